@@ -2,34 +2,180 @@ import discord
 import dataclasses
 import sqlite3
 import asyncio
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
 import contextlib
+import contextvars
+import functools
+import heapq
 import inspect
+import itertools
 import json
+import mmap
+import queue
 import random
 import re
+import signal
+import struct
+import subprocess
+import sys
 import os
+import threading
+import time
+import traceback
+import zlib
 
 from typing import *
 
-intents = discord.Intents().all()
-client: discord.Client = discord.Client(intents=intents)
+STARTED = time.monotonic()
+
+# "lean" asks only for what the handlers use and caches just the members who
+# are in voice; "full" is everything, with the whole member list chunked in
+# at startup. Without the members intent on_member_update only arrives for
+# the bot itself, other members' role changes are picked up by the
+# permission cache's TTL.
+INTENTS_PROFILE = os.getenv('PARTYBOT_INTENTS', 'lean').lower()
+if INTENTS_PROFILE == 'full':
+    intents = discord.Intents().all()
+    member_cache_flags = discord.MemberCacheFlags.all()
+else:
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.guild_messages = True
+    member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+
+# Sharding: PARTYBOT_SHARD_COUNT alone runs every shard in this process with
+# AutoShardedClient; PARTYBOT_WORKERS > 1 makes this process a supervisor that
+# starts that many workers, each given its own PARTYBOT_SHARD_IDS.
+SHARD_COUNT = int(os.getenv('PARTYBOT_SHARD_COUNT', '0'))
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('PARTYBOT_SHARD_IDS', '').split(',') if shard_id.strip()] or None
+WORKERS = int(os.getenv('PARTYBOT_WORKERS', '1'))
+if SHARD_COUNT:
+    client: discord.Client = discord.AutoShardedClient(
+        shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, intents=intents,
+        member_cache_flags=member_cache_flags, chunk_guilds_at_startup=intents.members)
+else:
+    client: discord.Client = discord.Client(
+        intents=intents, member_cache_flags=member_cache_flags, chunk_guilds_at_startup=intents.members)
 
 USER_ID_PATTERN = re.compile(r'<?@?!?(\d+)>?')
 CHANNEL_LIMIT = 50
 REQUIRED_PERMISSIONS = discord.Permissions(16778256)
 TOKEN = os.getenv('PARTYBOT_TOKEN')
+TRACE_FILE = os.getenv('PARTYBOT_TRACE_FILE')
+WRITE_BEHIND = os.getenv('PARTYBOT_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+WRITE_BEHIND_INTERVAL = float(os.getenv('PARTYBOT_WRITE_BEHIND_INTERVAL', '0.005'))
+WRITE_BEHIND_MAX_OPS = int(os.getenv('PARTYBOT_WRITE_BEHIND_MAX_OPS', '256'))
+PIPELINE_BACKLOG_WARNING = int(os.getenv('PARTYBOT_PIPELINE_BACKLOG_WARNING', '50'))
+POOL_REFILL_INTERVAL = float(os.getenv('PARTYBOT_POOL_REFILL_INTERVAL', '30'))
+POOL_REFILL_STEP = int(os.getenv('PARTYBOT_POOL_REFILL_STEP', '5'))
+POOL_CHANNEL_NAME = "PartyBot Room"
+POOL_REFILL = object()
+CHANNEL_REAP = object()
+REAPER_GRACE = float(os.getenv('PARTYBOT_REAPER_GRACE', '30'))
+REAPER_INTERVAL = float(os.getenv('PARTYBOT_REAPER_INTERVAL', '10'))
+RECONCILE = object()
+CATEGORY_SCALE = object()
+ADMIT = object()
+# Joiners who find no room wait in the join channel; past these they're
+# disconnected on purpose instead.
+ADMISSION_MAX_WAITING = int(os.getenv('PARTYBOT_ADMISSION_MAX_WAITING', '100'))
+ADMISSION_MAX_WAIT = float(os.getenv('PARTYBOT_ADMISSION_MAX_WAIT', '600'))
+ADMISSION_INTERVAL = float(os.getenv('PARTYBOT_ADMISSION_INTERVAL', '5'))
+RECONCILE_INTERVAL = float(os.getenv('PARTYBOT_RECONCILE_INTERVAL', '3600'))
+# Free room slots across a guild's categories at which another category is
+# made ahead of demand, and that must remain after an empty one is deleted.
+AUTOSCALE_UP_FREE = int(os.getenv('PARTYBOT_AUTOSCALE_UP_FREE', '5'))
+AUTOSCALE_DOWN_FREE = int(os.getenv('PARTYBOT_AUTOSCALE_DOWN_FREE', '20'))
+AUTOSCALE_MIN_LIFETIME = float(os.getenv('PARTYBOT_AUTOSCALE_MIN_LIFETIME', '900'))
+AUTOSCALE_DOWN_DELAY = float(os.getenv('PARTYBOT_AUTOSCALE_DOWN_DELAY', '300'))
+AUTOSCALE_INTERVAL = float(os.getenv('PARTYBOT_AUTOSCALE_INTERVAL', '60'))
+# Extra categories holding this many rooms or fewer are emptied into the
+# others when things are quiet, 0 turns that off.
+AUTOSCALE_CONSOLIDATE_BELOW = int(os.getenv('PARTYBOT_AUTOSCALE_CONSOLIDATE_BELOW', '0'))
+CATEGORY_POLICY_FILL_FIRST = "fill_first"
+CATEGORY_POLICY_LEAST_LOADED = "least_loaded"
+CATEGORY_POLICIES = (CATEGORY_POLICY_FILL_FIRST, CATEGORY_POLICY_LEAST_LOADED)
+SCHEDULER_WORKERS = int(os.getenv('PARTYBOT_SCHEDULER_WORKERS', '4'))
+SCHEDULER_GUILD_RATE = float(os.getenv('PARTYBOT_SCHEDULER_GUILD_RATE', '10'))
+SCHEDULER_GUILD_BURST = float(os.getenv('PARTYBOT_SCHEDULER_GUILD_BURST', '20'))
+SCHEDULER_GLOBAL_RATE = float(os.getenv('PARTYBOT_SCHEDULER_GLOBAL_RATE', '45'))
+SCHEDULER_GLOBAL_BURST = float(os.getenv('PARTYBOT_SCHEDULER_GLOBAL_BURST', '50'))
+SCHEDULER_RESERVE = float(os.getenv('PARTYBOT_SCHEDULER_RESERVE', '3'))
+
+PROVISION_CONCURRENCY = int(os.getenv('PARTYBOT_PROVISION_CONCURRENCY', '5'))
+PROVISION_PROGRESS_INTERVAL = float(os.getenv('PARTYBOT_PROVISION_PROGRESS_INTERVAL', '5'))
+PROVISION_MAX_FAILURES = int(os.getenv('PARTYBOT_PROVISION_MAX_FAILURES', '10'))
+PERMISSION_CACHE_TTL = float(os.getenv('PARTYBOT_PERMISSION_CACHE_TTL', '300'))
+# Any of these makes Storage's caches bounded; it then reads through to
+# SQLite on a miss instead of loading every row at startup.
+CACHE_MAX_GUILDS = int(os.getenv('PARTYBOT_CACHE_MAX_GUILDS', '0'))
+CACHE_MAX_OWNERS = int(os.getenv('PARTYBOT_CACHE_MAX_OWNERS', '0'))
+CACHE_TTL = float(os.getenv('PARTYBOT_CACHE_TTL', '0'))
+NEGATIVE_CACHE_TTL = float(os.getenv('PARTYBOT_NEGATIVE_CACHE_TTL', '300'))
+MAINTENANCE_WINDOW = os.getenv('PARTYBOT_MAINTENANCE_WINDOW', '3-5')
+MAINTENANCE_INTERVAL = float(os.getenv('PARTYBOT_MAINTENANCE_INTERVAL', '300'))
+MAINTENANCE_STEP_PAGES = int(os.getenv('PARTYBOT_MAINTENANCE_STEP_PAGES', '64'))
+MAINTENANCE_STEP_PAUSE = float(os.getenv('PARTYBOT_MAINTENANCE_STEP_PAUSE', '0.05'))
+# Converting an older file to incremental auto-vacuum is a full VACUUM holding
+# the write lock; above this size it's left for when the bot is stopped.
+MAINTENANCE_ONLINE_VACUUM_MAX_BYTES = int(os.getenv('PARTYBOT_MAINTENANCE_ONLINE_VACUUM_MAX_BYTES', str(16 * 2 ** 20)))
+BACKUP_DIRECTORY = os.getenv('PARTYBOT_BACKUP_DIRECTORY')
+BACKUP_KEEP = int(os.getenv('PARTYBOT_BACKUP_KEEP', '7'))
+# Empty turns snapshots off; shard workers add their shard ids to the name.
+SNAPSHOT_FILE = os.getenv('PARTYBOT_SNAPSHOT_FILE', 'partybot.snapshot')
+SNAPSHOT_INTERVAL = float(os.getenv('PARTYBOT_SNAPSHOT_INTERVAL', '300'))
+SNAPSHOT_ATTEMPTS = int(os.getenv('PARTYBOT_SNAPSHOT_ATTEMPTS', '5'))
+SNAPSHOT_RETRY_DELAY = float(os.getenv('PARTYBOT_SNAPSHOT_RETRY_DELAY', '0.05'))
+SUPERVISOR_IDENTIFY_INTERVAL = float(os.getenv('PARTYBOT_SUPERVISOR_IDENTIFY_INTERVAL', '5'))
+SUPERVISOR_RESTART_DELAY = float(os.getenv('PARTYBOT_SUPERVISOR_RESTART_DELAY', '5'))
+SUPERVISOR_MAX_RESTART_DELAY = float(os.getenv('PARTYBOT_SUPERVISOR_MAX_RESTART_DELAY', '300'))
+METRICS_HOST = os.getenv('PARTYBOT_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('PARTYBOT_METRICS_PORT', '0'))
+METRICS_FILE = os.getenv('PARTYBOT_METRICS_FILE')
+METRICS_INTERVAL = float(os.getenv('PARTYBOT_METRICS_INTERVAL', '15'))
+# Handlers slower than this many seconds get a phase breakdown and sampled
+# stacks written to PROFILE_FILE; 0 leaves the profiler out entirely.
+PROFILE_THRESHOLD = float(os.getenv('PARTYBOT_PROFILE_THRESHOLD', '0'))
+PROFILE_FILE = os.getenv('PARTYBOT_PROFILE_FILE', 'partybot-slow.jsonl')
+PROFILE_MAX_BYTES = int(os.getenv('PARTYBOT_PROFILE_MAX_BYTES', str(4 * 2 ** 20)))
+PROFILE_BACKUPS = int(os.getenv('PARTYBOT_PROFILE_BACKUPS', '3'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PARTYBOT_PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_SAMPLE_WINDOW = float(os.getenv('PARTYBOT_PROFILE_SAMPLE_WINDOW', '30'))
+LOOP_STALL_THRESHOLD = float(os.getenv('PARTYBOT_LOOP_STALL_THRESHOLD', '0.25'))
+
+PRIORITY_MOVE = 0
+PRIORITY_CREATE = 1
+PRIORITY_EDIT = 2
+PRIORITY_BULK = 3
+PRIORITY_DELETE = 4
 print(f"TOKEN: {TOKEN}")
 
 
+def slotted(cls):
+    # What dataclass(slots=True) does on 3.10+: rebuild the class with
+    # __slots__ for its fields, so instances don't carry a __dict__.
+    names = tuple(field.name for field in dataclasses.fields(cls))
+    namespace = {key: value for key, value in cls.__dict__.items()
+                 if key not in names and key not in ('__dict__', '__weakref__')}
+    namespace['__slots__'] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+@slotted
 @dataclasses.dataclass
 class PartyBotOwnerChannel:
     channel_id: int
     user_id: int
 
     def __repr__(self):
-        return str(vars(self))
+        return str(dataclasses.asdict(self))
 
 
+@slotted
 @dataclasses.dataclass
 class PartyBotGuildSettings:
     guild_id: int
@@ -40,6 +186,8 @@ class PartyBotGuildSettings:
     manage_role_id: int
     dynamic_category_creation: bool
     max_categories: int
+    pool_size: int = 0
+    category_policy: str = CATEGORY_POLICY_FILL_FIRST
 
     @staticmethod
     def is_valid_channel_id(guild, channel_id):
@@ -65,8 +213,1566 @@ class PartyBotGuildSettings:
     def is_valid_moderator_role_id(guild, role_id):
         return guild.get_role(role_id)
 
+    @staticmethod
+    def is_valid_category_policy(policy):
+        return policy in CATEGORY_POLICIES
+
     def __repr__(self):
-        return str(vars(self))
+        return str(dataclasses.asdict(self))
+
+
+class Histogram:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    # Latency histograms recorded where the work happens, plus collectors that
+    # read the counters and sizes the other components already keep when a
+    # snapshot is rendered. Rendered in the Prometheus text format, served by
+    # metrics_server() and/or written by metrics_snapshot_loop().
+
+    def __init__(self):
+        self.histograms: Dict[str, Dict[Tuple[Tuple[str, str], ...], Histogram]] = \
+            collections.defaultdict(dict)
+        self.help: Dict[str, str] = {}
+        self.collectors: List[Callable[[], Iterable[Tuple[str, str, str, Dict[str, Any], float]]]] = []
+
+    def histogram(self, name, help_, **labels) -> Histogram:
+        self.help.setdefault(name, help_)
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        histogram = self.histograms[name].get(key)
+        if histogram is None:
+            histogram = self.histograms[name][key] = Histogram()
+        return histogram
+
+    def observe(self, name, help_, value, **labels):
+        self.histogram(name, help_, **labels).observe(value)
+
+    def timed(self, name):
+        # Times a coroutine function into partybot_handler_seconds.
+        def decorator(function):
+            histogram = self.histogram("partybot_handler_seconds", "Event handler latency.", handler=name)
+
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                trace = slow_handler_profiler.begin(name) if slow_handler_profiler else None
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    histogram.observe(elapsed)
+                    if trace:
+                        slow_handler_profiler.finish(trace, elapsed)
+            return wrapper
+        return decorator
+
+    def collector(self, function):
+        self.collectors.append(function)
+        return function
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+    def render(self):
+        lines = []
+        for name, histograms in sorted(self.histograms.items()):
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', repr(float(bound))),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+
+        samples: Dict[str, List[Tuple[str, str, Tuple[Tuple[str, str], ...], float]]] = collections.defaultdict(list)
+        for collect in self.collectors:
+            try:
+                for name, type_, help_, labels, value in collect():
+                    labels = tuple(sorted((label, str(value)) for label, value in labels.items()))
+                    samples[name].append((type_, help_, labels, value))
+            except Exception:
+                traceback.print_exc()
+        for name, values in sorted(samples.items()):
+            lines.append(f"# HELP {name} {values[0][1]}")
+            lines.append(f"# TYPE {name} {values[0][0]}")
+            for _, _, labels, value in values:
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class DatabaseExecutor:
+    # One thread owns the sqlite3 connection. Work is handed to it through a
+    # queue, so storage never competes with discord.py for the loop's default
+    # executor and statements are compiled once and reused by the connection's
+    # statement cache.
+
+    def __init__(self, filename, cached_statements=128, pragmas=(), name="partybot-db"):
+        self.filename = filename
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas
+        self.operations = 0
+        self._requests: "queue.Queue[Optional[Tuple[concurrent.futures.Future, Callable]]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        connection = sqlite3.connect(self.filename, cached_statements=self.cached_statements)
+        cursor = connection.cursor()
+        for pragma in self.pragmas:
+            cursor.execute(pragma)
+        try:
+            while True:
+                request = self._requests.get()
+                if request is None:
+                    break
+
+                future, function = request
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                self.operations += 1
+                try:
+                    result = function(connection, cursor)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            cursor.close()
+            connection.close()
+
+    def submit(self, function: Callable[[sqlite3.Connection, sqlite3.Cursor], Any]) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self._requests.put((future, function))
+        return future
+
+    def call(self, function):
+        return self.submit(function).result()
+
+    async def run(self, function, operation="run"):
+        # Timed from the loop's side, so the histogram includes queueing behind
+        # other statements, which is what a handler actually waits for.
+        start = time.perf_counter()
+        trace = slow_handler_profiler.current() if slow_handler_profiler else None
+        top = trace.enter() if trace else False
+        try:
+            return await asyncio.wrap_future(self.submit(function))
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("partybot_db_seconds", "SQLite operation latency, including queueing.",
+                            elapsed, operation=operation)
+            if trace:
+                trace.exit("db." + operation, elapsed, top)
+
+    async def fetchone(self, query, params):
+        return await self.run(lambda connection, cursor: cursor.execute(query, params).fetchone(), "fetchone")
+
+    async def fetchall(self, query, params):
+        return await self.run(lambda connection, cursor: cursor.execute(query, params).fetchall(), "fetchall")
+
+    async def fetchone_many(self, query, params_list):
+        def _f(connection, cursor):
+            return [cursor.execute(query, params).fetchone() for params in params_list]
+
+        return await self.run(_f, "fetchone_many")
+
+    async def execute(self, query, params):
+        def _f(connection, cursor):
+            cursor.execute(query, params)
+            connection.commit()
+
+        await self.run(_f, "execute")
+
+    async def execute_batch(self, writes):
+        await self.run(lambda connection, cursor: DatabaseExecutor._execute_batch(connection, cursor, writes),
+                       "execute_batch")
+
+    def execute_batch_sync(self, writes):
+        self.call(lambda connection, cursor: DatabaseExecutor._execute_batch(connection, cursor, writes))
+
+    @staticmethod
+    def _execute_batch(connection, cursor, writes):
+        try:
+            for query, params in writes:
+                cursor.execute(query, params)
+            connection.commit()
+        except sqlite3.Error as e:
+            # Don't let one bad row take the rest of the batch with it.
+            connection.rollback()
+            print(f"Storage batch of {len(writes)} writes failed ({e!r}), retrying one by one.")
+            for query, params in writes:
+                try:
+                    cursor.execute(query, params)
+                    connection.commit()
+                except sqlite3.Error as e:
+                    connection.rollback()
+                    print(f"Storage dropped write {query.strip()!r} {params}: {e!r}")
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+
+PERMISSION_OWNER = "owner"
+PERMISSION_MANAGER = "manager"
+
+
+class PermissionCache:
+    # Caches the bot's "missing REQUIRED_PERMISSIONS" verdict per channel and
+    # each member's manager/moderator/admin flags per guild. Role, member,
+    # channel and settings events invalidate entries; member entries also
+    # expire after a TTL in case the member update events aren't delivered.
+    MANAGER = 1
+    MODERATOR = 2
+    ADMINISTRATOR = 4
+
+    def __init__(self, ttl=PERMISSION_CACHE_TTL):
+        self.ttl = ttl
+        self.bot_missing: Dict[int, Dict[int, bool]] = {}
+        self.members: Dict[int, Dict[int, Tuple[int, float]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bot_missing_permissions(self, channel):
+        channels = self.bot_missing.setdefault(channel.guild.id, {})
+        missing = channels.get(channel.id)
+        if missing is None:
+            self.misses += 1
+            missing = channels[channel.id] = channel.permissions_for(channel.guild.me) < REQUIRED_PERMISSIONS
+        else:
+            self.hits += 1
+        return missing
+
+    def member_flags(self, member, guild_settings):
+        members = self.members.setdefault(member.guild.id, {})
+        now = time.monotonic()
+        entry = members.get(member.id)
+        if entry is not None and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        flags = 0
+        if member.guild.get_role(guild_settings.manage_role_id) in member.roles:
+            flags |= PermissionCache.MANAGER
+        if member.guild.get_role(guild_settings.moderator_role_id) in member.roles:
+            flags |= PermissionCache.MODERATOR
+        if member.guild_permissions.administrator:
+            flags |= PermissionCache.ADMINISTRATOR
+        members[member.id] = (flags, now + self.ttl)
+        return flags
+
+    def is_staff(self, member, guild_settings):
+        return self.member_flags(member, guild_settings) != 0
+
+    def is_manager(self, member, guild_settings):
+        return self.member_flags(member, guild_settings) & (PermissionCache.MANAGER | PermissionCache.ADMINISTRATOR) != 0
+
+    def invalidate_guild(self, guild_id):
+        self.bot_missing.pop(guild_id, None)
+        self.members.pop(guild_id, None)
+
+    def invalidate_members(self, guild_id):
+        self.members.pop(guild_id, None)
+
+    def invalidate_member(self, guild_id, member_id):
+        members = self.members.get(guild_id)
+        if members:
+            members.pop(member_id, None)
+
+    def invalidate_bot(self, guild_id):
+        self.bot_missing.pop(guild_id, None)
+
+    def invalidate_channel(self, guild_id, channel_id):
+        channels = self.bot_missing.get(guild_id)
+        if channels:
+            channels.pop(channel_id, None)
+
+
+@dataclasses.dataclass
+class CommandContext:
+    message: discord.Message
+    guild: discord.Guild
+    guild_settings: "PartyBotGuildSettings"
+    arguments: List[str]
+    voice_channel: Optional[discord.VoiceChannel] = None
+
+
+@dataclasses.dataclass
+class Command:
+    name: str
+    handler: Callable[[CommandContext], Awaitable[None]]
+    permission: str
+
+
+class CommandRouter:
+    # Maps "!pb <name>" to a handler and the permission it needs. Owner
+    # commands only work in the command channel for someone who owns a room,
+    # manager commands need administrator or the manage role.
+    PREFIX = "!pb"
+
+    def __init__(self):
+        self.commands: Dict[str, Command] = {}
+        self.timings: Dict[str, Dict[str, float]] = collections.defaultdict(lambda: collections.defaultdict(float))
+
+    def command(self, name, permission):
+        def decorator(handler):
+            self.commands[name] = Command(name, handler, permission)
+            return handler
+        return decorator
+
+    def parse(self, content) -> Optional[Tuple[Command, List[str]]]:
+        argument_list = content.split()
+        if len(argument_list) < 2 or argument_list[0] != CommandRouter.PREFIX:
+            return None
+
+        command = self.commands.get(argument_list[1])
+        if not command:
+            return None
+        return command, argument_list[2:]
+
+    def is_permitted(self, command, context):
+        if command.permission == PERMISSION_OWNER:
+            return context.voice_channel is not None
+
+        if not permission_cache.is_manager(context.message.author, context.guild_settings):
+            return False
+
+        if permission_cache.bot_missing_permissions(context.message.channel):
+            print(f"PartyBot is missing permissions in channel {context.message.channel.id}.")
+            return False
+        return True
+
+    async def dispatch(self, command, context):
+        if not self.is_permitted(command, context):
+            return
+
+        timing = self.timings[command.name]
+        start = time.perf_counter()
+        trace = slow_handler_profiler.current() if slow_handler_profiler else None
+        top = trace.enter() if trace else False
+        try:
+            await command.handler(context)
+        finally:
+            elapsed = time.perf_counter() - start
+            timing['count'] += 1
+            timing['total'] += elapsed
+            timing['max'] = max(timing['max'], elapsed)
+            metrics.observe("partybot_command_seconds", "!pb command latency.", elapsed, command=command.name)
+            if trace:
+                trace.exit("command." + command.name, elapsed, top)
+
+
+class GuildEventPipeline:
+    # Serializes event handling per guild while different guilds still run
+    # concurrently. Events that pile up while a guild's handler is busy are
+    # handed to the next pass as a single batch.
+
+    def __init__(self, handler: Callable[[int, List[Any]], Awaitable[None]], backlog_warning=PIPELINE_BACKLOG_WARNING):
+        self.handler = handler
+        self.backlog_warning = backlog_warning
+        self.queues: Dict[int, Deque[Any]] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.events = 0
+        self.batches = 0
+        self.max_batch = 0
+
+    def submit(self, guild_id, event):
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            queue = self.queues[guild_id] = collections.deque()
+            self.workers[guild_id] = asyncio.ensure_future(self._worker(guild_id, queue))
+
+        queue.append(event)
+        if self.backlog_warning and len(queue) % self.backlog_warning == 0:
+            print(f"Guild {guild_id} voice pipeline backlogged: {len(queue)} events queued.")
+
+    async def _worker(self, guild_id, queue):
+        try:
+            while queue:
+                batch = list(queue)
+                queue.clear()
+
+                self.events += len(batch)
+                self.batches += 1
+                self.max_batch = max(self.max_batch, len(batch))
+                try:
+                    await self.handler(guild_id, batch)
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            del self.queues[guild_id]
+            del self.workers[guild_id]
+
+    def queue_depth(self, guild_id):
+        queue = self.queues.get(guild_id)
+        return len(queue) if queue else 0
+
+    def queue_depths(self):
+        return {guild_id: len(queue) for guild_id, queue in self.queues.items()}
+
+    async def join(self):
+        while self.workers:
+            await asyncio.wait(list(self.workers.values()))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, reserve=0):
+        # Seconds until a token above `reserve` is available, 0 if one is now.
+        self._refill()
+        missing = reserve + 1 - self.tokens
+        return 0 if missing <= 0 else missing / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+@dataclasses.dataclass
+class ScheduledAction:
+    priority: int
+    kind: str
+    bucket: str
+    action: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    key: Optional[Hashable] = None
+    still_needed: Optional[Callable[[], bool]] = None
+    submitted: float = dataclasses.field(default_factory=time.monotonic)
+    started: bool = False
+    # The submitting handler's HandlerTrace, when profiling.
+    trace: Optional[Any] = None
+
+
+class ActionScheduler:
+    # Every Discord REST call the bot makes goes through here. Actions run by
+    # priority class, deferred classes (edits, bulk work, deletes) only spend
+    # budget above a reserve kept for moves and creates, and an action with the
+    # same key as one still queued replaces it instead of running twice.
+
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.worker_count = workers
+        self.workers: List[asyncio.Task] = []
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.global_bucket = TokenBucket(SCHEDULER_GLOBAL_RATE, SCHEDULER_GLOBAL_BURST)
+        self.stats: Dict[str, Dict[str, float]] = collections.defaultdict(lambda: collections.defaultdict(float))
+        self.depths: Dict[int, int] = collections.defaultdict(int)
+        self.running = 0
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._pending: Dict[Hashable, ScheduledAction] = {}
+        self._sequence = itertools.count()
+
+    def submit(self, priority, kind, bucket, action, key=None, still_needed=None) -> asyncio.Future:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            self.workers = [asyncio.ensure_future(self._worker()) for _ in range(self.worker_count)]
+
+        stats = self.stats[kind]
+        stats['submitted'] += 1
+
+        if key is not None:
+            pending = self._pending.get(key)
+            if pending is not None and not pending.started:
+                pending.action = action
+                pending.still_needed = still_needed
+                stats['merged'] += 1
+                return pending.future
+
+        scheduled = ScheduledAction(
+            priority, kind, bucket, action, asyncio.get_event_loop().create_future(), key, still_needed)
+        if slow_handler_profiler:
+            scheduled.trace = slow_handler_profiler.current()
+        if key is not None:
+            self._pending[key] = scheduled
+        self._put(scheduled)
+        return scheduled.future
+
+    def defer(self, priority, kind, bucket, action, key=None, still_needed=None):
+        def _done(future):
+            if not future.cancelled() and future.exception():
+                print(f"PartyBot {kind} failed: {future.exception()!r}")
+
+        future = self.submit(priority, kind, bucket, action, key, still_needed)
+        future.add_done_callback(_done)
+        return future
+
+    def _put(self, scheduled):
+        self.depths[scheduled.priority] += 1
+        self._queue.put_nowait((scheduled.priority, next(self._sequence), scheduled))
+
+    def _bucket(self, name):
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = TokenBucket(SCHEDULER_GUILD_RATE, SCHEDULER_GUILD_BURST)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            _, _, scheduled = await self._queue.get()
+            self.depths[scheduled.priority] -= 1
+
+            if scheduled.future.done():
+                continue
+
+            bucket = self._bucket(scheduled.bucket)
+            reserve = SCHEDULER_RESERVE if scheduled.priority > PRIORITY_CREATE else 0
+            delay = max(bucket.delay(reserve), self.global_bucket.delay(reserve))
+            if delay > 0:
+                if scheduled.priority > PRIORITY_CREATE:
+                    # Don't hold a worker for deferred work, moves may be waiting.
+                    self.depths[scheduled.priority] += 1
+                    asyncio.get_event_loop().call_later(
+                        delay, self._queue.put_nowait, (scheduled.priority, next(self._sequence), scheduled))
+                    continue
+                await asyncio.sleep(delay)
+
+            await self._execute(scheduled, bucket)
+
+    async def _execute(self, scheduled, bucket):
+        stats = self.stats[scheduled.kind]
+        scheduled.started = True
+        if scheduled.key is not None and self._pending.get(scheduled.key) is scheduled:
+            del self._pending[scheduled.key]
+
+        if scheduled.still_needed is not None and not scheduled.still_needed():
+            stats['skipped'] += 1
+            scheduled.future.set_result(None)
+            return
+
+        bucket.take()
+        self.global_bucket.take()
+        self.running += 1
+        start = time.monotonic()
+        try:
+            result = await scheduled.action()
+        except discord.NotFound as e:
+            # Someone else already removed it, that's what a delete wanted anyway.
+            stats['skipped'] += 1
+            if scheduled.priority == PRIORITY_DELETE:
+                scheduled.future.set_result(None)
+            else:
+                scheduled.future.set_exception(e)
+        except Exception as e:
+            stats['failed'] += 1
+            scheduled.future.set_exception(e)
+        else:
+            stats['completed'] += 1
+            scheduled.future.set_result(result)
+        finally:
+            self.running -= 1
+            now = time.monotonic()
+            stats['latency_total'] += now - scheduled.submitted
+            stats['latency_max'] = max(stats['latency_max'], now - scheduled.submitted)
+            stats['call_total'] += now - start
+            metrics.observe("partybot_rest_seconds", "Discord REST call latency.", now - start, kind=scheduled.kind)
+            metrics.observe("partybot_rest_queued_seconds", "Discord REST latency from submit to response.",
+                            now - scheduled.submitted, kind=scheduled.kind)
+            if scheduled.trace:
+                # What a handler awaiting it waited; deferred actions that
+                # finish within the handler are counted too.
+                scheduled.trace.add_phase("rest." + scheduled.kind, now - scheduled.submitted, scheduled.trace.depth == 0)
+
+    def queue_depth(self):
+        return sum(self.depths.values())
+
+    def idle(self):
+        return self.running == 0 and self.queue_depth() == 0
+
+    # Shorthands for the calls the handlers make.
+
+    def move(self, member, channel, reason):
+        return self.submit(
+            PRIORITY_MOVE, "move", f"guild:{member.guild.id}",
+            lambda: member.move_to(channel, reason=reason))
+
+    def create_voice_channel(self, guild, name, priority=PRIORITY_CREATE, **kwargs):
+        return self.submit(
+            priority, "create_voice_channel", f"guild:{guild.id}",
+            lambda: guild.create_voice_channel(name, **kwargs))
+
+    def create_category(self, guild, name, **kwargs):
+        return self.submit(
+            PRIORITY_CREATE, "create_category", f"guild:{guild.id}",
+            lambda: guild.create_category(name, **kwargs))
+
+    def edit(self, channel, **kwargs):
+        return self.submit(
+            PRIORITY_EDIT, "edit", f"guild:{channel.guild.id}",
+            lambda: channel.edit(**kwargs), key=("edit", channel.id, tuple(sorted(kwargs))),
+            still_needed=lambda: channel.guild.get_channel(channel.id) is not None)
+
+    def delete(self, channel, reason):
+        return self.defer(
+            PRIORITY_DELETE, "delete", f"guild:{channel.guild.id}",
+            lambda: channel.delete(reason=reason), key=("delete", channel.id),
+            still_needed=lambda: channel.guild.get_channel(channel.id) is not None)
+
+
+@dataclasses.dataclass
+class ProvisioningRun:
+    guild_id: int
+    category_ids: List[int]
+    remaining: Dict[int, int] = dataclasses.field(default_factory=dict)
+    created: int = 0
+    failed: int = 0
+    total: int = 0
+    task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self):
+        return not any(self.remaining.values())
+
+    def progress(self):
+        return f"Provisioned {self.created}/{self.total} channels across {len(self.category_ids)} categories" + \
+            (f", {self.failed} failed" if self.failed else "") + "."
+
+
+class BulkProvisioner:
+    # Fills categories with rooms using a bounded number of concurrent creates
+    # that go through the action scheduler at bulk priority. A run's plan is
+    # recomputed from the live categories on resume, so a run that was
+    # interrupted picks up where it stopped.
+
+    def __init__(self, concurrency=PROVISION_CONCURRENCY):
+        self.concurrency = concurrency
+        self.runs: Dict[int, ProvisioningRun] = {}
+
+    def is_running(self, guild_id):
+        run = self.runs.get(guild_id)
+        return run is not None and run.task is not None and not run.task.done()
+
+    def plan(self, guild, category_ids):
+        run = ProvisioningRun(guild.id, list(category_ids))
+        for category_id in run.category_ids:
+            category = guild.get_channel(category_id)
+            if category:
+                run.remaining[category_id] = max(0, CHANNEL_LIMIT - len(category.channels))
+        run.total = sum(run.remaining.values())
+        self.runs[guild.id] = run
+        return run
+
+    def start(self, guild, run, status_channel):
+        run.task = asyncio.ensure_future(self._run(guild, run, status_channel))
+        return run.task
+
+    async def _run(self, guild, run, status_channel):
+        status = await status_channel.send(run.progress())
+
+        in_flight: Dict[int, int] = collections.defaultdict(int)
+        # What this run made, whether or not the gateway has told us yet.
+        created: Dict[int, Set[int]] = collections.defaultdict(set)
+
+        async def _worker():
+            while run.failed < PROVISION_MAX_FAILURES:
+                category_id = next((c for c, n in run.remaining.items() if n > 0), None)
+                if category_id is None:
+                    return
+
+                # Other code (joins, the pool) may be creating rooms here too.
+                category = guild.get_channel(category_id)
+                if not category or len({channel.id for channel in category.channels} | created[category_id]) + \
+                        in_flight[category_id] >= CHANNEL_LIMIT:
+                    run.remaining[category_id] = 0
+                    continue
+
+                # Claim the slot before awaiting so other workers skip it, and
+                # in the occupancy so joins don't take it either.
+                run.remaining[category_id] -= 1
+                in_flight[category_id] += 1
+                occupancy = category_occupancy.get(guild.id)
+                if occupancy is not None:
+                    occupancy.reserve(category_id)
+                try:
+                    channel = await action_scheduler.create_voice_channel(
+                        guild,
+                        POOL_CHANNEL_NAME,
+                        priority=PRIORITY_BULK,
+                        category=category,
+                        bitrate=32000,
+                        user_limit=4,
+                        reason="PartyBot create member channel."
+                    )
+                except discord.HTTPException as e:
+                    run.remaining[category_id] += 1
+                    run.failed += 1
+                    print(f"PartyBot provisioning in category {category_id} failed: {e!r}")
+                    continue
+                finally:
+                    in_flight[category_id] -= 1
+                    if occupancy is not None:
+                        occupancy.unreserve(category_id)
+
+                run.created += 1
+                created[category_id].add(channel.id)
+                occupancy = category_occupancy.get(guild.id)
+                if occupancy is not None:
+                    occupancy.add_channel(category_id, channel.id)
+
+        async def _report():
+            while True:
+                await asyncio.sleep(PROVISION_PROGRESS_INTERVAL)
+                action_scheduler.defer(
+                    PRIORITY_EDIT, "progress", f"guild:{guild.id}",
+                    lambda: status.edit(content=run.progress()), key=("progress", status.id))
+
+        reporter = asyncio.ensure_future(_report())
+        try:
+            await asyncio.gather(*(_worker() for _ in range(self.concurrency)))
+        finally:
+            reporter.cancel()
+
+        if run.finished:
+            del self.runs[guild.id]
+            await status.edit(content=run.progress())
+        else:
+            await status.edit(content=run.progress() + " Stopped, use `!pb fill_category resume` to continue.")
+
+
+class CategoryOccupancy:
+    # Channel ids per managed category of one guild. Updates are idempotent so
+    # both our own REST responses and the gateway events can feed it.
+    # Categories with free slots are kept sorted by rank (their order in the
+    # guild's category list) for fill-first; least-loaded uses a lazy heap.
+
+    def __init__(self, capacity=CHANNEL_LIMIT - 1):
+        self.capacity = capacity
+        self.channels: Dict[int, Set[int]] = {}
+        # Creates still in flight from outside the guild pipeline; they take
+        # a slot until the channel shows up.
+        self.pending: Dict[int, int] = {}
+        self.ranks: Dict[int, int] = {}
+        self._next_rank = 0
+        self._available: List[Tuple[int, int]] = []
+        self._heap: List[Tuple[int, int, int]] = []
+
+    def __contains__(self, category_id):
+        return category_id in self.channels
+
+    def channel_count(self, category_id):
+        return len(self.channels.get(category_id, ())) + self.pending.get(category_id, 0)
+
+    def free_slots(self, category_id):
+        return max(0, self.capacity - self.channel_count(category_id))
+
+    def add_category(self, category_id, channel_ids=()):
+        if category_id not in self.channels:
+            self.channels[category_id] = set()
+            self.ranks[category_id] = self._next_rank
+            self._next_rank += 1
+        self.channels[category_id].update(channel_ids)
+        self._update(category_id)
+
+    def remove_category(self, category_id):
+        self.pending.pop(category_id, None)
+        if self.channels.pop(category_id, None) is None:
+            return
+        rank = self.ranks.pop(category_id)
+        position = bisect.bisect_left(self._available, (rank, category_id))
+        if position < len(self._available) and self._available[position] == (rank, category_id):
+            del self._available[position]
+
+    def add_channel(self, category_id, channel_id):
+        channels = self.channels.get(category_id)
+        if channels is not None and channel_id not in channels:
+            channels.add(channel_id)
+            self._update(category_id)
+
+    def remove_channel(self, category_id, channel_id):
+        channels = self.channels.get(category_id)
+        if channels is not None and channel_id in channels:
+            channels.discard(channel_id)
+            self._update(category_id)
+
+    def reserve(self, category_id):
+        if category_id in self.channels:
+            self.pending[category_id] = self.pending.get(category_id, 0) + 1
+            self._update(category_id)
+
+    def unreserve(self, category_id):
+        pending = self.pending.get(category_id, 0)
+        if pending <= 1:
+            self.pending.pop(category_id, None)
+        else:
+            self.pending[category_id] = pending - 1
+        if pending and category_id in self.channels:
+            self._update(category_id)
+
+    def matches(self, guild):
+        for category_id, channel_ids in self.channels.items():
+            category = guild.get_channel(category_id)
+            if not category or {channel.id for channel in category.channels} != channel_ids:
+                return False
+        return True
+
+    def _update(self, category_id):
+        rank = self.ranks[category_id]
+        count = self.channel_count(category_id)
+        entry = (rank, category_id)
+        position = bisect.bisect_left(self._available, entry)
+        present = position < len(self._available) and self._available[position] == entry
+        if count < self.capacity:
+            if not present:
+                self._available.insert(position, entry)
+            heapq.heappush(self._heap, (count, rank, category_id))
+            if len(self._heap) > 4 * len(self.channels) + 16:
+                self._heap = [(self.channel_count(i), self.ranks[i], i) for i in self.channels
+                              if self.channel_count(i) < self.capacity]
+                heapq.heapify(self._heap)
+        elif present:
+            del self._available[position]
+
+    def pick(self, policy=CATEGORY_POLICY_FILL_FIRST) -> Optional[int]:
+        if policy == CATEGORY_POLICY_LEAST_LOADED:
+            while self._heap:
+                count, rank, category_id = self._heap[0]
+                if category_id in self.channels and self.channel_count(category_id) == count and \
+                        self.ranks[category_id] == rank:
+                    return category_id
+                heapq.heappop(self._heap)
+            return None
+        return self._available[0][1] if self._available else None
+
+
+class VoiceChannelPool:
+    # Idle, unowned rooms kept ready in the managed categories so a join only
+    # needs a move. Channel ids are kept per guild in an insertion-ordered dict.
+
+    def __init__(self):
+        self.idle: Dict[int, Dict[int, None]] = {}
+        self.refilling: Dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.recycled = 0
+
+    def size(self, guild_id):
+        return len(self.idle.get(guild_id, ()))
+
+    def take(self, guild) -> Optional[discord.VoiceChannel]:
+        idle = self.idle.get(guild.id)
+        while idle:
+            channel_id = next(iter(idle))
+            del idle[channel_id]
+            channel = guild.get_channel(channel_id)
+            if channel and not channel.members:
+                self.hits += 1
+                return channel
+        self.misses += 1
+        return None
+
+    def release(self, guild_id, channel_id):
+        self.idle.setdefault(guild_id, {})[channel_id] = None
+
+    def discard(self, guild_id, channel_id):
+        idle = self.idle.get(guild_id)
+        if idle and channel_id in idle:
+            del idle[channel_id]
+            return True
+        return False
+
+    def contains(self, guild_id, channel_id):
+        return channel_id in self.idle.get(guild_id, ())
+
+    def category_counts(self, guild) -> Counter:
+        counts: Counter = collections.Counter()
+        for channel_id in self.idle.get(guild.id, ()):
+            channel = guild.get_channel(channel_id)
+            if channel:
+                counts[channel.category_id] += 1
+        return counts
+
+    def discard_category(self, guild, category_id):
+        idle = self.idle.get(guild.id)
+        if idle:
+            for channel_id in list(idle):
+                channel = guild.get_channel(channel_id)
+                if not channel or channel.category_id == category_id:
+                    del idle[channel_id]
+
+    def start_refill(self, guild, join_channel, categories, target, policy=CATEGORY_POLICY_FILL_FIRST):
+        # Runs beside the guild's pipeline rather than on it, so joins are
+        # never held up behind pool creates.
+        if guild.id not in self.refilling:
+            self.refilling[guild.id] = asyncio.ensure_future(
+                self._refill_task(guild, join_channel, categories, target, policy))
+
+    async def _refill_task(self, guild, join_channel, categories, target, policy):
+        more = False
+        try:
+            more = await self.refill(guild, join_channel, categories, target, policy)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            del self.refilling[guild.id]
+        if more:
+            voice_pipeline.submit(guild.id, POOL_REFILL)
+
+    async def refill(self, guild, join_channel, categories, target, policy=CATEGORY_POLICY_FILL_FIRST,
+                     limit=POOL_REFILL_STEP):
+        # Only fills existing categories; new categories are left to joins so
+        # the pool never pushes a guild past max_categories. Creates go at
+        # bulk priority, behind the creates and moves placing members.
+        created = 0
+        while self.size(guild.id) < target and created < limit:
+            category = await get_unfilled_category(guild, categories, policy)
+            if not category:
+                break
+
+            occupancy = await get_category_occupancy(guild, categories)
+            occupancy.reserve(category.id)
+            try:
+                channel = await action_scheduler.create_voice_channel(
+                    guild,
+                    POOL_CHANNEL_NAME,
+                    priority=PRIORITY_BULK,
+                    category=category,
+                    bitrate=join_channel.bitrate,
+                    user_limit=join_channel.user_limit,
+                    reason="PartyBot pre-create pooled channel."
+                )
+            except discord.HTTPException as e:
+                print(f"PartyBot couldn't pre-create a pooled channel in category {category.id}: {e!r}")
+                return False
+            finally:
+                occupancy.unreserve(category.id)
+            (await get_category_occupancy(guild, categories)).add_channel(category.id, channel.id)
+            self.release(guild.id, channel.id)
+            self.created += 1
+            created += 1
+        return self.size(guild.id) < target and created == limit
+
+
+class ChannelReaper:
+    # Empty rooms are marked instead of deleted on the spot. A periodic sweep
+    # deletes whatever stayed empty for the whole grace period, so people who
+    # drop and rejoin don't cost a delete plus a create.
+
+    def __init__(self, grace=REAPER_GRACE):
+        self.grace = grace
+        self.marked: Dict[int, Dict[int, float]] = {}
+        self.marks = 0
+        self.cancelled = 0
+        self.reaped = 0
+        self.reclaimed = 0
+
+    def mark(self, guild_id, channel_id, due_now=False):
+        marked = self.marked.setdefault(guild_id, {})
+        if channel_id not in marked:
+            marked[channel_id] = time.monotonic() - (self.grace if due_now else 0)
+            self.marks += 1
+
+    def cancel(self, guild_id, channel_id):
+        marked = self.marked.get(guild_id)
+        if marked and marked.pop(channel_id, None) is not None:
+            self.cancelled += 1
+            return True
+        return False
+
+    def discard(self, guild_id, channel_id):
+        marked = self.marked.get(guild_id)
+        if marked:
+            marked.pop(channel_id, None)
+
+    def due_guilds(self):
+        deadline = time.monotonic() - self.grace
+        return [guild_id for guild_id, marked in self.marked.items()
+                if any(marked_at <= deadline for marked_at in marked.values())]
+
+    def take_due(self, guild_id):
+        marked = self.marked.get(guild_id)
+        if not marked:
+            return []
+
+        deadline = time.monotonic() - self.grace
+        due = [channel_id for channel_id, marked_at in marked.items() if marked_at <= deadline]
+        for channel_id in due:
+            del marked[channel_id]
+        if not marked:
+            del self.marked[guild_id]
+        return due
+
+    def reclaim(self, guild):
+        # An empty room still in its grace period, for when there's no other
+        # way to seat someone; oldest mark first.
+        marked = self.marked.get(guild.id)
+        while marked:
+            channel_id = next(iter(marked))
+            del marked[channel_id]
+            channel = guild.get_channel(channel_id)
+            if channel and not channel.members:
+                self.reclaimed += 1
+                return channel
+        self.marked.pop(guild.id, None)
+        return None
+
+
+class CategoryAutoscaler:
+    # Decides when extra categories come and go. One is made ahead of demand
+    # once free slots drop to scale_up_free; an empty one is only deleted on
+    # a scheduled pass, after it has been empty for down_delay and has lived
+    # min_lifetime, and only while the rest keep scale_down_free slots. The
+    # gap between the two thresholds stops load hovering around a category
+    # boundary from creating and deleting categories back to back. Idle pool
+    # rooms (pooled, per category) count as free slots, not load.
+
+    def __init__(self, scale_up_free=AUTOSCALE_UP_FREE, scale_down_free=AUTOSCALE_DOWN_FREE,
+                 min_lifetime=AUTOSCALE_MIN_LIFETIME, down_delay=AUTOSCALE_DOWN_DELAY,
+                 consolidate_below=AUTOSCALE_CONSOLIDATE_BELOW):
+        self.scale_up_free = scale_up_free
+        self.scale_down_free = max(scale_down_free, scale_up_free + 1)
+        self.min_lifetime = min_lifetime
+        self.down_delay = down_delay
+        self.consolidate_below = consolidate_below
+        self.empty_since: Dict[int, Dict[int, float]] = {}
+        self.scaled_up = 0
+        self.scaled_down = 0
+        self.consolidated = 0
+
+    @staticmethod
+    def age(category_id, now=None):
+        # From the snowflake, so it holds across restarts.
+        created = ((category_id >> 22) + discord.utils.DISCORD_EPOCH) / 1000
+        return (now or time.time()) - created
+
+    @staticmethod
+    def in_use(occupancy, category_id, pooled):
+        return max(0, occupancy.channel_count(category_id) - pooled.get(category_id, 0))
+
+    @staticmethod
+    def free_slots(occupancy, pooled=None):
+        pooled = pooled or {}
+        return sum(occupancy.free_slots(category_id) + pooled.get(category_id, 0)
+                   for category_id in occupancy.channels)
+
+    def wants_category(self, occupancy, guild_settings, categories, pooled=None):
+        return guild_settings.dynamic_category_creation and len(categories) < guild_settings.max_categories and \
+            self.free_slots(occupancy, pooled) <= self.scale_up_free
+
+    def track(self, guild_id, occupancy, main_category_id, pooled=None):
+        pooled = pooled or {}
+        now = time.monotonic()
+        previous = self.empty_since.get(guild_id, {})
+        empty = {category_id: previous.get(category_id, now) for category_id in occupancy.channels
+                 if category_id != main_category_id and self.in_use(occupancy, category_id, pooled) == 0}
+        if empty:
+            self.empty_since[guild_id] = empty
+        else:
+            self.empty_since.pop(guild_id, None)
+        return empty
+
+    def forget(self, guild_id):
+        self.empty_since.pop(guild_id, None)
+
+    def scale_down_candidates(self, guild_id, occupancy, main_category_id, pooled=None):
+        empty = self.track(guild_id, occupancy, main_category_id, pooled)
+        free = self.free_slots(occupancy, pooled)
+        monotonic, now = time.monotonic(), time.time()
+        due = []
+        # Newest first, fill-first keeps the older ones busier anyway.
+        for category_id in sorted(empty, key=occupancy.ranks.__getitem__, reverse=True):
+            if monotonic - empty[category_id] < self.down_delay or self.age(category_id, now) < self.min_lifetime:
+                continue
+            if free - occupancy.capacity < self.scale_down_free:
+                break
+            free -= occupancy.capacity
+            due.append(category_id)
+        return due
+
+    def consolidation_source(self, occupancy, main_category_id, pooled=None):
+        # The lightest extra category, if its rooms fit in the others with
+        # scale_down_free slots to spare once it's gone.
+        if not self.consolidate_below:
+            return None
+        pooled = pooled or {}
+        candidates = [category_id for category_id in occupancy.channels
+                      if category_id != main_category_id and
+                      0 < self.in_use(occupancy, category_id, pooled) <= self.consolidate_below and
+                      self.age(category_id) >= self.min_lifetime]
+        if not candidates:
+            return None
+        source = min(candidates, key=lambda c: (self.in_use(occupancy, c, pooled), -occupancy.ranks[c]))
+        remaining = self.free_slots(occupancy, pooled) - occupancy.free_slots(source) - occupancy.channel_count(source)
+        return source if remaining >= self.scale_down_free else None
+
+
+class AdmissionQueue:
+    # Joiners who found no room and no way to make one, per guild in arrival
+    # order, with when they started waiting. They stay in the join channel
+    # and are seated first as rooms free up; past max_waiting or max_wait
+    # they're shed and counted rather than left to retry.
+
+    def __init__(self, max_waiting=ADMISSION_MAX_WAITING, max_wait=ADMISSION_MAX_WAIT):
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.waiting: Dict[int, Dict[int, float]] = {}
+        self.queued = 0
+        self.admitted = 0
+        self.abandoned = 0
+        self.failed = 0
+        self.shed: Counter = collections.Counter()
+
+    def size(self, guild_id):
+        return len(self.waiting.get(guild_id, ()))
+
+    def contains(self, guild_id, member_id):
+        return member_id in self.waiting.get(guild_id, ())
+
+    def members(self, guild_id):
+        return list(self.waiting.get(guild_id, ()))
+
+    def enqueue(self, guild_id, member_id):
+        waiting = self.waiting.setdefault(guild_id, {})
+        if member_id in waiting:
+            return True
+        if len(waiting) >= self.max_waiting:
+            if not waiting:
+                del self.waiting[guild_id]
+            return False
+        waiting[member_id] = time.monotonic()
+        self.queued += 1
+        return True
+
+    def remove(self, guild_id, member_id) -> Optional[float]:
+        waiting = self.waiting.get(guild_id)
+        if not waiting or member_id not in waiting:
+            return None
+        waited = time.monotonic() - waiting.pop(member_id)
+        if not waiting:
+            del self.waiting[guild_id]
+        return waited
+
+    def overdue(self, guild_id):
+        deadline = time.monotonic() - self.max_wait
+        return [member_id for member_id, since in self.waiting.get(guild_id, {}).items() if since <= deadline]
+
+
+class EventRecorder:
+    # Appends incoming gateway events to a compact JSONL trace for
+    # partybot_replay.py. Only ids are kept, plus message content for !pb
+    # commands; each guild's settings are written the first time it shows up.
+
+    def __init__(self, filename, flush_every=1000):
+        self.file = open(filename, "a", encoding="utf-8")
+        self.flush_every = flush_every
+        self.start = time.monotonic()
+        self.guilds: Set[int] = set()
+        self.records = 0
+
+    def _write(self, record):
+        record["t"] = round(time.monotonic() - self.start, 4)
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.records += 1
+        if self.records % self.flush_every == 0:
+            self.file.flush()
+
+    def _guild(self, guild):
+        if guild.id not in self.guilds:
+            self.guilds.add(guild.id)
+            guild_settings = storage.party_bot_guild_settings.get(guild.id)
+            self._write({"e": "guild", "g": guild.id,
+                         "s": dataclasses.astuple(guild_settings) if guild_settings else None})
+
+    @staticmethod
+    def _channel(channel):
+        return [channel.id, channel.category_id] if channel else None
+
+    def voice(self, member, before, after):
+        self._guild(member.guild)
+        self._write({"e": "voice", "g": member.guild.id, "u": member.id,
+                     "b": self._channel(before.channel), "a": self._channel(after.channel)})
+
+    def message(self, message):
+        self._guild(message.guild)
+        content = message.content if message.content.startswith(CommandRouter.PREFIX) else None
+        self._write({"e": "message", "g": message.guild.id, "u": message.author.id,
+                     "c": message.channel.id, "x": content,
+                     "a": message.author.guild_permissions.administrator,
+                     "r": [role.id for role in message.author.roles if role.id != message.guild.id]})
+
+    def channel_delete(self, channel):
+        self._guild(channel.guild)
+        self._write({"e": "delete", "g": channel.guild.id, "c": channel.id,
+                     "k": channel.category_id, "y": str(channel.type)})
+
+    def close(self):
+        self.file.close()
+
+
+class StackSampler:
+    # Samples one thread's Python stack from a helper thread and counts
+    # collapsed stacks ("outer;inner;leaf count"), the input format of
+    # flamegraph.pl and speedscope.
+
+    def __init__(self, thread_id=None, interval=0.001):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks: Counter = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="partybot-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.stacks[StackSampler.collapse(frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def write_collapsed(self, filename):
+        with open(filename, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@dataclasses.dataclass
+class HandlerTrace:
+    handler: str
+    start: float
+    phases: Dict[str, List[float]] = dataclasses.field(default_factory=dict)
+    accounted: float = 0.0
+    depth: int = 0
+    done: bool = False
+    token: Optional[contextvars.Token] = None
+
+    def enter(self):
+        top = self.depth == 0
+        self.depth += 1
+        return top
+
+    def exit(self, phase, elapsed, top):
+        if self.done:
+            return
+        self.depth = max(0, self.depth - 1)
+        self.add_phase(phase, elapsed, top)
+
+    def add_phase(self, phase, elapsed, top):
+        # For time spent outside the handler's own call stack, like queued
+        # REST calls; leaves the nesting alone.
+        if self.done:
+            return
+        stats = self.phases.setdefault(phase, [0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        # Only outermost phases count against the total, Storage calls
+        # contain their SQLite operations.
+        if top:
+            self.accounted += elapsed
+
+
+class SlowHandlerProfiler:
+    # Opt-in (PARTYBOT_PROFILE_THRESHOLD). Handlers wrapped by metrics.timed
+    # carry a HandlerTrace in a context variable; Storage coroutines, SQLite
+    # operations and scheduled REST calls add their time to it as phases. A
+    # helper thread samples the loop thread's stack into a short ring buffer,
+    # so a handler that went over the threshold gets the stacks from its own
+    # run, and watches a heartbeat from the loop to catch blocking calls.
+    # Reports are JSON lines in a size-rotated file, written by that thread.
+
+    def __init__(self, threshold=PROFILE_THRESHOLD, filename=PROFILE_FILE, max_bytes=PROFILE_MAX_BYTES,
+                 backups=PROFILE_BACKUPS, sample_interval=PROFILE_SAMPLE_INTERVAL,
+                 sample_window=PROFILE_SAMPLE_WINDOW, stall_threshold=LOOP_STALL_THRESHOLD):
+        self.threshold = threshold
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample_interval = sample_interval
+        self.stall_threshold = stall_threshold
+        self.beat_interval = stall_threshold / 4
+        self.samples: Deque[Tuple[float, str]] = collections.deque(maxlen=int(sample_window / sample_interval))
+        self.slow = 0
+        self.stalls = 0
+        self.heartbeat: Optional[float] = None
+        self._trace: contextvars.ContextVar = contextvars.ContextVar("partybot_trace", default=None)
+        self._records: queue.SimpleQueue = queue.SimpleQueue()
+        self._loop_thread_id = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def install(self):
+        # Call from the thread that will run the event loop.
+        for name, function in list(vars(Storage).items()):
+            if inspect.iscoroutinefunction(function):
+                setattr(Storage, name, self.phase("storage." + name.lstrip("_"), function))
+        self._loop_thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="partybot-profiler", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def current(self) -> Optional[HandlerTrace]:
+        trace = self._trace.get()
+        return trace if trace is not None and not trace.done else None
+
+    def begin(self, handler):
+        # Always a fresh trace: tasks a handler starts inherit its context.
+        trace = HandlerTrace(handler, time.perf_counter())
+        trace.token = self._trace.set(trace)
+        return trace
+
+    def finish(self, trace, elapsed):
+        trace.done = True
+        self._trace.reset(trace.token)
+        if elapsed < self.threshold:
+            return
+
+        self.slow += 1
+        stacks = collections.Counter(stack for sampled_at, stack in self.samples if sampled_at >= trace.start)
+        self._records.put({
+            "type": "handler",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "handler": trace.handler,
+            "seconds": round(elapsed, 6),
+            "phases": {phase: {"count": count, "seconds": round(seconds, 6)}
+                       for phase, (count, seconds) in sorted(trace.phases.items(), key=lambda p: -p[1][1])},
+            "unaccounted": round(max(0.0, elapsed - trace.accounted), 6),
+            "samples": sum(stacks.values()),
+            "stacks": stacks.most_common(20),
+        })
+        print(f"Slow handler {trace.handler} took {elapsed:.2f}s, profile written to {self.filename}.")
+
+    def phase(self, name, function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            trace = self.current()
+            if trace is None:
+                return await function(*args, **kwargs)
+            top = trace.enter()
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                trace.exit(name, time.perf_counter() - start, top)
+        return wrapper
+
+    async def heartbeat_loop(self):
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.beat_interval)
+            self.heartbeat = time.perf_counter()
+            metrics.observe("partybot_loop_lag_seconds", "Event loop wake-up delay.",
+                            max(0.0, self.heartbeat - before - self.beat_interval))
+
+    def _run(self):
+        stall: Optional[collections.Counter] = None
+        stalled_since = 0.0
+        while not self._stop.wait(self.sample_interval):
+            now = time.perf_counter()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = sys.intern(StackSampler.collapse(frame)) if frame is not None else None
+            if stack:
+                self.samples.append((now, stack))
+
+            heartbeat = self.heartbeat
+            if heartbeat is None:
+                pass
+            elif now - heartbeat > self.stall_threshold:
+                if stall is None:
+                    stall, stalled_since = collections.Counter(), heartbeat
+                if stack:
+                    stall[stack] += 1
+            elif stall is not None and heartbeat > stalled_since:
+                self.stalls += 1
+                self._records.put({
+                    "type": "stall",
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "seconds": round(heartbeat - stalled_since - self.beat_interval, 6),
+                    "samples": sum(stall.values()),
+                    "stacks": stall.most_common(20),
+                })
+                stall = None
+
+            while not self._records.empty():
+                self._write(self._records.get())
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        try:
+            if os.path.exists(self.filename) and os.path.getsize(self.filename) + len(line) > self.max_bytes:
+                self._rotate()
+            with open(self.filename, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"Writing the slow handler profile failed: {e!r}")
+
+    def _rotate(self):
+        if not self.backups:
+            os.remove(self.filename)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.filename}.{i}"):
+                os.replace(f"{self.filename}.{i}", f"{self.filename}.{i + 1}")
+        os.replace(self.filename, f"{self.filename}.1")
+
+
+def approximate_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set)):
+        size += sum(sys.getsizeof(item) for item in value)
+    elif hasattr(value, '__slots__'):
+        size += sum(sys.getsizeof(getattr(value, name, None)) for name in value.__slots__)
+    elif hasattr(value, '__dict__'):
+        size += sys.getsizeof(value.__dict__) + sum(sys.getsizeof(item) for item in vars(value).values())
+    return size
+
+
+class BoundedCache(collections.abc.MutableMapping):
+    # A dict with an optional size limit, evicting the least recently used
+    # entry, and optional expiry. None values ("known missing") can get a
+    # shorter lifetime than real ones. 0 means no limit / no expiry.
+
+    def __init__(self, name, max_size=0, ttl=0, negative_ttl=0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data: "collections.OrderedDict[Hashable, Tuple[Any, float]]" = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # Called with (key, value) for entries dropped by the size limit or
+        # expiry, not for explicit deletes.
+        self.on_evict: Optional[Callable[[Hashable, Any], None]] = None
+
+    def _expires(self, value):
+        ttl = self.negative_ttl if value is None and self.negative_ttl else self.ttl
+        return time.monotonic() + ttl if ttl else 0
+
+    def __getitem__(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            raise KeyError(key)
+        value, expires = entry
+        if expires and expires <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+            raise KeyError(key)
+        if self.max_size:
+            self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = (value, self._expires(value))
+        if self.max_size:
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                evicted, (evicted_value, _) = self._data.popitem(last=False)
+                self.evictions += 1
+                if self.on_evict:
+                    self.on_evict(evicted, evicted_value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def discard_if(self, key, value):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] == value:
+            del self._data[key]
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and not (entry[1] and entry[1] <= time.monotonic())
+
+    def __iter__(self):
+        # A snapshot, callers delete while they iterate.
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def items(self):
+        now = time.monotonic()
+        return [(key, value) for key, (value, expires) in self._data.items() if not expires or expires > now]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def clear(self):
+        self._data.clear()
+
+    def memory_bytes(self, sample=64):
+        # The table itself plus the average of a sample of entries, scaled up.
+        size = sys.getsizeof(self._data)
+        if self._data:
+            entries = list(itertools.islice(self._data.items(), sample))
+            per_entry = sum(approximate_size(key) + approximate_size(entry) + approximate_size(entry[0])
+                            for key, entry in entries) / len(entries)
+            size += int(per_entry * len(self._data))
+        return size
+
+
+def storage_write(function):
+    # Counts Storage writes that are part way through: between touching the
+    # caches and their statement reaching SQLite or the write-behind queue,
+    # the two disagree, so a state snapshot waits for none to be in flight.
+    @functools.wraps(function)
+    async def wrapper(self, *args, **kwargs):
+        self.writes_in_flight += 1
+        try:
+            return await function(self, *args, **kwargs)
+        finally:
+            self.writes_in_flight -= 1
+    return wrapper
 
 
 class Storage:
@@ -75,7 +1781,7 @@ class Storage:
 
     PARTYBOT_INSERT_QUERY = """
 INSERT INTO partybot VALUES (
-?, ?, ?, ?, ?, ?, ?, ?
+?, ?, ?, ?, ?, ?, ?, ?, ?, ?
 ) ON CONFLICT(guild_id)
 DO UPDATE SET
 join_here_channel_id=excluded.join_here_channel_id,
@@ -84,7 +1790,9 @@ main_category_id=excluded.main_category_id,
 moderator_role_id=excluded.moderator_role_id,
 manage_role_id=excluded.manage_role_id,
 dynamic_category_creation=excluded.dynamic_category_creation,
-max_categories=excluded.max_categories;
+max_categories=excluded.max_categories,
+pool_size=excluded.pool_size,
+category_policy=excluded.category_policy;
 """
 
     CREATE_PARTYBOT_TABLE_QUERY = """
@@ -96,8 +1804,18 @@ CREATE TABLE IF NOT EXISTS partybot(
     moderator_role_id INTEGER,
     manage_role_id INTEGER,
     dynamic_category_creation BOOL,
-    max_categories INTEGER
+    max_categories INTEGER,
+    pool_size INTEGER DEFAULT 0,
+    category_policy TEXT DEFAULT 'fill_first'
 )
+"""
+
+    ADD_POOL_SIZE_COLUMN_QUERY = """
+ALTER TABLE partybot ADD COLUMN pool_size INTEGER DEFAULT 0;
+"""
+
+    ADD_CATEGORY_POLICY_COLUMN_QUERY = """
+ALTER TABLE partybot ADD COLUMN category_policy TEXT DEFAULT 'fill_first';
 """
 
     CREATE_CATEGORIES_TABLE_QUERY = """
@@ -110,16 +1828,144 @@ CREATE TABLE IF NOT EXISTS partybot_categories(
     CREATE_OWNERS_TABLE_QUERY = """
 CREATE TABLE IF NOT EXISTS partybot_owners(
     channel_id INTEGER PRIMARY KEY,
-    user_id INTEGER
+    user_id INTEGER,
+    guild_id INTEGER
+)
+"""
+
+    ADD_OWNER_GUILD_COLUMN_QUERY = """
+ALTER TABLE partybot_owners ADD COLUMN guild_id INTEGER;
+"""
+
+    CREATE_SCHEMA_VERSION_TABLE_QUERY = """
+CREATE TABLE IF NOT EXISTS partybot_schema_version(
+    version INTEGER PRIMARY KEY,
+    description TEXT,
+    applied_at REAL
+)
+"""
+
+    # A user owns one room at a time; keep the newest row for anyone who
+    # ended up with more before this was enforced.
+    DEDUPLICATE_OWNERS_QUERY = """
+DELETE FROM partybot_owners WHERE user_id IS NOT NULL AND rowid NOT IN (
+    SELECT MAX(rowid) FROM partybot_owners WHERE user_id IS NOT NULL GROUP BY user_id
+);
+"""
+
+    CREATE_OWNER_USER_INDEX_QUERY = """
+CREATE UNIQUE INDEX IF NOT EXISTS partybot_owners_user_id ON partybot_owners(user_id);
+"""
+
+    CREATE_OWNER_GUILD_INDEX_QUERY = """
+CREATE INDEX IF NOT EXISTS partybot_owners_guild_id ON partybot_owners(guild_id);
+"""
+
+    CREATE_CATEGORY_GUILD_INDEX_QUERY = """
+CREATE INDEX IF NOT EXISTS partybot_categories_guild_id ON partybot_categories(guild_id);
+"""
+
+    # Bumped by triggers on every write, per guild (owners without one count
+    # as guild 0), so a state snapshot can tell whether the rows it was taken
+    # from changed since.
+    CREATE_GENERATION_TABLE_QUERY = """
+CREATE TABLE IF NOT EXISTS partybot_generation(
+    guild_id INTEGER PRIMARY KEY,
+    generation INTEGER NOT NULL
 )
 """
 
+    # No INSERT OR IGNORE here: in a trigger the firing statement's OR REPLACE
+    # takes over, which would reset the counter on every owner change.
+    CREATE_GENERATION_TRIGGER_QUERY = """
+CREATE TRIGGER IF NOT EXISTS {table}_{name}_generation AFTER {event} ON {table} BEGIN
+    INSERT INTO partybot_generation SELECT coalesce({row}.guild_id, 0), 0 WHERE NOT EXISTS (
+        SELECT 1 FROM partybot_generation WHERE guild_id = coalesce({row}.guild_id, 0));
+    UPDATE partybot_generation SET generation = generation + 1 WHERE guild_id = coalesce({row}.guild_id, 0);
+END
+"""
+
+    PARTYBOT_SELECT_GENERATIONS_QUERY = """
+SELECT guild_id, generation FROM partybot_generation
+"""
+
+    PRAGMAS = (
+        # Other shard processes may hold the write lock for a moment.
+        "PRAGMA busy_timeout=10000",
+        # Only takes effect on a new file, before WAL writes the header;
+        # DatabaseMaintenance converts older files.
+        "PRAGMA auto_vacuum=INCREMENTAL",
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8192",
+        # So the row INSERT OR REPLACE pushes out through the unique user_id
+        # index fires the delete trigger and bumps that guild's generation.
+        "PRAGMA recursive_triggers=ON",
+    )
+
+    # Schema history, applied in order. A database's version is the highest
+    # row in partybot_schema_version; files from before versioning start at 0,
+    # and the column steps skip whatever the old ad-hoc upgrades already did.
+    MIGRATIONS: List[Tuple[str, Callable[[sqlite3.Cursor], None]]] = [
+        ("create tables", lambda cursor: (
+            cursor.execute(Storage.CREATE_PARTYBOT_TABLE_QUERY),
+            cursor.execute(Storage.CREATE_CATEGORIES_TABLE_QUERY),
+            cursor.execute(Storage.CREATE_OWNERS_TABLE_QUERY))),
+        ("add partybot.pool_size", lambda cursor: Storage._add_column(
+            cursor, "partybot", "pool_size", Storage.ADD_POOL_SIZE_COLUMN_QUERY)),
+        ("add partybot.category_policy", lambda cursor: Storage._add_column(
+            cursor, "partybot", "category_policy", Storage.ADD_CATEGORY_POLICY_COLUMN_QUERY)),
+        ("add partybot_owners.guild_id", lambda cursor: Storage._add_column(
+            cursor, "partybot_owners", "guild_id", Storage.ADD_OWNER_GUILD_COLUMN_QUERY)),
+        ("index owners by user and guild, categories by guild", lambda cursor: (
+            cursor.execute(Storage.DEDUPLICATE_OWNERS_QUERY),
+            cursor.execute(Storage.CREATE_OWNER_USER_INDEX_QUERY),
+            cursor.execute(Storage.CREATE_OWNER_GUILD_INDEX_QUERY),
+            cursor.execute(Storage.CREATE_CATEGORY_GUILD_INDEX_QUERY))),
+        ("count writes per guild", lambda cursor: Storage._add_generation_triggers(cursor)),
+        ("count replaced owner rows", lambda cursor: Storage._add_generation_triggers(cursor)),
+    ]
+    SCHEMA_VERSION = len(MIGRATIONS)
+
+    @staticmethod
+    def _add_generation_triggers(cursor):
+        cursor.execute(Storage.CREATE_GENERATION_TABLE_QUERY)
+        for table in ("partybot", "partybot_categories", "partybot_owners"):
+            for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+                cursor.execute(f"DROP TRIGGER IF EXISTS {table}_{event.lower()}_generation")
+                cursor.execute(Storage.CREATE_GENERATION_TRIGGER_QUERY.format(
+                    table=table, name=event.lower(), event=event, row=row))
+
+    @staticmethod
+    def _add_column(cursor, table, column, query):
+        columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+        if column not in columns:
+            cursor.execute(query)
+
+    @staticmethod
+    def migrate(connection, cursor):
+        # BEGIN IMMEDIATE takes the write lock before the version is read, so
+        # shard workers starting together upgrade the file exactly once.
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(Storage.CREATE_SCHEMA_VERSION_TABLE_QUERY)
+            version = cursor.execute("SELECT MAX(version) FROM partybot_schema_version").fetchone()[0] or 0
+            for number, (description, migration) in enumerate(Storage.MIGRATIONS[version:], version + 1):
+                migration(cursor)
+                cursor.execute("INSERT INTO partybot_schema_version VALUES (?, ?, ?)",
+                               (number, description, time.time()))
+                print(f"Storage schema upgraded to version {number}: {description}.")
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        return version
+
     PARTYBOT_INSERT_OWNER_QUERY = """
-INSERT INTO partybot_owners VALUES (
-?, ?
-) ON CONFLICT(channel_id)
-DO UPDATE SET
-user_id=excluded.user_id;
+INSERT OR REPLACE INTO partybot_owners(channel_id, user_id, guild_id) VALUES (
+?, ?, ?
+);
 """
 
     PARTYBOT_DELETE_OWNER_CHANNEL_QUERY = """
@@ -134,7 +1980,7 @@ SELECT channel_id FROM partybot_owners WHERE user_id=?;
 """
 
     PARTYBOT_DELETE_OWNERS_QUERY = """
-DELETE FROM partybot_owners;
+DELETE FROM partybot_owners WHERE guild_id = ?;
 """
 
     PARTYBOT_SELECT_CATEGORIES_QUERY = """
@@ -153,62 +1999,306 @@ DELETE FROM partybot_categories WHERE category_id=?;
 DELETE FROM partybot_categories WHERE guild_id=?;
 """
 
-    def __init__(self, filename):
-        self.connection = sqlite3.connect(filename, check_same_thread=False)
-        self.party_bot_guild_settings: Dict[int, PartyBotGuildSettings] = {}
-        self.party_bot_channels: Dict[int, int] = {}
-        self.party_bot_owners: Dict[int, int] = {}
-        self.categories = {}
+    PARTYBOT_SELECT_ALL_QUERY = """
+SELECT * FROM partybot;
+"""
 
-        with contextlib.closing(self.connection.cursor()) as cursor:
-            cursor.execute(Storage.CREATE_PARTYBOT_TABLE_QUERY)
-            cursor.execute(Storage.CREATE_CATEGORIES_TABLE_QUERY)
-            cursor.execute(Storage.CREATE_OWNERS_TABLE_QUERY)
-            self.connection.commit()
+    PARTYBOT_SELECT_ALL_OWNERS_QUERY = """
+SELECT channel_id, user_id, guild_id FROM partybot_owners;
+"""
 
-    async def _fetchone_async(self, query, params):
-        def _f():
-            with contextlib.closing(self.connection.cursor()) as cursor:
-                return cursor.execute(query, params).fetchone()
+    PARTYBOT_SELECT_GUILD_OWNERS_QUERY = """
+SELECT channel_id, user_id FROM partybot_owners WHERE guild_id = ?;
+"""
+
+    PARTYBOT_SELECT_UNASSIGNED_OWNERS_QUERY = """
+SELECT channel_id FROM partybot_owners WHERE guild_id IS NULL;
+"""
+
+    PARTYBOT_ASSIGN_OWNER_GUILD_QUERY = """
+UPDATE partybot_owners SET guild_id = ? WHERE channel_id = ?;
+"""
+
+    PARTYBOT_SELECT_COMMAND_CHANNELS_QUERY = """
+SELECT guild_id, command_channel_id FROM partybot WHERE command_channel_id IS NOT NULL;
+"""
 
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None, _f)
+    PARTYBOT_SELECT_ALL_CATEGORIES_QUERY = """
+SELECT category_id, guild_id FROM partybot_categories;
+"""
+
+    def __init__(self, filename, write_behind=False,
+                 flush_interval=WRITE_BEHIND_INTERVAL, flush_max_ops=WRITE_BEHIND_MAX_OPS,
+                 guild_filter: Optional[Callable[[int], bool]] = None,
+                 cache_max_guilds=CACHE_MAX_GUILDS, cache_max_owners=CACHE_MAX_OWNERS,
+                 cache_ttl=CACHE_TTL, negative_cache_ttl=NEGATIVE_CACHE_TTL):
+        self.executor = DatabaseExecutor(filename, pragmas=Storage.PRAGMAS)
+        # Set when several shard processes share the file: each one only loads
+        # the guilds it owns and only ever writes rows for them.
+        self.guild_filter = guild_filter
+        self.bounded = bool(cache_max_guilds or cache_max_owners or cache_ttl)
+        self.party_bot_guild_settings: MutableMapping[int, Optional[PartyBotGuildSettings]] = BoundedCache(
+            "guild_settings", cache_max_guilds, cache_ttl, negative_cache_ttl)
+        self.party_bot_channels: MutableMapping[int, int] = BoundedCache("channel_owners", cache_max_owners, cache_ttl)
+        self.party_bot_owners: MutableMapping[int, int] = BoundedCache("owner_channels", cache_max_owners, cache_ttl)
+        # Both directions of an owner row leave the cache together, so a hit
+        # in either one is never stale and a miss reads through to SQLite.
+        self.party_bot_channels.on_evict = \
+            lambda channel_id, owner_id: self.party_bot_owners.discard_if(owner_id, channel_id)
+        self.party_bot_owners.on_evict = \
+            lambda owner_id, channel_id: self.party_bot_channels.discard_if(channel_id, owner_id)
+        # channel_id -> guild_id for owned rooms, so owners can be cleared per guild.
+        self.owner_guilds: MutableMapping[int, int] = BoundedCache("owner_guilds", cache_max_owners, cache_ttl)
+        self.categories: MutableMapping[int, List[int]] = BoundedCache("categories", cache_max_guilds, cache_ttl)
+        # The command channel index below stays complete either way; it's
+        # two ints per guild and lets on_message drop chat without a lookup.
+        self.index_loaded = False
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.writes_in_flight = 0
+        # Set by load_all(); from then on a cache miss is authoritative and
+        # the read path never goes to SQLite.
+        self.loaded = False
+        # guild_id -> command channel id and back, so on_message can drop
+        # ordinary chat without looking at guild settings.
+        self.command_channels: Dict[int, int] = {}
+        self.command_channel_guilds: Dict[int, int] = {}
+
+        # Write-behind mode: the dicts above are the source of truth and writes
+        # are queued here, then committed as one transaction by _write_behind_loop.
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_max_ops = flush_max_ops
+        self.flush_count = 0
+        self.flushed_writes = 0
+        self._pending_writes: List[Tuple[str, tuple]] = []
+        self._writes_pending: Optional[asyncio.Event] = None
+        self._writes_full: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+        self.executor.call(Storage.migrate)
+
+    async def _fetchone_async(self, query, params):
+        if self._pending_writes:
+            await self.flush()
+        return await self.executor.fetchone(query, params)
 
     async def _fetchall_async(self, query, params):
-        def _f():
-            with contextlib.closing(self.connection.cursor()) as cursor:
-                return cursor.execute(query, params).fetchall()
+        if self._pending_writes:
+            await self.flush()
+        return await self.executor.fetchall(query, params)
 
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None, _f)
+    async def _fetchone_many_async(self, query, params_list):
+        if self._pending_writes:
+            await self.flush()
+        return await self.executor.fetchone_many(query, params_list)
 
     async def _execute_and_commit_async(self, query, params):
-        def _f():
-            with contextlib.closing(self.connection.cursor()) as cursor:
-                cursor.execute(query, params)
-                self.connection.commit()
+        if self.write_behind:
+            self._queue_write(query, params)
+            return
+        await self.executor.execute(query, params)
+
+    def _queue_write(self, query, params):
+        if self._flush_task is None:
+            self._writes_pending = asyncio.Event()
+            self._writes_full = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._flush_task = asyncio.ensure_future(self._write_behind_loop())
+
+        self._pending_writes.append((query, params))
+        self._writes_pending.set()
+        if len(self._pending_writes) >= self.flush_max_ops:
+            self._writes_full.set()
+
+    async def _write_behind_loop(self):
+        while True:
+            await self._writes_pending.wait()
+            if len(self._pending_writes) < self.flush_max_ops:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._writes_full.wait(), self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Storage write-behind flush failed: {e!r}")
+
+    async def flush(self):
+        if self._flush_lock is None:
+            return 0
+
+        async with self._flush_lock:
+            writes, self._pending_writes = self._pending_writes, []
+            self._writes_pending.clear()
+            self._writes_full.clear()
+            if not writes:
+                return 0
+
+            await self.executor.execute_batch(writes)
+
+            self.flush_count += 1
+            self.flushed_writes += len(writes)
+            return len(writes)
+
+    def flush_sync(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+
+        writes, self._pending_writes = self._pending_writes, []
+        if writes:
+            self.executor.execute_batch_sync(writes)
+            self.flush_count += 1
+            self.flushed_writes += len(writes)
+            print(f"Storage flushed {len(writes)} writes on shutdown.")
+
+    def close(self):
+        self.flush_sync()
+        self.executor.close()
+
+    def read_generation(self, connection, cursor):
+        # Run on the executor. Counters only grow, so the sum over this
+        # process's guilds only stays the same if none of their rows changed.
+        rows = cursor.execute(Storage.PARTYBOT_SELECT_GENERATIONS_QUERY).fetchall()
+        return sum(generation for guild_id, generation in rows
+                   if not self.guild_filter or not guild_id or self.guild_filter(guild_id))
+
+    def snapshot_state(self):
+        # Plain copies of the caches, taken in one go on the loop. They only
+        # match the database with no writes in flight or queued; see
+        # save_state_snapshot for how the generation is pinned around them.
+        owner_guilds = dict(self.owner_guilds.items())
+        return (
+            [dataclasses.astuple(guild_settings) for guild_settings in self.party_bot_guild_settings.values()
+             if guild_settings is not None],
+            [(guild_id, list(category_ids)) for guild_id, category_ids in self.categories.items()
+             if category_ids is not None],
+            [(channel_id, user_id, owner_guilds.get(channel_id))
+             for channel_id, user_id in self.party_bot_channels.items() if user_id is not None],
+            list(self.command_channels.items()),
+        )
+
+    def restore(self, settings_rows, category_rows, owner_rows, command_channel_rows, complete):
+        for row in settings_rows:
+            self.party_bot_guild_settings[row[0]] = PartyBotGuildSettings(*row)
+        for guild_id, category_ids in category_rows:
+            self.categories[guild_id] = category_ids
+        for channel_id, user_id, guild_id in owner_rows:
+            self.party_bot_channels[channel_id] = user_id
+            self.party_bot_owners[user_id] = channel_id
+            if guild_id is not None:
+                self.owner_guilds[channel_id] = guild_id
+
+        self.command_channels.clear()
+        self.command_channel_guilds.clear()
+        for guild_id, channel_id in command_channel_rows:
+            self.command_channels[guild_id] = channel_id
+            self.command_channel_guilds[channel_id] = guild_id
+        self.index_loaded = True
+        self.loaded = complete and not self.bounded
+
+    def load_all(self):
+        if self.bounded:
+            self.load_command_channels()
+            return
+
+        start = time.perf_counter()
+
+        def _f(connection, cursor):
+            return (
+                cursor.execute(Storage.PARTYBOT_SELECT_ALL_QUERY).fetchall(),
+                cursor.execute(Storage.PARTYBOT_SELECT_ALL_OWNERS_QUERY).fetchall(),
+                cursor.execute(Storage.PARTYBOT_SELECT_ALL_CATEGORIES_QUERY).fetchall()
+            )
 
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None, _f)
+        settings_rows, owner_rows, category_rows = self.executor.call(_f)
+        if self.guild_filter:
+            settings_rows = [row for row in settings_rows if self.guild_filter(row[0])]
+            # Owners written before rows carried a guild id are kept everywhere.
+            owner_rows = [row for row in owner_rows if row[2] is None or self.guild_filter(row[2])]
+            category_rows = [row for row in category_rows if self.guild_filter(row[1])]
+
+        self.party_bot_guild_settings.clear()
+        for row in settings_rows:
+            self.party_bot_guild_settings[row[0]] = PartyBotGuildSettings(*row)
+        for guild_settings in self.party_bot_guild_settings.values():
+            self._index_command_channel(guild_settings)
+
+        self.party_bot_channels.clear()
+        self.party_bot_owners.clear()
+        self.owner_guilds.clear()
+        for channel_id, user_id, guild_id in owner_rows:
+            self.party_bot_channels[channel_id] = user_id
+            self.party_bot_owners[user_id] = channel_id
+            if guild_id is not None:
+                self.owner_guilds[channel_id] = guild_id
+
+        self.categories.clear()
+        for category_id, guild_id in category_rows:
+            self.categories.setdefault(guild_id, []).append(category_id)
+        for guild_id, guild_settings in self.party_bot_guild_settings.items():
+            self.categories.setdefault(guild_id, []).append(guild_settings.main_category_id)
+
+        self.loaded = True
+        self.index_loaded = True
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"Storage loaded {len(settings_rows)} guild settings, {len(owner_rows)} owners and "
+              f"{len(category_rows)} categories in {elapsed:.1f}ms.")
+
+    def load_command_channels(self):
+        start = time.perf_counter()
+        rows = self.executor.call(
+            lambda connection, cursor: cursor.execute(Storage.PARTYBOT_SELECT_COMMAND_CHANNELS_QUERY).fetchall())
+        if self.guild_filter:
+            rows = [row for row in rows if self.guild_filter(row[0])]
+
+        self.command_channels.clear()
+        self.command_channel_guilds.clear()
+        for guild_id, channel_id in rows:
+            self.command_channels[guild_id] = channel_id
+            self.command_channel_guilds[channel_id] = guild_id
+        self.index_loaded = True
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"Storage loaded {len(rows)} command channels in {elapsed:.1f}ms, other rows are read on demand.")
+
+    def caches(self) -> List[BoundedCache]:
+        return [self.party_bot_guild_settings, self.party_bot_channels, self.party_bot_owners,
+                self.owner_guilds, self.categories]
 
     async def get_party_bot_guild_settings(self, guild_id: int) -> Optional[PartyBotGuildSettings]:
+        if self.loaded:
+            self.cache_hits += 1
+            return self.party_bot_guild_settings.get(guild_id)
+
         guild_settings = self.party_bot_guild_settings.get(guild_id, -1)
-        if guild_settings == -1:
+        if guild_settings != -1:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
             result = await self._fetchone_async(Storage.PARTYBOT_SELECT_QUERY, (guild_id,))
             if result:
-                guild_settings = PartyBotGuildSettings(
-                    result[0], result[1], result[2], result[3], result[4], result[5], result[6], result[7]
-                )
+                guild_settings = PartyBotGuildSettings(*result)
                 self.party_bot_guild_settings[guild_id] = guild_settings
+                self._index_command_channel(guild_settings)
             else:
                 self.party_bot_guild_settings[guild_id] = None
         return guild_settings if guild_settings != -1 else None
 
+    def _index_command_channel(self, guild_settings: PartyBotGuildSettings):
+        previous = self.command_channels.pop(guild_settings.guild_id, None)
+        if previous is not None:
+            self.command_channel_guilds.pop(previous, None)
+        if guild_settings.command_channel_id:
+            self.command_channels[guild_settings.guild_id] = guild_settings.command_channel_id
+            self.command_channel_guilds[guild_settings.command_channel_id] = guild_settings.guild_id
+
+    def may_be_command_channel(self, channel_id):
+        # Until the index is loaded any channel could be one.
+        return not self.index_loaded or channel_id in self.command_channel_guilds
+
+    @storage_write
     async def set_party_bot_guild_settings(self, guild_settings: PartyBotGuildSettings):
         self.party_bot_guild_settings[guild_settings.guild_id] = guild_settings
+        self._index_command_channel(guild_settings)
         await self._execute_and_commit_async(
             Storage.PARTYBOT_INSERT_QUERY, (
                 guild_settings.guild_id,
@@ -218,46 +2308,59 @@ DELETE FROM partybot_categories WHERE guild_id=?;
                 guild_settings.moderator_role_id,
                 guild_settings.manage_role_id,
                 guild_settings.dynamic_category_creation,
-                guild_settings.max_categories
+                guild_settings.max_categories,
+                guild_settings.pool_size,
+                guild_settings.category_policy
             )
         )
 
     async def get_categories(self, guild_id):
         categories = self.categories.get(guild_id)
-        if not categories:
-            result = await self._fetchall_async(
-                Storage.PARTYBOT_SELECT_CATEGORIES_QUERY,
-                (guild_id,)
-            )
+        if categories:
+            self.cache_hits += 1
+        else:
+            if self.loaded:
+                self.cache_hits += 1
+                result = []
+            else:
+                self.cache_misses += 1
+                result = await self._fetchall_async(
+                    Storage.PARTYBOT_SELECT_CATEGORIES_QUERY,
+                    (guild_id,)
+                )
+                result = [a[0] for a in result]
 
-            result = [a[0] for a in result]
             result.append(
-                self.party_bot_guild_settings[guild_id].main_category_id)
+                (await self.get_party_bot_guild_settings(guild_id)).main_category_id)
             self.categories[guild_id] = result
         return self.categories[guild_id]
 
+    @storage_write
     async def add_category(self, guild_id, category_id):
-        if not self.categories.get(guild_id):
-            await self.get_categories(guild_id)
+        # Work on the list get_categories returns; with a bounded cache the
+        # entry may be evicted while the write is waiting.
+        categories = await self.get_categories(guild_id)
+        categories.append(category_id)
 
         await self._execute_and_commit_async(
             Storage.PARTYBOT_INSERT_CATEGORIES_QUERY,
             (category_id, guild_id)
         )
 
-        self.categories[guild_id].append(category_id)
-
+    @storage_write
     async def remove_category(self, guild_id, category_id):
-        if not self.categories.get(guild_id):
-            await self.get_categories(guild_id)
+        # The channel delete event and the handler that deleted the category
+        # can both get here, so only the first one touches the list.
+        categories = await self.get_categories(guild_id)
+        if category_id in categories:
+            categories.remove(category_id)
 
         await self._execute_and_commit_async(
             Storage.PARTYBOT_DELETE_CATEGORIES_QUERY,
             (category_id,)
         )
 
-        self.categories[guild_id].remove(category_id)
-
+    @storage_write
     async def delete_all_additional_categories(self, guild_id):
         await self._execute_and_commit_async(
             Storage.PARTYBOT_DELETE_ALL_CATEGORIES_QUERY,
@@ -269,17 +2372,31 @@ DELETE FROM partybot_categories WHERE guild_id=?;
         except:
             pass
 
-    async def delete_all_owners(self):
+    @storage_write
+    async def delete_all_owners(self, guild_id):
         await self._execute_and_commit_async(
-            Storage.PARTYBOT_DELETE_OWNERS_QUERY, ()
+            Storage.PARTYBOT_DELETE_OWNERS_QUERY, (guild_id,)
         )
 
-        self.party_bot_channels = {}
-        self.party_bot_owners = {}
+        if not self.loaded:
+            # Lazily fetched entries don't know their guild, start over.
+            self.party_bot_channels.clear()
+            self.party_bot_owners.clear()
+            self.owner_guilds.clear()
+            return
+
+        for channel_id in [c for c, g in self.owner_guilds.items() if g == guild_id]:
+            owner_id = self.party_bot_channels.pop(channel_id, None)
+            if self.party_bot_owners.get(owner_id) == channel_id:
+                del self.party_bot_owners[owner_id]
+            del self.owner_guilds[channel_id]
 
     async def get_channel_owner(self, channel_id):
         owner_id = self.party_bot_channels.get(channel_id, -1)
-        if owner_id == -1:
+        if owner_id != -1 or self.loaded:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
             result = await self._fetchone_async(
                 Storage.PARTYBOT_SELECT_CHANNEL_OWNER_QUERY,
                 (channel_id,)
@@ -292,7 +2409,10 @@ DELETE FROM partybot_categories WHERE guild_id=?;
 
     async def get_owner_channel(self, user_id):
         channel_id = self.party_bot_owners.get(user_id, -1)
-        if channel_id == -1:
+        if channel_id != -1 or self.loaded:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
             result = await self._fetchone_async(
                 Storage.PARTYBOT_SELECT_OWNER_CHANNEL_QUERY,
                 (user_id,)
@@ -303,10 +2423,35 @@ DELETE FROM partybot_categories WHERE guild_id=?;
                 self.party_bot_owners[user_id] = channel_id
         return channel_id if channel_id != -1 else None
 
-    async def set_channel_owner(self, channel_id, owner_id):
+    async def get_channel_owners(self, channel_ids):
+        owners = {}
+        missing = []
+        for channel_id in channel_ids:
+            owner_id = self.party_bot_channels.get(channel_id)
+            if owner_id is None:
+                missing.append(channel_id)
+            else:
+                owners[channel_id] = owner_id
+
+        self.cache_hits += len(owners) + (len(missing) if self.loaded else 0)
+        if missing and not self.loaded:
+            self.cache_misses += len(missing)
+            results = await self._fetchone_many_async(
+                Storage.PARTYBOT_SELECT_CHANNEL_OWNER_QUERY,
+                [(channel_id,) for channel_id in missing]
+            )
+            for channel_id, result in zip(missing, results):
+                if result:
+                    owners[channel_id] = result[0]
+                    self.party_bot_channels[channel_id] = result[0]
+                    self.party_bot_owners[result[0]] = channel_id
+        return owners
+
+    @storage_write
+    async def set_channel_owner(self, guild_id, channel_id, owner_id):
         await self._execute_and_commit_async(
             Storage.PARTYBOT_INSERT_OWNER_QUERY,
-            (channel_id, owner_id)
+            (channel_id, owner_id, guild_id)
         )
 
         try:
@@ -315,15 +2460,70 @@ DELETE FROM partybot_categories WHERE guild_id=?;
         except:
             pass
 
+        # Owning a new room gives up the old one, the unique index on
+        # user_id did the same to the row.
+        previous_channel = self.party_bot_owners.get(owner_id)
+        if previous_channel is not None and previous_channel != channel_id:
+            self.party_bot_channels.pop(previous_channel, None)
+            self.owner_guilds.pop(previous_channel, None)
+
         self.party_bot_channels[channel_id] = owner_id
         self.party_bot_owners[owner_id] = channel_id
+        self.owner_guilds[channel_id] = guild_id
+
+    async def _execute_batch_async(self, writes):
+        # One transaction for the whole list, or queued behind the others in
+        # write-behind mode, where a flush is one transaction anyway.
+        if self.write_behind:
+            for query, params in writes:
+                self._queue_write(query, params)
+            return
+        await self.executor.execute_batch(writes)
+
+    async def get_guild_owners(self, guild_id) -> Dict[int, int]:
+        # Straight from the database: the reconciliation sweep wants the rows
+        # that are there, not what this process has cached.
+        return dict(await self._fetchall_async(Storage.PARTYBOT_SELECT_GUILD_OWNERS_QUERY, (guild_id,)))
+
+    async def get_unassigned_owner_channels(self) -> List[int]:
+        return [row[0] for row in await self._fetchall_async(Storage.PARTYBOT_SELECT_UNASSIGNED_OWNERS_QUERY, ())]
+
+    @storage_write
+    async def assign_owner_guilds(self, channel_guilds: Dict[int, int]):
+        await self._execute_batch_async([
+            (Storage.PARTYBOT_ASSIGN_OWNER_GUILD_QUERY, (guild_id, channel_id))
+            for channel_id, guild_id in channel_guilds.items()
+        ])
+        for channel_id, guild_id in channel_guilds.items():
+            if channel_id in self.party_bot_channels:
+                self.owner_guilds[channel_id] = guild_id
+
+    @storage_write
+    async def delete_orphans(self, guild_id, channel_ids, category_ids):
+        writes = [(Storage.PARTYBOT_DELETE_OWNER_CHANNEL_QUERY, (channel_id,)) for channel_id in channel_ids]
+        writes += [(Storage.PARTYBOT_DELETE_CATEGORIES_QUERY, (category_id,)) for category_id in category_ids]
+        if not writes:
+            return
+        await self._execute_batch_async(writes)
+
+        for channel_id in channel_ids:
+            self.owner_guilds.pop(channel_id, None)
+            owner_id = self.party_bot_channels.pop(channel_id, None)
+            if owner_id is not None and self.party_bot_owners.get(owner_id) == channel_id:
+                del self.party_bot_owners[owner_id]
+
+        categories = self.categories.get(guild_id)
+        if categories:
+            categories[:] = [c for c in categories if c not in category_ids]
 
+    @storage_write
     async def delete_channel(self, channel_id):
         await self._execute_and_commit_async(
             Storage.PARTYBOT_DELETE_OWNER_CHANNEL_QUERY,
             (channel_id,)
         )
 
+        self.owner_guilds.pop(channel_id, None)
         try:
             owner_id = self.party_bot_channels[channel_id]
             del self.party_bot_owners[owner_id]
@@ -332,15 +2532,461 @@ DELETE FROM partybot_categories WHERE guild_id=?;
             pass
 
 
+class DatabaseMaintenance:
+    # WAL checkpoints, incremental vacuum, ANALYZE and online backups on a
+    # second connection and thread, so none of it queues in front of the
+    # handlers' statements. WAL lets it read while Storage writes; the steps
+    # that need the write lock are cut small with a pause between them.
+
+    def __init__(self, filename, backup_directory=BACKUP_DIRECTORY, keep_backups=BACKUP_KEEP,
+                 step_pages=MAINTENANCE_STEP_PAGES, step_pause=MAINTENANCE_STEP_PAUSE,
+                 online_vacuum_max_bytes=MAINTENANCE_ONLINE_VACUUM_MAX_BYTES):
+        self.filename = filename
+        self.online_vacuum_max_bytes = online_vacuum_max_bytes
+        self.backup_directory = backup_directory
+        self.keep_backups = keep_backups
+        self.step_pages = step_pages
+        self.step_pause = step_pause
+        self.executor = DatabaseExecutor(filename, pragmas=Storage.PRAGMAS, name="partybot-db-maintenance")
+        self.runs = 0
+        self.backups = 0
+        self.last_run: Optional[float] = None
+        self.last_backup: Optional[float] = None
+        self.page_count = 0
+        self.freelist_count = 0
+        self.page_size = 0
+        self._last_day = None
+
+    async def _pragma(self, name):
+        return (await self.executor.run(
+            lambda connection, cursor: cursor.execute(f"PRAGMA {name}").fetchone(), name))[0]
+
+    async def refresh_stats(self):
+        self.page_size = await self._pragma("page_size")
+        self.page_count = await self._pragma("page_count")
+        self.freelist_count = await self._pragma("freelist_count")
+
+    async def checkpoint(self, mode="PASSIVE"):
+        # PASSIVE never waits on readers or writers; TRUNCATE also resets the
+        # WAL file, worth it when things are quiet.
+        return await self.executor.run(
+            lambda connection, cursor: cursor.execute(f"PRAGMA wal_checkpoint({mode})").fetchone(), "checkpoint")
+
+    async def enable_incremental_vacuum(self):
+        if await self._pragma("auto_vacuum") == 2:
+            return False
+
+        size = await self._pragma("page_count") * await self._pragma("page_size")
+        if size > self.online_vacuum_max_bytes:
+            # Storage's writes would wait out busy_timeout and fail.
+            print(f"Not converting the {size / 2 ** 20:.1f} MiB database to incremental auto-vacuum while "
+                  f"running; stop the bot and run: sqlite3 {self.filename} "
+                  f"'PRAGMA auto_vacuum=INCREMENTAL; VACUUM;'")
+            return False
+
+        def _f(connection, cursor):
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            cursor.execute("VACUUM")
+
+        # A one-off full VACUUM, short at this size; Storage's writes wait on
+        # the busy timeout meanwhile.
+        await self.executor.run(_f, "vacuum")
+        return True
+
+    async def incremental_vacuum(self):
+        released = 0
+        while True:
+            free = await self._pragma("freelist_count")
+            if not free:
+                break
+            step = min(free, self.step_pages)
+            await self.executor.run(
+                lambda connection, cursor: cursor.execute(f"PRAGMA incremental_vacuum({step})").fetchall(),
+                "incremental_vacuum")
+            released += step
+            await asyncio.sleep(self.step_pause)
+        return released
+
+    async def analyze(self):
+        def _f(connection, cursor):
+            cursor.execute("ANALYZE")
+            connection.commit()
+
+        await self.executor.run(_f, "analyze")
+
+    async def backup(self, directory=None):
+        directory = directory or self.backup_directory
+        os.makedirs(directory, exist_ok=True)
+        # Microseconds, so two backups in the same second don't overwrite
+        # each other; still sorts by time for pruning.
+        now = time.time()
+        name = time.strftime("partybot-%Y%m%d-%H%M%S", time.localtime(now)) + f".{int(now % 1 * 1e6):06d}.db"
+        target = os.path.join(directory, name)
+        temporary = target + ".tmp"
+
+        def _f(connection, cursor):
+            # sqlite3's online backup copies step_pages at a time and sleeps
+            # in between, so Storage's writes get the lock back in between.
+            destination = sqlite3.connect(temporary)
+            try:
+                connection.backup(destination, pages=self.step_pages, sleep=self.step_pause)
+            finally:
+                destination.close()
+            os.replace(temporary, target)
+
+        start = time.perf_counter()
+        await self.executor.run(_f, "backup")
+        self.backups += 1
+        self.last_backup = time.time()
+        print(f"Backed up the database to {target} in {time.perf_counter() - start:.2f}s.")
+
+        backups = sorted(f for f in os.listdir(directory) if f.startswith("partybot-") and f.endswith(".db"))
+        for old in backups[:-self.keep_backups] if self.keep_backups else ():
+            os.remove(os.path.join(directory, old))
+        return target
+
+    async def run(self):
+        start = time.perf_counter()
+        if await self.enable_incremental_vacuum():
+            print("Converted the database to incremental auto-vacuum.")
+        released = await self.incremental_vacuum()
+        await self.analyze()
+        await self.checkpoint("TRUNCATE")
+        if self.backup_directory:
+            await self.backup()
+        await self.refresh_stats()
+        self.runs += 1
+        self.last_run = time.time()
+        print(f"Database maintenance released {released} pages in {time.perf_counter() - start:.2f}s, "
+              f"{self.page_count * self.page_size / 2 ** 20:.1f} MiB in use.")
+
+    @staticmethod
+    def in_window(window, hour):
+        start, _, end = window.partition("-")
+        start, end = int(start), int(end or start)
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def due(self, now=None):
+        # Once a day, inside the off-peak window.
+        now = time.localtime(now)
+        day = (now.tm_year, now.tm_yday)
+        return self._last_day != day and self.in_window(MAINTENANCE_WINDOW, now.tm_hour)
+
+    def mark_done(self, now=None):
+        now = time.localtime(now)
+        self._last_day = (now.tm_year, now.tm_yday)
+
+    def close(self):
+        self.executor.close()
+
+
+class StateSnapshot:
+    # Storage's caches and the category occupancy as fixed-size records, so a
+    # restart can memory-map the file and unpack it with struct instead of
+    # scanning the tables. Ids are stored with 0 for None. The header carries
+    # the schema version, the DB generation it was taken at and the shard
+    # layout; a CRC32 trailer catches torn or truncated files.
+
+    MAGIC = b"PBSNAP01"
+    HEADER = struct.Struct("<8sIQ?H")
+    COUNT = struct.Struct("<I")
+    CRC = struct.Struct("<I")
+    SETTINGS = struct.Struct("<6Q?iiB")
+    PAIR = struct.Struct("<QQ")
+    TRIPLE = struct.Struct("<QQQ")
+
+    @staticmethod
+    def _id(value):
+        return value or 0
+
+    @staticmethod
+    def _section(record, rows):
+        return [StateSnapshot.COUNT.pack(len(rows))] + [record.pack(*row) for row in rows]
+
+    @staticmethod
+    def pack(generation, shard_key, complete, state, occupancy):
+        settings_rows, category_rows, owner_rows, command_channel_rows = state
+        _id = StateSnapshot._id
+        shard_key = shard_key.encode()
+        parts = [StateSnapshot.HEADER.pack(
+            StateSnapshot.MAGIC, Storage.SCHEMA_VERSION, generation, complete, len(shard_key)), shard_key]
+        parts += StateSnapshot._section(StateSnapshot.SETTINGS, [
+            (*(_id(value) for value in row[:6]), bool(row[6]), row[7] or 0, row[8] or 0,
+             CATEGORY_POLICIES.index(row[9]) if row[9] in CATEGORY_POLICIES else 0)
+            for row in settings_rows])
+        parts += StateSnapshot._section(StateSnapshot.PAIR, [
+            (guild_id, _id(category_id)) for guild_id, category_ids in category_rows for category_id in category_ids])
+        parts += StateSnapshot._section(StateSnapshot.TRIPLE, [
+            (channel_id, user_id, _id(guild_id)) for channel_id, user_id, guild_id in owner_rows])
+        parts += StateSnapshot._section(StateSnapshot.PAIR, command_channel_rows)
+        # Categories in rank order, one (guild, category, 0) row for an empty one.
+        parts += StateSnapshot._section(StateSnapshot.TRIPLE, [
+            (guild_id, category_id, channel_id)
+            for guild_id, categories in occupancy for category_id, channel_ids in categories
+            for channel_id in (channel_ids or (0,))])
+        data = b"".join(parts)
+        return data + StateSnapshot.CRC.pack(zlib.crc32(data))
+
+    @staticmethod
+    def write(filename, data):
+        temporary = filename + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, filename)
+
+    @staticmethod
+    def read(filename):
+        with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size = len(mapped)
+            if size < StateSnapshot.HEADER.size + StateSnapshot.CRC.size or \
+                    zlib.crc32(mapped[:size - StateSnapshot.CRC.size]) != \
+                    StateSnapshot.CRC.unpack_from(mapped, size - StateSnapshot.CRC.size)[0]:
+                raise ValueError("checksum mismatch")
+
+            magic, schema_version, generation, complete, shard_key_length = StateSnapshot.HEADER.unpack_from(mapped)
+            if magic != StateSnapshot.MAGIC:
+                raise ValueError("not a PartyBot snapshot")
+            offset = StateSnapshot.HEADER.size
+            shard_key = mapped[offset:offset + shard_key_length].decode()
+            offset += shard_key_length
+
+            sections = []
+            with memoryview(mapped) as view:
+                for record in (StateSnapshot.SETTINGS, StateSnapshot.PAIR, StateSnapshot.TRIPLE,
+                               StateSnapshot.PAIR, StateSnapshot.TRIPLE):
+                    count = StateSnapshot.COUNT.unpack_from(view, offset)[0]
+                    offset += StateSnapshot.COUNT.size
+                    with view[offset:offset + count * record.size] as chunk:
+                        sections.append(list(record.iter_unpack(chunk)))
+                    offset += count * record.size
+
+        settings, category_pairs, owners, command_channels, occupancy_rows = sections
+        categories: Dict[int, List[Optional[int]]] = {}
+        for guild_id, category_id in category_pairs:
+            categories.setdefault(guild_id, []).append(category_id or None)
+        occupancy: Dict[int, Dict[int, List[int]]] = {}
+        for guild_id, category_id, channel_id in occupancy_rows:
+            channel_ids = occupancy.setdefault(guild_id, {}).setdefault(category_id, [])
+            if channel_id:
+                channel_ids.append(channel_id)
+
+        return {
+            "schema_version": schema_version,
+            "generation": generation,
+            "complete": complete,
+            "shard_key": shard_key,
+            "settings": [
+                (*(value or None for value in row[:6]), row[6], row[7], row[8], CATEGORY_POLICIES[row[9]])
+                for row in settings],
+            "categories": list(categories.items()),
+            "owners": [(channel_id, user_id, guild_id or None) for channel_id, user_id, guild_id in owners],
+            "command_channels": command_channels,
+            "occupancy": occupancy,
+        }
+
+
+permission_cache = PermissionCache()
+bulk_provisioner = BulkProvisioner()
+command_router = CommandRouter()
+
+
+async def get_or_fetch_member(guild, member_id):
+    member = guild.get_member(member_id)
+    if member is None:
+        try:
+            member = await guild.fetch_member(member_id)
+        except discord.NotFound:
+            return None
+    return member
+
+
+async def get_command_target(context: CommandContext):
+    if not context.arguments:
+        return None
+
+    match = USER_ID_PATTERN.match(context.arguments[0])
+    if not match:
+        return None
+
+    # Voice states are always cached, the member object may not be.
+    user_id = int(match.group(1))
+    if user_id not in context.voice_channel.voice_states:
+        return None
+    return await get_or_fetch_member(context.guild, user_id)
+
+
+@command_router.command("lock", PERMISSION_OWNER)
+async def lock_command(context: CommandContext):
+    member_length = max(1, len(context.voice_channel.voice_states))
+    await action_scheduler.edit(context.voice_channel, user_limit=member_length)
+
+
+@command_router.command("unlock", PERMISSION_OWNER)
+async def unlock_command(context: CommandContext):
+    join_voice_channel = context.guild.get_channel(context.guild_settings.join_channel_id)
+    await action_scheduler.edit(context.voice_channel, user_limit=join_voice_channel.user_limit)
+
+
+@command_router.command("kick", PERMISSION_OWNER)
+async def kick_command(context: CommandContext):
+    user = await get_command_target(context)
+    if user and not permission_cache.is_staff(user, context.guild_settings):
+        await action_scheduler.move(user, None, f"PartyBot {context.message.author.id} disconnected user.")
+
+
+@command_router.command("owner", PERMISSION_OWNER)
+async def owner_command(context: CommandContext):
+    user = await get_command_target(context)
+    if user:
+        await storage.set_channel_owner(context.guild.id, context.voice_channel.id, user.id)
+
+
+@command_router.command("delete_all_addition_categories", PERMISSION_MANAGER)
+async def delete_all_additional_categories_command(context: CommandContext):
+    await storage.delete_all_additional_categories(context.guild.id)
+    category_occupancy.pop(context.guild.id, None)
+    category_autoscaler.forget(context.guild.id)
+    await context.message.channel.send(f"Deleteing additional categories.")
+
+
+@command_router.command("delete_all_owners", PERMISSION_MANAGER)
+async def delete_all_owners_command(context: CommandContext):
+    await storage.delete_all_owners(context.guild.id)
+    await context.message.channel.send(f"Deleteing all channel owners.")
+
+
+@command_router.command("fill_category", PERMISSION_MANAGER)
+async def fill_category_command(context: CommandContext):
+    if not context.arguments:
+        return
+
+    if bulk_provisioner.is_running(context.guild.id):
+        await context.message.channel.send("Already filling categories, wait for it to finish.")
+        return
+
+    if context.arguments[0] == "resume":
+        run = bulk_provisioner.runs.get(context.guild.id)
+        if not run:
+            await context.message.channel.send("Nothing to resume.")
+            return
+        category_ids = run.category_ids
+    elif context.arguments[0] == "all":
+        category_ids = list(await storage.get_categories(context.guild.id))
+    else:
+        try:
+            category_ids = [int(argument) for argument in context.arguments]
+        except ValueError:
+            await context.message.channel.send("Category IDs must be numbers.")
+            return
+
+    run = bulk_provisioner.plan(context.guild, category_ids)
+    bulk_provisioner.start(context.guild, run, context.message.channel)
+
+
+@command_router.command("queue", PERMISSION_MANAGER)
+async def queue_command(context: CommandContext):
+    await context.message.channel.send(
+        f"Voice events queued: {voice_pipeline.queue_depth(context.guild.id)}, "
+        f"Discord actions queued: {action_scheduler.queue_depth()}, "
+        f"members waiting for a room: {admission_queue.size(context.guild.id)}.")
+
+
+@command_router.command("timings", PERMISSION_MANAGER)
+async def timings_command(context: CommandContext):
+    lines = [
+        f"{name}: {timing['count']:.0f} calls, {timing['total'] / timing['count'] * 1000:.1f}ms avg, "
+        f"{timing['max'] * 1000:.1f}ms max"
+        for name, timing in sorted(command_router.timings.items()) if timing['count']
+    ]
+    await context.message.channel.send("```" + ("\n".join(lines) or "No commands yet.") + "```")
+
+
+@command_router.command("settings", PERMISSION_MANAGER)
+async def settings_command(context: CommandContext):
+    await context.message.channel.send(f"```{json.dumps(dataclasses.asdict(context.guild_settings), indent=4, sort_keys=True)}```")
+
+
+@command_router.command("set", PERMISSION_MANAGER)
+async def set_command(context: CommandContext):
+    if len(context.arguments) < 2:
+        return
+
+    guild_settings = context.guild_settings
+    message = context.message
+    sub_command = context.arguments[0]
+    parameter = context.arguments[1]
+
+    signature = inspect.signature(PartyBotGuildSettings)
+    if sub_command in signature.parameters and sub_command != 'guild_id':
+        type_ = signature.parameters[sub_command].annotation
+        try:
+            if type_ == bool:
+                property_ = parameter.lower() == 'true'
+            else:
+                property_ = type_(parameter)
+        except ValueError:
+            await message.channel.send(f"{parameter} is not a valid type for {sub_command}, needs to be type {type_}.")
+            return
+
+        if sub_command == "category_policy" and not guild_settings.is_valid_category_policy(property_):
+            await message.channel.send(f"{property_} is not a valid policy, use one of {', '.join(CATEGORY_POLICIES)}.")
+            return
+
+        if "id" in sub_command:
+            valid_property = getattr(
+                guild_settings, "is_valid_" + sub_command)(message.channel.guild, property_)
+            if valid_property:
+                await message.channel.send(f"Set {sub_command} set to {valid_property.name}.")
+            else:
+                await message.channel.send(f"{property_} is not a valid ID.")
+                return
+        else:
+            await message.channel.send(f"Set {sub_command} set to {property_}.")
+
+        setattr(guild_settings, sub_command, property_)
+
+    guild_settings = PartyBotGuildSettings(
+        guild_settings.guild_id,
+        guild_settings.join_channel_id,
+        guild_settings.command_channel_id,
+        guild_settings.main_category_id,
+        guild_settings.moderator_role_id,
+        guild_settings.manage_role_id,
+        guild_settings.dynamic_category_creation,
+        guild_settings.max_categories,
+        guild_settings.pool_size,
+        guild_settings.category_policy
+    )
+
+    await storage.set_party_bot_guild_settings(guild_settings)
+    category_occupancy.pop(guild_settings.guild_id, None)
+    permission_cache.invalidate_members(guild_settings.guild_id)
+    if guild_settings.pool_size > 0:
+        voice_pipeline.submit(guild_settings.guild_id, POOL_REFILL)
+
+
 @client.event
+@metrics.timed("on_message")
 async def on_message(message: discord.Message):
-    if message.author == client.user:
+    if message.author == client.user or not message.guild:
+        return
+
+    if event_recorder:
+        event_recorder.message(message)
+
+    # Fast path: plain chat outside a command channel costs two lookups.
+    is_command = message.content.startswith(CommandRouter.PREFIX)
+    if not is_command and not storage.may_be_command_channel(message.channel.id):
         return
 
-    guild_settings = await storage.get_party_bot_guild_settings(message.author.guild.id)
+    guild_settings = await storage.get_party_bot_guild_settings(message.guild.id)
     if not guild_settings:
         guild_settings = PartyBotGuildSettings(
-            message.author.guild.id,
+            message.guild.id,
             None,
             None,
             None,
@@ -350,260 +2996,1071 @@ async def on_message(message: discord.Message):
             1
         )
 
-    if message.channel.id == guild_settings.command_channel_id:
-        async with contextlib.AsyncExitStack() as stack:
-            if message.author.guild.get_role(guild_settings.manage_role_id) not in message.author.roles and \
-                    message.author.guild.get_role(guild_settings.moderator_role_id) not in message.author.roles and \
-                    not message.author.permissions_in(message.channel).administrator:
-                stack.push_async_callback(message.delete)
+    parsed = command_router.parse(message.content) if is_command else None
+
+    async with contextlib.AsyncExitStack() as stack:
+        voice_channel = None
+        if message.channel.id == guild_settings.command_channel_id:
+            if not permission_cache.is_staff(message.author, guild_settings):
+                stack.push_async_callback(slow_handler_profiler.phase("rest.message_delete", message.delete)
+                                          if slow_handler_profiler else message.delete)
 
             channel_id = await storage.get_owner_channel(message.author.id)
-            voice_channel = message.channel.guild.get_channel(channel_id)
-            if not voice_channel:
-                if channel_id:
-                    await storage.delete_channel(channel_id)
-            else:
-                if message.content.startswith("!pb"):
-                    argument_list = message.content.split()
-                    if len(argument_list) < 2:
-                        return
-
-                    command = argument_list[1]
-
-                    if command == "lock":
-                        member_length = max(1, len(voice_channel.members))
-                        await voice_channel.edit(user_limit=member_length)
-                    elif command == "unlock":
-                        join_voice_channel = message.channel.guild.get_channel(
-                            guild_settings.join_channel_id)
-                        await voice_channel.edit(user_limit=join_voice_channel.user_limit)
-
-                    if len(argument_list) < 3:
-                        return
-
-                    user_id = argument_list[2]
-
-                    match = USER_ID_PATTERN.match(user_id)
-                    if not match:
-                        return
-
-                    user_id = int(match.group(1))
-                    user = message.channel.guild.get_member(user_id)
-
-                    if not user:
-                        return
-
-                    if user not in voice_channel.members:
-                        return
-
-                    if command == "kick":
-                        if message.author.guild.get_role(guild_settings.manage_role_id) not in user.roles and \
-                                message.author.guild.get_role(guild_settings.moderator_role_id) not in user.roles and \
-                                not user.permissions_in(message.channel).administrator:
-                            await user.move_to(None, reason=f"PartyBot {message.author.id} disconnected user.")
-                    elif command == "owner":
-                        await storage.set_channel_owner(voice_channel.id, user.id)
-                        print(storage.party_bot_owners)
-                        print(storage.party_bot_channels)
-
-    if not message.author.permissions_in(message.channel).administrator and \
-            (message.author.guild.get_role(guild_settings.manage_role_id) not in message.author.roles):
-        return
+            voice_channel = message.guild.get_channel(channel_id)
+            if not voice_channel and channel_id:
+                await storage.delete_channel(channel_id)
 
-    if message.channel.permissions_for(message.channel.guild.get_member(client.user.id)) < REQUIRED_PERMISSIONS:
-        print(discord.user.permissions_in(message.channel))
-        return
+        if parsed:
+            command, arguments = parsed
+            context = CommandContext(message, message.guild, guild_settings, arguments, voice_channel)
+            await command_router.dispatch(command, context)
 
-    if message.content.startswith("!pb"):
-        argument_list = message.content.split()
 
-        if len(argument_list) < 2:
-            return
+def resident_memory():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # Peak rather than current, and in bytes on macOS but KiB on Linux.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
 
-        command = argument_list[1]
 
-        if command == "delete_all_addition_categories":
-            await storage.delete_all_additional_categories(message.channel.guild.id)
-            await message.channel.send(f"Deleteing additional categories.")
+startup_seconds: Optional[float] = None
 
-        if command == "delete_all_owners":
-            await storage.delete_all_owners()
-            await message.channel.send(f"Deleteing all channel owners.")
 
-        if command == "fill_category":
-            if len(argument_list) < 3:
-                return
+@client.event
+async def on_ready():
+    global startup_seconds
+    print("We have logged in as {0.user}".format(client))
+    if startup_seconds is None:
+        startup_seconds = time.monotonic() - STARTED
+        print(f"Ready in {startup_seconds:.1f}s with the {INTENTS_PROFILE} intents profile: "
+              f"{len(client.guilds)} guilds, {sum(len(guild.members) for guild in client.guilds)} cached members, "
+              f"{resident_memory() / 2 ** 20:.1f} MiB resident.")
+    start_background_tasks()
+    # The cache is fresh after a (re)connect, a good time to look for rooms,
+    # owners and categories that went away while the bot wasn't watching.
+    background_tasks.append(asyncio.ensure_future(reconcile_all()))
+
+
+@metrics.collector
+def collect_profiler_metrics():
+    if not slow_handler_profiler:
+        return
+    yield "partybot_slow_handlers_total", "counter", "Handlers that went over the profiling threshold.", {}, \
+        slow_handler_profiler.slow
+    yield "partybot_loop_stalls_total", "counter", "Times the event loop was blocked past the stall threshold.", \
+        {}, slow_handler_profiler.stalls
 
-            category_id = int(argument_list[2])
-            category = message.channel.guild.get_channel(category_id)
+
+@metrics.collector
+def collect_maintenance_metrics():
+    if not database_maintenance:
+        return
+    yield "partybot_db_maintenance_runs_total", "counter", "Off-peak maintenance runs.", {}, database_maintenance.runs
+    yield "partybot_db_backups_total", "counter", "Online backups taken.", {}, database_maintenance.backups
+    if database_maintenance.last_backup:
+        yield "partybot_db_last_backup_timestamp", "gauge", "Unix time of the last backup.", {}, \
+            database_maintenance.last_backup
+    if database_maintenance.page_count:
+        yield "partybot_db_file_bytes", "gauge", "Database size at the last maintenance run.", {}, \
+            database_maintenance.page_count * database_maintenance.page_size
+        yield "partybot_db_free_bytes", "gauge", "Free pages left after the last maintenance run.", {}, \
+            database_maintenance.freelist_count * database_maintenance.page_size
+
+
+@metrics.collector
+def collect_process_metrics():
+    yield "partybot_resident_memory_bytes", "gauge", "Resident set size.", {}, resident_memory()
+    yield "partybot_cached_members", "gauge", "Members in the client cache.", {"profile": INTENTS_PROFILE}, \
+        sum(len(guild.members) for guild in client.guilds)
+    if startup_seconds is not None:
+        yield "partybot_startup_seconds", "gauge", "Seconds from start to the first on_ready.", \
+            {"profile": INTENTS_PROFILE}, startup_seconds
+
+
+background_tasks: List[asyncio.Task] = []
+
+
+def start_background_tasks():
+    # on_ready fires again after every reconnect, only start things once.
+    if background_tasks:
+        return
+    background_tasks.append(asyncio.ensure_future(pool_refill_loop()))
+    background_tasks.append(asyncio.ensure_future(channel_reaper_loop()))
+    background_tasks.append(asyncio.ensure_future(reconcile_loop()))
+    background_tasks.append(asyncio.ensure_future(autoscale_loop()))
+    background_tasks.append(asyncio.ensure_future(admission_loop()))
+    if slow_handler_profiler:
+        background_tasks.append(asyncio.ensure_future(slow_handler_profiler.heartbeat_loop()))
+    if snapshot_file:
+        background_tasks.append(asyncio.ensure_future(snapshot_loop()))
+    if database_maintenance:
+        background_tasks.append(asyncio.ensure_future(maintenance_loop()))
+    if METRICS_PORT:
+        background_tasks.append(asyncio.ensure_future(metrics_server()))
+    if METRICS_FILE:
+        background_tasks.append(asyncio.ensure_future(metrics_snapshot_loop()))
+
+
+category_occupancy: Dict[int, CategoryOccupancy] = {}
+
+
+async def get_category_occupancy(guild, categories):
+    occupancy = category_occupancy.get(guild.id)
+    if occupancy is None:
+        occupancy = CategoryOccupancy()
+        for category_id in list(categories):
+            category = guild.get_channel(category_id)
             if category:
-                for i in range(0, 50 - len(category.channels)):
-                    await category.create_voice_channel(
-                        f"PartyBot Room",
-                        bitrate=32000,
-                        user_limit=4,
-                        reason="PartyBot create member channel."
-                    )
+                occupancy.add_category(category_id, (channel.id for channel in category.channels))
+            else:
+                await storage.remove_category(guild.id, category_id)
+        category_occupancy[guild.id] = occupancy
+    return occupancy
 
-        if command == "settings":
-            await message.channel.send(f"```{json.dumps(vars(guild_settings), indent=4, sort_keys=True)}```")
 
-        elif command == "set":
-            if len(argument_list) < 4:
-                return
+async def get_unfilled_category(guild, categories, policy=CATEGORY_POLICY_FILL_FIRST):
+    occupancy = await get_category_occupancy(guild, categories)
+    while True:
+        category_id = occupancy.pick(policy)
+        if category_id is None:
+            return None
 
-            sub_command = argument_list[2]
-            parameter = argument_list[3]
+        category = guild.get_channel(category_id)
+        if category:
+            return category
 
-            signature = inspect.signature(PartyBotGuildSettings)
-            if sub_command in signature.parameters and sub_command != 'guild_id':
-                type_ = signature.parameters[sub_command].annotation
-                try:
-                    if type_ == bool:
-                        property_ = parameter.lower() == 'true'
-                    else:
-                        property_ = type_(parameter)
-                except ValueError:
-                    await message.channel.send(f"{parameter} is not a valid type for {sub_command}, needs to be type {type_}.")
-                    return
+        occupancy.remove_category(category_id)
+        await storage.remove_category(guild.id, category_id)
 
-                if "id" in sub_command:
-                    valid_property = getattr(
-                        guild_settings, "is_valid_" + sub_command)(message.channel.guild, property_)
-                    if valid_property:
-                        await message.channel.send(f"Set {sub_command} set to {valid_property.name}.")
-                    else:
-                        await message.channel.send(f"{property_} is not a valid ID.")
-                        return
-                else:
-                    await message.channel.send(f"Set {sub_command} set to {property_}.")
 
-                setattr(guild_settings, sub_command, property_)
+@client.event
+@metrics.timed("on_guild_channel_create")
+async def on_guild_channel_create(channel):
+    occupancy = category_occupancy.get(channel.guild.id)
+    if occupancy is not None and channel.category_id in occupancy:
+        occupancy.add_channel(channel.category_id, channel.id)
 
-            guild_settings = PartyBotGuildSettings(
-                guild_settings.guild_id,
-                guild_settings.join_channel_id,
-                guild_settings.command_channel_id,
-                guild_settings.main_category_id,
-                guild_settings.moderator_role_id,
-                guild_settings.manage_role_id,
-                guild_settings.dynamic_category_creation,
-                guild_settings.max_categories
-            )
 
-            await storage.set_party_bot_guild_settings(guild_settings)
+@client.event
+async def on_guild_role_create(role):
+    permission_cache.invalidate_guild(role.guild.id)
 
 
 @client.event
-async def on_ready():
-    print("We have logged in as {0.user}".format(client))
+async def on_guild_role_update(before, after):
+    permission_cache.invalidate_guild(after.guild.id)
 
 
-async def get_unfilled_category(guild, categories):
-    for category_id in categories:
-        try:
-            category = guild.get_channel(category_id)
-            if len(category.channels) < CHANNEL_LIMIT - 1:
-                return category
-        except AttributeError:
-            await storage.remove_category(guild.id, category_id)
-    return None
+@client.event
+async def on_guild_role_delete(role):
+    permission_cache.invalidate_guild(role.guild.id)
+
+
+@client.event
+async def on_guild_update(before, after):
+    permission_cache.invalidate_guild(after.id)
+
 
 @client.event
+async def on_member_update(before, after):
+    if before.roles != after.roles:
+        permission_cache.invalidate_member(after.guild.id, after.id)
+        if after.id == client.user.id:
+            permission_cache.invalidate_bot(after.guild.id)
+
+
+@client.event
+@metrics.timed("on_guild_channel_update")
+async def on_guild_channel_update(before, after):
+    permission_cache.invalidate_channel(after.guild.id, after.id)
+    occupancy = category_occupancy.get(after.guild.id)
+    if occupancy is not None and before.category_id != after.category_id:
+        occupancy.remove_channel(before.category_id, before.id)
+        occupancy.add_channel(after.category_id, after.id)
+
+
+@client.event
+@metrics.timed("on_guild_channel_delete")
 async def on_guild_channel_delete(channel):
-    categories = await storage.get_categories(channel.guild.id)
+    if event_recorder:
+        event_recorder.channel_delete(channel)
+
+    permission_cache.invalidate_channel(channel.guild.id, channel.id)
+    voice_channel_pool.discard(channel.guild.id, channel.id)
+    channel_reaper.discard(channel.guild.id, channel.id)
+    occupancy = category_occupancy.get(channel.guild.id)
+    if occupancy is not None:
+        occupancy.remove_channel(channel.category_id, channel.id)
+
     guild_settings = await storage.get_party_bot_guild_settings(channel.guild.id)
-    
-    if isinstance(channel, discord.VoiceChannel) and channel.category in categories:
-        if storage.partybot_channels.get(channel.id):
+    if not guild_settings:
+        return
+
+    categories = await storage.get_categories(channel.guild.id)
+
+    if channel.type == discord.ChannelType.voice and channel.category_id in categories:
+        if storage.party_bot_channels.get(channel.id):
             print("removing owner channel")
             await storage.delete_channel(channel.id)
-    elif isinstance(channel, discord.CategoryChannel) and channel in categories:
+    elif channel.type == discord.ChannelType.category and channel.id in categories:
         print("removing category")
+        if occupancy is not None:
+            occupancy.remove_category(channel.id)
+        voice_channel_pool.discard_category(channel.guild, channel.id)
         await storage.remove_category(channel.guild.id, channel.id)
     elif channel.id == guild_settings.join_channel_id:
         guild_settings.join_channel_id = None
         await storage.set_party_bot_guild_settings(guild_settings)
 
-@client.event
-async def on_voice_state_update(
-        member: discord.Member,
-        before: discord.VoiceState,
-        after: discord.VoiceState):
-
-    guild_settings = await storage.get_party_bot_guild_settings(member.guild.id)
-
-    if not guild_settings.join_channel_id or not guild_settings.main_category_id:
-        return
-
-    main_category = member.guild.get_channel(guild_settings.main_category_id)
-    if not main_category:
-        guild_settings.main_category_id = None
-        await storage.set_party_bot_guild_settings(guild_settings)
-        return
 
-    if client.get_channel(guild_settings.join_channel_id) \
-             .permissions_for(member.guild.get_member(client.user.id)) < REQUIRED_PERMISSIONS:
-        return
+def is_recyclable(channel, join_channel, guild_settings):
+    return voice_channel_pool.size(channel.guild.id) < guild_settings.pool_size and \
+        channel.name == POOL_CHANNEL_NAME and channel.user_limit == join_channel.user_limit
 
-    categories = await storage.get_categories(member.guild.id)
 
+async def handle_voice_leave(member, before, join_channel, guild_settings, categories):
     if before.channel and before.channel.id != guild_settings.join_channel_id and \
        before.channel.category_id in categories:
         if len(before.channel.members) == 0:
-            if await storage.get_owner_channel(member.id) == before.channel.id:
-                await storage.delete_channel(before.channel.id)
-            await before.channel.delete(reason="PartyBot no more members in channel.")
-            if before.channel.category_id != guild_settings.main_category_id:
-                if len(before.channel.category.channels) == 0:
-                    category_id = before.channel.category.id
-                    await before.channel.category.delete(reason="PartyBot no more channels in category.")
-                    await storage.remove_category(member.guild.id, category_id)
+            if is_recyclable(before.channel, join_channel, guild_settings):
+                if await storage.get_channel_owner(before.channel.id) is not None:
+                    await storage.delete_channel(before.channel.id)
+                voice_channel_pool.release(member.guild.id, before.channel.id)
+                voice_channel_pool.recycled += 1
+                return
+            channel_reaper.mark(member.guild.id, before.channel.id)
         else:
             if await storage.get_owner_channel(member.id) == before.channel.id and \
                await storage.get_channel_owner(before.channel.id) == member.id:
                 new_owner = random.choice(before.channel.members)
-                await storage.set_channel_owner(before.channel.id, new_owner.id)
+                await storage.set_channel_owner(member.guild.id, before.channel.id, new_owner.id)
                 #await new_owner.send(f"The previous owner left, you're the captain now of {before.channel.name}.")
                 #Apparently DMing the user here is considered spam, so TODO: find a better way to do this, maybe a channel?
 
-    if after.channel and after.channel.id == guild_settings.join_channel_id:
-        category = await get_unfilled_category(member.guild, categories)
 
-        if not category:
-            if guild_settings.dynamic_category_creation and len(categories) < guild_settings.max_categories:
-                main_cateogry = member.guild.get_channel(
-                    guild_settings.main_category_id)
+async def handle_voice_rejoin(after, guild_settings, categories):
+    channel = after.channel
+    if not channel or channel.id == guild_settings.join_channel_id or channel.category_id not in categories:
+        return
+
+    # Someone walked into a room that was waiting to be reaped or sitting in
+    # the pool; if its owner isn't there any more, hand it to someone who is.
+    was_marked = channel_reaper.cancel(channel.guild.id, channel.id)
+    was_pooled = voice_channel_pool.discard(channel.guild.id, channel.id)
+    if was_marked or was_pooled:
+        members = channel.members
+        owner_id = await storage.get_channel_owner(channel.id)
+        if members and not any(m.id == owner_id for m in members):
+            await storage.set_channel_owner(channel.guild.id, channel.id, random.choice(members).id)
 
-                category = await member.guild.create_category(
-                    f"{main_cateogry.name} {len(categories) + 1}",
-                    position=member.guild.get_channel(
-                        categories[-1]).position + 1,
-                    reason="PartyBot dynamic category creation."
-                )
 
-                await storage.add_category(member.guild.id, category.id)
-            else:
-                await member.move_to(None, reason="PartyBot no more open categories.")
-                #await member.send("There are no more open categories, contact an administrator or moderator for more details.")
-                return
+async def reap_channels(guild, join_channel, guild_settings, categories):
+    channel_ids = channel_reaper.take_due(guild.id)
+    if not channel_ids:
+        return
+
+    occupancy = await get_category_occupancy(guild, categories)
+    channels = [guild.get_channel(channel_id) for channel_id in channel_ids]
+    channels = [channel for channel in channels
+                if channel and not channel.members and not voice_channel_pool.contains(guild.id, channel.id)]
+    # Owner rows for the whole sweep are looked up and dropped in one go.
+    owners = await storage.get_channel_owners([channel.id for channel in channels])
+    if owners:
+        await storage.delete_orphans(guild.id, list(owners), [])
+
+    reaped = 0
+    for channel in channels:
+        if is_recyclable(channel, join_channel, guild_settings):
+            voice_channel_pool.release(guild.id, channel.id)
+            voice_channel_pool.recycled += 1
+            continue
+
+        action_scheduler.delete(channel, "PartyBot no more members in channel.")
+        occupancy.remove_channel(channel.category_id, channel.id)
+        reaped += 1
+
+    # Categories this empties are deleted later, if at all, by scale_categories.
+    channel_reaper.reaped += reaped
+
+
+async def reconcile_guild(guild, join_channel, guild_settings, categories):
+    # Bulk version of the lazy cleanups: drop categories and owner rows whose
+    # channels are gone, and mark rooms that still have an owner row but
+    # nobody in them, left over from an outage, for reaping right away.
+    # Unowned empty rooms are pooled or provisioned with fill_category.
+    dead_categories = []
+    for category_id in categories:
+        if category_id == guild_settings.main_category_id:
+            continue
+        category = guild.get_channel(category_id)
+        # Empty ones are left to the autoscaler's scale-down pass.
+        if not category or category.type != discord.ChannelType.category:
+            dead_categories.append(category_id)
+
+    owners = await storage.get_guild_owners(guild.id)
+    dead_owners = [channel_id for channel_id in owners if not guild.get_channel(channel_id)]
+    await storage.delete_orphans(guild.id, dead_owners, dead_categories)
+    for category_id in dead_categories:
+        voice_channel_pool.discard_category(guild, category_id)
+    # Rebuilt from the guild cache on next use, unless it still matches, as
+    # one restored from a state snapshot usually does.
+    occupancy = category_occupancy.get(guild.id)
+    if occupancy is not None and (dead_categories or not occupancy.matches(guild)):
+        category_occupancy.pop(guild.id, None)
+
+    empty_rooms = 0
+    for channel_id in owners:
+        channel = guild.get_channel(channel_id)
+        if channel and channel.type == discord.ChannelType.voice and channel.id != join_channel.id and \
+                channel.category_id in categories and not channel.members and \
+                not voice_channel_pool.contains(guild.id, channel.id):
+            channel_reaper.mark(guild.id, channel.id, due_now=True)
+            empty_rooms += 1
+
+    if dead_categories or dead_owners or empty_rooms:
+        print(f"Reconciled guild {guild.id}: {len(dead_categories)} categories and {len(dead_owners)} owners "
+              f"removed, {empty_rooms} empty rooms queued for cleanup.")
+
+
+async def create_managed_category(guild, guild_settings, categories):
+    main_cateogry = guild.get_channel(guild_settings.main_category_id)
+
+    category = await action_scheduler.create_category(
+        guild,
+        f"{main_cateogry.name} {len(categories) + 1}",
+        position=guild.get_channel(categories[-1]).position + 1,
+        reason="PartyBot dynamic category creation."
+    )
+
+    await storage.add_category(guild.id, category.id)
+    occupancy = await get_category_occupancy(guild, categories)
+    occupancy.add_category(category.id)
+    return category
+
+
+async def scale_categories(guild, guild_settings, categories, scheduled=False):
+    occupancy = await get_category_occupancy(guild, categories)
+    main_category_id = guild_settings.main_category_id
+    pooled = voice_channel_pool.category_counts(guild)
+
+    if category_autoscaler.wants_category(occupancy, guild_settings, categories, pooled):
+        await create_managed_category(guild, guild_settings, categories)
+        category_autoscaler.scaled_up += 1
+
+    if not scheduled:
+        category_autoscaler.track(guild.id, occupancy, main_category_id, pooled)
+        return
+
+    for category_id in category_autoscaler.scale_down_candidates(guild.id, occupancy, main_category_id, pooled):
+        category = guild.get_channel(category_id)
+        # All that's left in it are idle pool rooms, they go with it.
+        for channel_id in list(occupancy.channels.get(category_id, ())):
+            channel = guild.get_channel(channel_id)
+            if channel and voice_channel_pool.contains(guild.id, channel_id) and not channel.members:
+                action_scheduler.delete(channel, "PartyBot no more channels in category.")
+        occupancy.remove_category(category_id)
+        voice_channel_pool.discard_category(guild, category_id)
+        category_autoscaler.empty_since[guild.id].pop(category_id, None)
+        if category:
+            action_scheduler.delete(category, "PartyBot no more channels in category.")
+        await storage.remove_category(guild.id, category_id)
+        category_autoscaler.scaled_down += 1
+
+    source_id = category_autoscaler.consolidation_source(occupancy, main_category_id, pooled) if is_quiet() else None
+    if not source_id:
+        return
+
+    # Move the rooms out, people in them stay connected; the emptied category
+    # goes on a later scheduled pass like any other.
+    targets = sorted((occupancy.ranks[category_id], category_id) for category_id in occupancy.channels
+                     if category_id != source_id and guild.get_channel(category_id))
+    moves = []
+    for channel_id in list(occupancy.channels[source_id]):
+        channel = guild.get_channel(channel_id)
+        target_id = next((category_id for _, category_id in targets if occupancy.free_slots(category_id)), None)
+        if not channel or target_id is None:
+            continue
+        occupancy.remove_channel(source_id, channel_id)
+        occupancy.add_channel(target_id, channel_id)
+        moves.append(action_scheduler.edit(channel, category=guild.get_channel(target_id)))
+    for result in await asyncio.gather(*moves, return_exceptions=True):
+        if isinstance(result, Exception):
+            print(f"PartyBot consolidating category {source_id} failed: {result!r}")
+            category_occupancy.pop(guild.id, None)
+        else:
+            category_autoscaler.consolidated += 1
 
-        if category != None:
-            channel: discord.VoiceChannel = await member.guild.create_voice_channel(
-                f"PartyBot Room",
+
+async def seat_member(member, channel):
+    await storage.set_channel_owner(member.guild.id, channel.id, member.id)
+    try:
+        await action_scheduler.move(member, channel, "PartyBot move user.")
+    except discord.HTTPException as e:
+        # Usually they left voice before the move landed. The reaper deletes
+        # the room and its owner row later, or hands it to the next joiner.
+        print(f"PartyBot couldn't move {member.id} into {channel.id}: {e!r}")
+        channel_reaper.mark(member.guild.id, channel.id)
+
+
+async def place_member(member, join_channel, guild_settings, categories):
+    channel = voice_channel_pool.take(member.guild)
+    if channel:
+        await seat_member(member, channel)
+        return True
+
+    category = await get_unfilled_category(member.guild, categories, guild_settings.category_policy)
+
+    if not category:
+        if guild_settings.dynamic_category_creation and len(categories) < guild_settings.max_categories:
+            category = await create_managed_category(member.guild, guild_settings, categories)
+        else:
+            channel = channel_reaper.reclaim(member.guild)
+            if channel:
+                await seat_member(member, channel)
+                return True
+            # No room; admit_members decides whether they wait.
+            return False
+
+    if category != None:
+        try:
+            channel: discord.VoiceChannel = await action_scheduler.create_voice_channel(
+                member.guild,
+                POOL_CHANNEL_NAME,
                 category=category,
-                bitrate=after.channel.bitrate,
-                user_limit=after.channel.user_limit,
+                bitrate=join_channel.bitrate,
+                user_limit=join_channel.user_limit,
                 reason="PartyBot create member channel."
             )
+        except discord.HTTPException as e:
+            # Treated like no room: they wait, and the next batch tries again.
+            print(f"PartyBot couldn't create a channel in category {category.id}: {e!r}")
+            return False
 
-            if channel.category == None:
-                channel.delete("PartyBot invalid category.")
-                return
+        if channel.category == None:
+            action_scheduler.delete(channel, "PartyBot invalid category.")
+            return True
+
+        occupancy = await get_category_occupancy(member.guild, categories)
+        occupancy.add_channel(channel.category_id, channel.id)
+
+        await seat_member(member, channel)
+    return True
+
+
+def in_join_channel(member, join_channel):
+    return member is not None and member.voice is not None and member.voice.channel is not None and \
+        member.voice.channel.id == join_channel.id
+
+
+async def admit_members(guild, join_channel, guild_settings, categories, arrivals=()):
+    # Whoever is already waiting goes first. Once someone can't be seated,
+    # everyone behind them waits too, so a later joiner never takes the room
+    # that frees up for an earlier one.
+    candidates: Dict[int, Optional[discord.Member]] = {
+        member_id: guild.get_member(member_id) for member_id in admission_queue.members(guild.id)}
+    for member in arrivals:
+        candidates.setdefault(member.id, member)
+
+    full = False
+    for member_id, member in candidates.items():
+        if not in_join_channel(member, join_channel):
+            if admission_queue.remove(guild.id, member_id) is not None:
+                admission_queue.abandoned += 1
+            continue
+
+        try:
+            if not full and await place_member(member, join_channel, guild_settings, categories):
+                waited = admission_queue.remove(guild.id, member_id)
+                if waited is not None:
+                    admission_queue.admitted += 1
+                    metrics.observe("partybot_admission_wait_seconds", "Time joiners spent waiting for a room.",
+                                    waited)
+                continue
+
+            full = True
+            if not admission_queue.enqueue(guild.id, member_id):
+                admission_queue.shed["full"] += 1
+                await action_scheduler.move(member, None, "PartyBot no more open categories.")
+        except Exception:
+            # Only this member is dropped; the rest keep their place in line.
+            traceback.print_exc()
+            admission_queue.remove(guild.id, member_id)
+            admission_queue.failed += 1
+
+    for member_id in admission_queue.overdue(guild.id):
+        admission_queue.remove(guild.id, member_id)
+        admission_queue.shed["timeout"] += 1
+        member = guild.get_member(member_id)
+        if in_join_channel(member, join_channel):
+            try:
+                await action_scheduler.move(member, None, "PartyBot waited too long for a room.")
+            except discord.HTTPException:
+                traceback.print_exc()
+
+
+@metrics.timed("voice_batch")
+async def handle_voice_state_updates(guild_id, events):
+    guild = client.get_guild(guild_id)
+    if not guild:
+        return
+
+    guild_settings = await storage.get_party_bot_guild_settings(guild_id)
+
+    if not guild_settings or not guild_settings.join_channel_id or not guild_settings.main_category_id:
+        return
+
+    main_category = guild.get_channel(guild_settings.main_category_id)
+    if not main_category:
+        guild_settings.main_category_id = None
+        await storage.set_party_bot_guild_settings(guild_settings)
+        return
+
+    join_channel = guild.get_channel(guild_settings.join_channel_id)
+    if not join_channel or permission_cache.bot_missing_permissions(join_channel):
+        return
+
+    categories = await storage.get_categories(guild_id)
+
+    # Leaves are handled in arrival order; joins are collected so the whole
+    # burst is placed in one pass against a consistent view of the categories.
+    waiting: Dict[int, discord.Member] = {}
+    refill = False
+    reap = False
+    reconcile = False
+    scale = False
+    for event in events:
+        if event is POOL_REFILL:
+            refill = True
+            continue
+        if event is CHANNEL_REAP:
+            reap = True
+            continue
+        if event is RECONCILE:
+            reconcile = True
+            continue
+        if event is CATEGORY_SCALE:
+            scale = True
+            continue
+        if event is ADMIT:
+            continue
+
+        member, before, after = event
+        try:
+            await handle_voice_leave(member, before, join_channel, guild_settings, categories)
+            await handle_voice_rejoin(after, guild_settings, categories)
+        except discord.HTTPException:
+            traceback.print_exc()
+
+        if after.channel and after.channel.id == guild_settings.join_channel_id:
+            waiting[member.id] = member
+        else:
+            waiting.pop(member.id, None)
+
+    if reconcile:
+        await reconcile_guild(guild, join_channel, guild_settings, categories)
+        reap = True
+
+    if waiting or admission_queue.size(guild_id):
+        await admit_members(guild, join_channel, guild_settings, categories, waiting.values())
+
+    if reap:
+        await reap_channels(guild, join_channel, guild_settings, categories)
+        # Rooms the reaper just freed go to whoever is waiting.
+        if admission_queue.size(guild_id):
+            await admit_members(guild, join_channel, guild_settings, categories)
+
+    await scale_categories(guild, guild_settings, categories, scheduled=scale)
+
+    # Topping up the pool only starts on a POOL_REFILL and runs off the
+    # pipeline in small steps; each step that leaves it short asks again.
+    if refill and guild_settings.pool_size > 0 and voice_channel_pool.size(guild_id) < guild_settings.pool_size:
+        voice_channel_pool.start_refill(guild, join_channel, categories, guild_settings.pool_size,
+                                        guild_settings.category_policy)
+
+
+async def pool_refill_loop():
+    while True:
+        await asyncio.sleep(POOL_REFILL_INTERVAL)
+        for guild_id, guild_settings in list(storage.party_bot_guild_settings.items()):
+            if guild_settings and guild_settings.pool_size > 0 and client.get_guild(guild_id) and \
+                    voice_channel_pool.size(guild_id) < guild_settings.pool_size:
+                voice_pipeline.submit(guild_id, POOL_REFILL)
+
+
+async def admission_loop():
+    # Waiting members are also seated by any batch for their guild; this is
+    # for quiet guilds, and to shed whoever waited past the limit.
+    while True:
+        await asyncio.sleep(ADMISSION_INTERVAL)
+        for guild_id in list(admission_queue.waiting):
+            voice_pipeline.submit(guild_id, ADMIT)
+
+
+async def autoscale_loop():
+    while True:
+        await asyncio.sleep(AUTOSCALE_INTERVAL)
+        guild_ids = set(category_occupancy) if category_autoscaler.consolidate_below else \
+            set(category_autoscaler.empty_since)
+        for guild_id in guild_ids:
+            voice_pipeline.submit(guild_id, CATEGORY_SCALE)
+
+
+async def channel_reaper_loop():
+    reported = (0, 0)
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        for guild_id in channel_reaper.due_guilds():
+            voice_pipeline.submit(guild_id, CHANNEL_REAP)
+
+        if (channel_reaper.reaped, channel_reaper.cancelled) != reported:
+            reported = (channel_reaper.reaped, channel_reaper.cancelled)
+            print(f"Reaper deleted {channel_reaper.reaped} empty channels, "
+                  f"{channel_reaper.cancelled} were rejoined within the grace period.")
+
+
+@metrics.collector
+def collect_bot_metrics():
+    yield "partybot_voice_events_total", "counter", "Voice events handled by the pipeline.", {}, voice_pipeline.events
+    yield "partybot_voice_batches_total", "counter", "Voice pipeline batches.", {}, voice_pipeline.batches
+    yield "partybot_voice_max_batch", "gauge", "Largest voice pipeline batch so far.", {}, voice_pipeline.max_batch
+    for guild_id, depth in voice_pipeline.queue_depths().items():
+        yield "partybot_voice_queue_depth", "gauge", "Voice events waiting per guild.", {"guild": guild_id}, depth
+
+    for priority, depth in sorted(action_scheduler.depths.items()):
+        yield "partybot_scheduler_queue_depth", "gauge", "Discord actions waiting per priority.", \
+            {"priority": priority}, depth
+    yield "partybot_scheduler_running", "gauge", "Discord actions in flight.", {}, action_scheduler.running
+    for kind, stats in sorted(action_scheduler.stats.items()):
+        for outcome in ("submitted", "merged", "completed", "failed", "skipped"):
+            yield "partybot_rest_actions_total", "counter", "Discord actions by kind and outcome.", \
+                {"kind": kind, "outcome": outcome}, stats[outcome]
+
+    yield "partybot_db_operations_total", "counter", "Operations run on the SQLite thread.", {}, \
+        storage.executor.operations
+    yield "partybot_storage_cache_total", "counter", "Storage reads served from memory or SQLite.", \
+        {"result": "hit"}, storage.cache_hits
+    yield "partybot_storage_cache_total", "counter", "Storage reads served from memory or SQLite.", \
+        {"result": "miss"}, storage.cache_misses
+    yield "partybot_storage_flushes_total", "counter", "Write-behind transactions.", {}, storage.flush_count
+    yield "partybot_storage_flushed_writes_total", "counter", "Writes committed by write-behind.", {}, \
+        storage.flushed_writes
+    yield "partybot_storage_pending_writes", "gauge", "Writes waiting for write-behind.", {}, \
+        len(storage._pending_writes)
+    yield "partybot_owned_channels", "gauge", "Rooms with an owner.", {}, len(storage.party_bot_channels)
+    for cache in storage.caches():
+        labels = {"cache": cache.name}
+        yield "partybot_cache_entries", "gauge", "Entries in a Storage cache.", labels, len(cache)
+        yield "partybot_cache_bytes", "gauge", "Estimated memory held by a Storage cache.", labels, cache.memory_bytes()
+        yield "partybot_cache_evictions_total", "counter", "Storage cache entries evicted for space.", labels, \
+            cache.evictions
+        yield "partybot_cache_expirations_total", "counter", "Storage cache entries expired.", labels, \
+            cache.expirations
+
+    yield "partybot_permission_cache_total", "counter", "Permission checks served from the cache.", \
+        {"result": "hit"}, permission_cache.hits
+    yield "partybot_permission_cache_total", "counter", "Permission checks served from the cache.", \
+        {"result": "miss"}, permission_cache.misses
+
+    yield "partybot_pool_takes_total", "counter", "Joins placed from the pool or not.", {"result": "hit"}, \
+        voice_channel_pool.hits
+    yield "partybot_pool_takes_total", "counter", "Joins placed from the pool or not.", {"result": "miss"}, \
+        voice_channel_pool.misses
+    yield "partybot_pool_created_total", "counter", "Rooms created for the pool.", {}, voice_channel_pool.created
+    yield "partybot_pool_recycled_total", "counter", "Rooms returned to the pool.", {}, voice_channel_pool.recycled
+    yield "partybot_reaper_marks_total", "counter", "Rooms marked empty.", {}, channel_reaper.marks
+    yield "partybot_reaper_cancelled_total", "counter", "Marked rooms rejoined in time.", {}, channel_reaper.cancelled
+    yield "partybot_reaper_reaped_total", "counter", "Empty rooms deleted.", {}, channel_reaper.reaped
+    yield "partybot_autoscaler_scaled_total", "counter", "Categories made ahead of demand or deleted.", \
+        {"direction": "up"}, category_autoscaler.scaled_up
+    yield "partybot_autoscaler_scaled_total", "counter", "Categories made ahead of demand or deleted.", \
+        {"direction": "down"}, category_autoscaler.scaled_down
+    yield "partybot_reaper_reclaimed_total", "counter", "Marked rooms handed to someone waiting.", {}, \
+        channel_reaper.reclaimed
+    yield "partybot_admission_queued_total", "counter", "Joiners who had to wait for a room.", {}, \
+        admission_queue.queued
+    yield "partybot_admission_admitted_total", "counter", "Waiting joiners given a room.", {}, admission_queue.admitted
+    yield "partybot_admission_abandoned_total", "counter", "Waiting joiners who left on their own.", {}, \
+        admission_queue.abandoned
+    yield "partybot_admission_failed_total", "counter", "Joiners dropped after an error placing them.", {}, \
+        admission_queue.failed
+    for reason in ("full", "timeout"):
+        yield "partybot_admission_shed_total", "counter", "Joiners disconnected instead of waiting.", \
+            {"reason": reason}, admission_queue.shed[reason]
+    yield "partybot_autoscaler_consolidated_total", "counter", "Rooms moved out of lightly used categories.", {}, \
+        category_autoscaler.consolidated
+
+    for guild_id in set(storage.categories) | set(category_occupancy) | set(voice_channel_pool.idle):
+        labels = {"guild": guild_id}
+        yield "partybot_categories", "gauge", "Managed categories per guild.", labels, \
+            len(storage.categories.get(guild_id) or ())
+        occupancy = category_occupancy.get(guild_id)
+        if occupancy is not None:
+            yield "partybot_channels", "gauge", "Channels in managed categories per guild.", labels, \
+                sum(len(channels) for channels in occupancy.channels.values())
+        yield "partybot_pool_idle_channels", "gauge", "Idle pooled rooms per guild.", labels, \
+            voice_channel_pool.size(guild_id)
+        yield "partybot_reaper_marked_channels", "gauge", "Empty rooms waiting to be reaped per guild.", labels, \
+            len(channel_reaper.marked.get(guild_id, ()))
+        yield "partybot_admission_waiting", "gauge", "Joiners waiting for a room per guild.", labels, \
+            admission_queue.size(guild_id)
+        yield "partybot_autoscaler_empty_categories", "gauge", "Empty extra categories per guild.", labels, \
+            len(category_autoscaler.empty_since.get(guild_id, ()))
+
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found.\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def metrics_server():
+    server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    print(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    async with server:
+        await server.serve_forever()
+
+
+def write_metrics_snapshot(filename):
+    # Written next to the target and renamed, so readers never see half a file.
+    temporary = f"{filename}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        f.write(metrics.render())
+    os.replace(temporary, filename)
+
+
+async def metrics_snapshot_loop():
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        try:
+            write_metrics_snapshot(METRICS_FILE)
+        except OSError as e:
+            print(f"Writing metrics to {METRICS_FILE} failed: {e!r}")
+
+
+async def reconcile_all():
+    # Owner rows from before they carried a guild id: attach them to the guild
+    # their channel is in, or drop them if no guild has it. With a subset of
+    # shards an unknown channel may just belong to another worker.
+    channel_ids = await storage.get_unassigned_owner_channels()
+    if channel_ids:
+        assigned = {}
+        orphans = []
+        for channel_id in channel_ids:
+            channel = client.get_channel(channel_id)
+            if channel:
+                assigned[channel_id] = channel.guild.id
+            elif SHARD_IDS is None:
+                orphans.append(channel_id)
+        await storage.assign_owner_guilds(assigned)
+        await storage.delete_orphans(None, orphans, [])
+        print(f"Reconciled {len(assigned)} owners without a guild, removed {len(orphans)}.")
+
+    for guild in client.guilds:
+        voice_pipeline.submit(guild.id, RECONCILE)
+
+
+def snapshot_shard_key():
+    return f"{SHARD_COUNT}:{','.join(map(str, SHARD_IDS))}" if SHARD_IDS else ""
+
+
+def snapshot_filename():
+    if not SHARD_IDS:
+        return SNAPSHOT_FILE
+    root, extension = os.path.splitext(SNAPSHOT_FILE)
+    return f"{root}-shards-{'-'.join(map(str, SHARD_IDS))}{extension}"
+
+
+def snapshot_occupancy():
+    return [(guild_id, [(category_id, list(occupancy.channels[category_id]))
+                        for category_id in sorted(occupancy.channels, key=occupancy.ranks.__getitem__)])
+            for guild_id, occupancy in category_occupancy.items()]
+
+
+async def save_state_snapshot(filename, attempts=SNAPSHOT_ATTEMPTS):
+    # Read the generation, copy the caches with nothing in flight or queued,
+    # flush and read it again. A write that slipped in anywhere, its cache
+    # change copied or not, shows up as a different second read, and that
+    # copy is thrown away rather than saved under the wrong generation.
+    start = time.perf_counter()
+    for _ in range(attempts):
+        await storage.flush()
+        generation = await storage.executor.run(storage.read_generation, "generation")
+        if storage.writes_in_flight or storage._pending_writes:
+            await asyncio.sleep(SNAPSHOT_RETRY_DELAY)
+            continue
+        state = storage.snapshot_state()
+        occupancy = snapshot_occupancy()
+        await storage.flush()
+        if await storage.executor.run(storage.read_generation, "generation") == generation:
+            break
+        await asyncio.sleep(SNAPSHOT_RETRY_DELAY)
+    else:
+        print(f"Skipped the state snapshot, writes kept landing in {attempts} attempts.")
+        return 0
+
+    loop = asyncio.get_event_loop()
+    data = await loop.run_in_executor(None, StateSnapshot.pack, generation, snapshot_shard_key(), storage.loaded,
+                                      state, occupancy)
+    await loop.run_in_executor(None, StateSnapshot.write, filename, data)
+    metrics.observe("partybot_snapshot_seconds", "Time to write a state snapshot.", time.perf_counter() - start)
+    return len(data)
+
+
+def save_state_snapshot_sync(filename):
+    # For shutdown, once the loop is gone; Storage must still be open. A
+    # handler stopped half way through a write leaves the caches and the
+    # database apart, the previous snapshot is the better one then.
+    storage.flush_sync()
+    if storage.writes_in_flight:
+        print("Skipped the state snapshot, a write was cut off by the shutdown.")
+        return
+    generation = storage.executor.call(storage.read_generation)
+    data = StateSnapshot.pack(generation, snapshot_shard_key(), storage.loaded, storage.snapshot_state(),
+                              snapshot_occupancy())
+    StateSnapshot.write(filename, data)
+    print(f"Wrote a {len(data) / 1024:.1f} KiB state snapshot to {filename}.")
+
+
+def restore_state_snapshot(filename):
+    start = time.perf_counter()
+    try:
+        snapshot = StateSnapshot.read(filename)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, struct.error, IndexError) as e:
+        print(f"Ignoring state snapshot {filename}: {e}.")
+        return False
+
+    if snapshot["schema_version"] != Storage.SCHEMA_VERSION or snapshot["shard_key"] != snapshot_shard_key():
+        reason = "taken with another schema or shard layout"
+    elif snapshot["generation"] != storage.executor.call(storage.read_generation):
+        reason = "the database changed since"
+    elif not snapshot["complete"] and not storage.bounded:
+        reason = "partial, and the caches are unbounded"
+    else:
+        reason = None
+    if reason:
+        print(f"Ignoring state snapshot {filename}: {reason}.")
+        return False
+
+    storage.restore(snapshot["settings"], snapshot["categories"], snapshot["owners"],
+                    snapshot["command_channels"], snapshot["complete"])
+    for guild_id, categories in snapshot["occupancy"].items():
+        occupancy = CategoryOccupancy()
+        for category_id, channel_ids in categories.items():
+            occupancy.add_category(category_id, channel_ids)
+        category_occupancy[guild_id] = occupancy
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"Restored {len(snapshot['settings'])} guild settings, {len(snapshot['owners'])} owners and "
+          f"{len(snapshot['occupancy'])} guilds' categories from {filename} in {elapsed:.1f}ms.")
+    return True
+
+
+async def snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await save_state_snapshot(snapshot_file)
+        except Exception:
+            traceback.print_exc()
+
+
+def is_quiet():
+    return not any(voice_pipeline.queue_depths().values()) and action_scheduler.queue_depth() < 10
+
+
+async def maintenance_loop():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            await database_maintenance.checkpoint()
+            # Waits for a quiet moment inside the window, tries again next tick.
+            if database_maintenance.due() and is_quiet():
+                database_maintenance.mark_done()
+                await database_maintenance.run()
+        except Exception:
+            traceback.print_exc()
+
+
+async def reconcile_loop():
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            await reconcile_all()
+        except Exception:
+            traceback.print_exc()
+
+
+voice_pipeline = GuildEventPipeline(handle_voice_state_updates)
+channel_reaper = ChannelReaper()
+category_autoscaler = CategoryAutoscaler()
+admission_queue = AdmissionQueue()
+voice_channel_pool = VoiceChannelPool()
+action_scheduler = ActionScheduler()
+
+
+@client.event
+@metrics.timed("on_voice_state_update")
+async def on_voice_state_update(
+        member: discord.Member,
+        before: discord.VoiceState,
+        after: discord.VoiceState):
+    if event_recorder:
+        event_recorder.voice(member, before, after)
+
+    voice_pipeline.submit(member.guild.id, (member, before, after))
+
+
+event_recorder: Optional[EventRecorder] = None
+database_maintenance: Optional[DatabaseMaintenance] = None
+slow_handler_profiler: Optional[SlowHandlerProfiler] = None
+snapshot_file: Optional[str] = None
+
+def shard_for_guild(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+
+def owns_guild(guild_id):
+    return SHARD_IDS is None or shard_for_guild(guild_id, SHARD_COUNT) in SHARD_IDS
+
+
+def worker_environment(index, shard_ids, shard_count):
+    environment = dict(os.environ)
+    environment.update({
+        'PARTYBOT_WORKERS': '1',
+        'PARTYBOT_SHARD_COUNT': str(shard_count),
+        'PARTYBOT_SHARD_IDS': ",".join(map(str, shard_ids)),
+    })
+    # Per-process outputs get the worker index so workers don't clobber each other.
+    if METRICS_PORT:
+        environment['PARTYBOT_METRICS_PORT'] = str(METRICS_PORT + index)
+    if METRICS_FILE:
+        environment['PARTYBOT_METRICS_FILE'] = f"{METRICS_FILE}.{index}"
+    if TRACE_FILE:
+        environment['PARTYBOT_TRACE_FILE'] = f"{TRACE_FILE}.{index}"
+    if PROFILE_FILE:
+        environment['PARTYBOT_PROFILE_FILE'] = f"{PROFILE_FILE}.{index}"
+    return environment
+
+
+def supervise(workers, shard_count, filename):
+    # Shards are dealt round-robin, worker i runs shards i, i + workers, ...
+    workers = max(1, min(workers, shard_count))
+    assignments = [list(range(index, shard_count, workers)) for index in range(workers)]
+
+    # Upgrade the schema once up front rather than in every worker at once.
+    Storage(filename).close()
+
+    processes: Dict[int, subprocess.Popen] = {}
+    started: Dict[int, float] = {}
+    restart_at: Dict[int, float] = {}
+    delays = {index: SUPERVISOR_RESTART_DELAY for index in range(workers)}
+    stopping = False
+
+    def start(index):
+        processes[index] = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            env=worker_environment(index, assignments[index], shard_count))
+        started[index] = time.monotonic()
+        print(f"Supervisor started worker {index} (pid {processes[index].pid}) for shards {assignments[index]}.")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # Discord only lets a bot identify one shard at a time, so stagger the
+    # workers by how many shards the ones before them have to identify.
+    now = time.monotonic()
+    for index in range(workers):
+        restart_at[index] = now + sum(len(a) for a in assignments[:index]) * SUPERVISOR_IDENTIFY_INTERVAL
+
+    while not stopping:
+        now = time.monotonic()
+        for index in range(workers):
+            process = processes.get(index)
+            if process is not None and process.poll() is not None:
+                del processes[index]
+                # A worker that stayed up a while earns its backoff back.
+                if now - started[index] > SUPERVISOR_MAX_RESTART_DELAY:
+                    delays[index] = SUPERVISOR_RESTART_DELAY
+                restart_at[index] = now + delays[index]
+                print(f"Supervisor: worker {index} exited with {process.returncode}, "
+                      f"restarting in {delays[index]:g}s.")
+                delays[index] = min(delays[index] * 2, SUPERVISOR_MAX_RESTART_DELAY)
+            if index not in processes and restart_at.get(index, now) <= now:
+                restart_at.pop(index, None)
+                start(index)
+        time.sleep(0.5)
+
+    print("Supervisor stopping workers.")
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return 0
 
-            await storage.set_channel_owner(channel.id, member.id)
-            await member.move_to(channel, reason="PartyBot move user.")
 
 if __name__ == "__main__":
-    storage = Storage("partybot.db")
-    client.run(TOKEN)
+    if WORKERS > 1 and SHARD_IDS is None:
+        sys.exit(supervise(WORKERS, SHARD_COUNT or WORKERS, "partybot.db"))
+
+    storage = Storage("partybot.db", write_behind=WRITE_BEHIND, guild_filter=owns_guild if SHARD_IDS else None)
+    snapshot_file = snapshot_filename() if SNAPSHOT_FILE else None
+    if not (snapshot_file and restore_state_snapshot(snapshot_file)):
+        storage.load_all()
+    # Shard workers share the file, one of them looks after it.
+    if SHARD_IDS is None or 0 in SHARD_IDS:
+        database_maintenance = DatabaseMaintenance("partybot.db")
+    if TRACE_FILE:
+        event_recorder = EventRecorder(TRACE_FILE)
+    if PROFILE_THRESHOLD:
+        slow_handler_profiler = SlowHandlerProfiler()
+        slow_handler_profiler.install()
+    try:
+        client.run(TOKEN)
+    finally:
+        if event_recorder:
+            event_recorder.close()
+        if slow_handler_profiler:
+            slow_handler_profiler.close()
+        if database_maintenance:
+            database_maintenance.close()
+        if snapshot_file:
+            try:
+                save_state_snapshot_sync(snapshot_file)
+            except Exception:
+                traceback.print_exc()
+        storage.close()
+        if METRICS_FILE:
+            write_metrics_snapshot(METRICS_FILE)
@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from typing import *
+
+# Offline load simulation: drives partybot's handlers against the fake guilds
+# in partybot_fakes.py and a temporary SQLite file, then reports per-event
+# latency percentiles, DB operations per event and REST calls per event.
+#
+#   python partybot_bench.py --guilds 4 --members 2000 --pool-size 20
+#   python partybot_bench.py --json bench.json --max-p99-ms 50
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline PartyBot load simulation.")
+    parser.add_argument("--guilds", type=int, default=1)
+    parser.add_argument("--members", type=int, default=1000, help="members per guild")
+    parser.add_argument("--max-categories", type=int, default=10)
+    parser.add_argument("--pool-size", type=int, default=0)
+    parser.add_argument("--category-policy", default="fill_first")
+    parser.add_argument("--join-rate", type=float, default=0,
+                        help="joins per second per guild, 0 sends everyone at once")
+    parser.add_argument("--messages-per-member", type=int, default=2)
+    parser.add_argument("--churn", type=float, default=0.2,
+                        help="fraction of members that drop and rejoin their room")
+    parser.add_argument("--rest-latency-ms", type=float, default=0)
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the scheduler's real rate budgets instead of lifting them")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--record", help="write the simulated events as a trace for partybot_replay.py")
+    parser.add_argument("--metrics", help="write partybot's Prometheus-format metrics to this file afterwards")
+    parser.add_argument("--max-p99-ms", type=float,
+                        help="exit non-zero if any event type's p99 latency is above this")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    # partybot reads its tunables at import time.
+    os.environ.setdefault("PARTYBOT_REAPER_GRACE", "0.2")
+    os.environ.setdefault("PARTYBOT_REAPER_INTERVAL", "0.05")
+    os.environ.setdefault("PARTYBOT_POOL_REFILL_INTERVAL", "0.5")
+    os.environ.setdefault("PARTYBOT_PIPELINE_BACKLOG_WARNING", "0")
+    if not args.rate_limits:
+        for name in ("PARTYBOT_SCHEDULER_GUILD_RATE", "PARTYBOT_SCHEDULER_GUILD_BURST",
+                     "PARTYBOT_SCHEDULER_GLOBAL_RATE", "PARTYBOT_SCHEDULER_GLOBAL_BURST"):
+            os.environ.setdefault(name, "1000000")
+
+
+class Benchmark:
+    def __init__(self, args, partybot, fakes):
+        self.args = args
+        self.partybot = partybot
+        self.fakes = fakes
+        self.random = random.Random(args.seed)
+        self.latencies: Dict[str, List[float]] = collections.defaultdict(list)
+        self.phases: Dict[str, float] = {}
+        self._dispatched: Dict[int, Tuple[str, float]] = {}
+        self.events = 0
+
+    def instrument(self):
+        partybot = self.partybot
+        on_voice_state_update = partybot.on_voice_state_update
+        handler = partybot.voice_pipeline.handler
+
+        async def timed_on_voice_state_update(member, before, after):
+            guild = member.guild
+            if after.channel is None:
+                kind = "voice.leave"
+            elif after.channel.id == guild.join_channel.id:
+                kind = "voice.join"
+            else:
+                kind = "voice.move"
+            self._dispatched[id(after)] = (kind, time.perf_counter())
+            self.events += 1
+            await on_voice_state_update(member, before, after)
+
+        async def timed_handler(guild_id, events):
+            await handler(guild_id, events)
+            now = time.perf_counter()
+            for event in events:
+                if isinstance(event, tuple):
+                    kind, start = self._dispatched.pop(id(event[2]), (None, None))
+                    if kind:
+                        self.latencies[kind].append(now - start)
+
+        partybot.on_voice_state_update = timed_on_voice_state_update
+        partybot.voice_pipeline.handler = timed_handler
+
+    async def send_message(self, author, channel, content, kind):
+        message = self.fakes.FakeMessage(author, channel, content)
+        self.events += 1
+        start = time.perf_counter()
+        await self.partybot.on_message(message)
+        self.latencies[kind].append(time.perf_counter() - start)
+
+    async def settle(self, reap=False):
+        partybot = self.partybot
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline:
+            await self.client.join()
+            await partybot.voice_pipeline.join()
+            if not self.client.pending and not partybot.voice_pipeline.workers and \
+                    partybot.action_scheduler.idle() and \
+                    not partybot.voice_channel_pool.refilling and not (reap and partybot.channel_reaper.marked):
+                return
+            await asyncio.sleep(0.01)
+        print("Timed out waiting for the bot to settle.", file=sys.stderr)
+
+    async def phase(self, name, coroutine, reap=False):
+        start = time.perf_counter()
+        await coroutine
+        await self.settle(reap)
+        self.phases[name] = time.perf_counter() - start
+
+    async def join_wave(self, guild):
+        members = [m for m in guild.members.values() if not m.bot and m.name.startswith("member")]
+        delay = 1 / self.args.join_rate if self.args.join_rate else 0
+        for member in members:
+            member.connect(guild.join_channel)
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def chatter(self, guild):
+        members = [m for m in guild.members.values() if not m.bot]
+        for _ in range(self.args.messages_per_member):
+            for member in members:
+                roll = self.random.random()
+                if roll < 0.1:
+                    command = self.random.choice(("lock", "unlock"))
+                    await self.send_message(member, guild.command_channel, f"!pb {command}", "message.command")
+                elif roll < 0.15:
+                    await self.send_message(member, guild.command_channel, "where is my room?", "message.command_channel")
+                else:
+                    await self.send_message(member, guild.chat_channel, "hello there", "message.chat")
+        admin = next(m for m in members if m.name == "admin")
+        await self.send_message(admin, guild.chat_channel, "!pb settings", "message.command")
+
+    async def churn(self, guild):
+        rooms = [(m, m.voice.channel) for m in guild.members.values()
+                 if m.voice and m.voice.channel and m.voice.channel.id != guild.join_channel.id]
+        churned = self.random.sample(rooms, int(len(rooms) * self.args.churn))
+        for member, _ in churned:
+            member.connect(None)
+        await asyncio.sleep(0)
+        for member, room in churned:
+            member.connect(room)
+
+    async def leave_wave(self, guild):
+        for member in list(guild.members.values()):
+            if member.voice:
+                member.connect(None)
+
+    async def run(self):
+        args = self.args
+        partybot = self.partybot
+        fakes = self.fakes
+
+        directory = tempfile.mkdtemp(prefix="partybot-bench-")
+        storage = partybot.Storage(os.path.join(directory, "partybot.db"), write_behind=args.write_behind)
+        storage.load_all()
+        self.client = fakes.FakeClient(partybot, rest_latency=args.rest_latency_ms / 1000)
+        partybot.storage = storage
+        partybot.client = self.client
+
+        guilds = [fakes.build_party_guild(self.client, args.members, f"guild{i}") for i in range(args.guilds)]
+        for guild in guilds:
+            await storage.set_party_bot_guild_settings(partybot.PartyBotGuildSettings(
+                guild.id,
+                guild.join_channel.id,
+                guild.command_channel.id,
+                guild.main_category.id,
+                guild.moderator_role.id,
+                guild.manager_role.id,
+                True,
+                args.max_categories,
+                args.pool_size,
+                args.category_policy
+            ))
+            if args.pool_size:
+                partybot.voice_pipeline.submit(guild.id, partybot.POOL_REFILL)
+        await self.settle()
+
+        if args.record:
+            partybot.event_recorder = partybot.EventRecorder(args.record)
+        self.instrument()
+        partybot.start_background_tasks()
+        db_operations = storage.executor.operations
+        # Setup and pool warm-up aren't part of the run.
+        rest_calls = collections.Counter(self.client.rest_calls)
+        start = time.perf_counter()
+
+        await self.phase("join", asyncio.gather(*(self.join_wave(guild) for guild in guilds)))
+        await self.phase("chat", asyncio.gather(*(self.chatter(guild) for guild in guilds)))
+        await self.phase("churn", asyncio.gather(*(self.churn(guild) for guild in guilds)), reap=True)
+        await self.phase("leave", asyncio.gather(*(self.leave_wave(guild) for guild in guilds)), reap=True)
+
+        elapsed = time.perf_counter() - start
+        for task in partybot.background_tasks:
+            task.cancel()
+        await storage.flush()
+        if partybot.event_recorder:
+            partybot.event_recorder.close()
+        db_operations = storage.executor.operations - db_operations
+        rest_calls = self.client.rest_calls - rest_calls
+        if args.metrics:
+            partybot.write_metrics_snapshot(args.metrics)
+        storage.close()
+
+        return {
+            "elapsed": elapsed,
+            "events": self.events,
+            "phases": self.phases,
+            "latency_ms": {
+                kind: {
+                    "count": len(values),
+                    "p50": percentile(values, 50) * 1000,
+                    "p90": percentile(values, 90) * 1000,
+                    "p99": percentile(values, 99) * 1000,
+                    "max": max(values) * 1000,
+                }
+                for kind, values in sorted(self.latencies.items())
+            },
+            "db_operations": db_operations,
+            "db_operations_per_event": db_operations / max(1, self.events),
+            "rest_calls": dict(rest_calls),
+            "rest_calls_per_event": sum(rest_calls.values()) / max(1, self.events),
+            "unplaced_members": sum(
+                1 for guild in guilds for member in guild.members.values()
+                if member.voice and member.voice.channel is guild.join_channel),
+        }
+
+
+def print_report(report):
+    print(f"{report['events']} events in {report['elapsed']:.2f}s "
+          f"({', '.join(f'{name} {seconds:.2f}s' for name, seconds in report['phases'].items())})")
+    print(f"{'event':<28}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, latency in report["latency_ms"].items():
+        print(f"{kind:<28}{latency['count']:>8}{latency['p50']:>10.2f}{latency['p90']:>10.2f}"
+              f"{latency['p99']:>10.2f}{latency['max']:>10.2f}")
+    print(f"DB operations: {report['db_operations']} ({report['db_operations_per_event']:.3f} per event)")
+    print(f"REST calls: {sum(report['rest_calls'].values())} ({report['rest_calls_per_event']:.3f} per event) "
+          f"{json.dumps(report['rest_calls'], sort_keys=True)}")
+    if report["unplaced_members"]:
+        print(f"{report['unplaced_members']} members were left in a join channel.")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment(args)
+
+    import partybot
+    import partybot_fakes
+
+    report = asyncio.run(Benchmark(args, partybot, partybot_fakes).run())
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+
+    if args.max_p99_ms is not None:
+        slow = [kind for kind, latency in report["latency_ms"].items() if latency["p99"] > args.max_p99_ms]
+        if slow:
+            print(f"p99 over {args.max_p99_ms}ms: {', '.join(slow)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
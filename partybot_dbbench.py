@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from typing import *
+
+# Times partybot's storage lookups on a database with the schema as it was
+# before versioned migrations, upgrades that file in place with Storage, and
+# times the same lookups again.
+#
+#   python partybot_dbbench.py --owners 100000 --guilds 2000 --lookups 20000
+
+# The tables as the first releases created them, without any indexes.
+LEGACY_SCHEMA = (
+    """
+CREATE TABLE partybot(
+    guild_id INTEGER PRIMARY KEY,
+    join_here_channel_id INTEGER,
+    command_channel_id INTEGER,
+    main_category_id INTEGER,
+    moderator_role_id INTEGER,
+    manage_role_id INTEGER,
+    dynamic_category_creation BOOL,
+    max_categories INTEGER
+)
+""",
+    """
+CREATE TABLE partybot_categories(
+    category_id INTEGER PRIMARY KEY,
+    guild_id INTEGER
+)
+""",
+    """
+CREATE TABLE partybot_owners(
+    channel_id INTEGER PRIMARY KEY,
+    user_id INTEGER
+)
+""",
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PartyBot schema lookup benchmark.")
+    parser.add_argument("--owners", type=int, default=100000)
+    parser.add_argument("--guilds", type=int, default=2000)
+    parser.add_argument("--categories-per-guild", type=int, default=5)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", help="leave the database at this path instead of a temporary file")
+    parser.add_argument("--json", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def build_legacy_database(filename, args, rng):
+    connection = sqlite3.connect(filename)
+    for query in LEGACY_SCHEMA:
+        connection.execute(query)
+
+    guild_ids = [(1 << 40) + i for i in range(args.guilds)]
+    connection.executemany(
+        "INSERT INTO partybot VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(guild_id, guild_id + 1, guild_id + 2, guild_id + 3, guild_id + 4, guild_id + 5, True, 10)
+         for guild_id in guild_ids])
+    connection.executemany(
+        "INSERT INTO partybot_categories VALUES (?, ?)",
+        [((2 << 40) + i * args.categories_per_guild + j, guild_id)
+         for i, guild_id in enumerate(guild_ids) for j in range(args.categories_per_guild)])
+    user_ids = rng.sample(range(3 << 40, (3 << 40) + args.owners * 10), args.owners)
+    connection.executemany(
+        "INSERT INTO partybot_owners VALUES (?, ?)",
+        [((4 << 40) + i, user_id) for i, user_id in enumerate(user_ids)])
+    connection.commit()
+    connection.close()
+    return guild_ids, user_ids
+
+
+def time_lookups(filename, queries, args, rng):
+    connection = sqlite3.connect(filename)
+    results = {}
+    for name, (query, keys) in queries.items():
+        sample = [(rng.choice(keys),) for _ in range(args.lookups)]
+        cursor = connection.cursor()
+        start = time.perf_counter()
+        for params in sample:
+            cursor.execute(query, params).fetchall()
+        elapsed = time.perf_counter() - start
+        plan = [row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + query, sample[0]).fetchall()]
+        results[name] = {"us_per_lookup": elapsed / args.lookups * 1e6, "plan": "; ".join(plan)}
+    connection.close()
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    import partybot
+
+    filename = args.keep or os.path.join(tempfile.mkdtemp(prefix="partybot-dbbench-"), "partybot.db")
+    if os.path.exists(filename):
+        print(f"{filename} already exists.", file=sys.stderr)
+        return 1
+
+    guild_ids, user_ids = build_legacy_database(filename, args, rng)
+    channel_ids = [(4 << 40) + i for i in range(args.owners)]
+    queries = {
+        "owner channel by user_id": (partybot.Storage.PARTYBOT_SELECT_OWNER_CHANNEL_QUERY, user_ids),
+        "channel owner by channel_id": (partybot.Storage.PARTYBOT_SELECT_CHANNEL_OWNER_QUERY, channel_ids),
+        "categories by guild_id": (partybot.Storage.PARTYBOT_SELECT_CATEGORIES_QUERY, guild_ids),
+    }
+
+    before = time_lookups(filename, queries, args, random.Random(args.seed))
+    start = time.perf_counter()
+    partybot.Storage(filename).close()
+    migration_seconds = time.perf_counter() - start
+    after = time_lookups(filename, queries, args, random.Random(args.seed))
+
+    print(f"{args.owners} owners, {args.guilds} guilds, {args.guilds * args.categories_per_guild} categories, "
+          f"{args.lookups} lookups per query; migrated in {migration_seconds * 1000:.1f}ms.")
+    print(f"{'lookup':<30}{'before us':>12}{'after us':>12}{'speedup':>10}")
+    for name in queries:
+        speedup = before[name]["us_per_lookup"] / max(after[name]["us_per_lookup"], 1e-9)
+        print(f"{name:<30}{before[name]['us_per_lookup']:>12.2f}{after[name]['us_per_lookup']:>12.2f}"
+              f"{speedup:>9.1f}x")
+    for name in queries:
+        print(f"{name}: {before[name]['plan']} -> {after[name]['plan']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"before": before, "after": after, "migration_seconds": migration_seconds},
+                      f, indent=4, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+import asyncio
+import collections
+import itertools
+import time
+import discord
+
+from typing import *
+
+# In-process stand-ins for the parts of discord.py partybot touches, so the
+# handlers can be driven offline by partybot_bench.py and partybot_replay.py.
+# REST-like methods count themselves on the guild and can sleep for a
+# simulated round trip; gateway events they would cause are dispatched to
+# the partybot module as tasks, the way they'd arrive from the websocket.
+
+# Ids are real-looking snowflakes for "now", so fakes made during a replay
+# never collide with ids recorded in an earlier trace.
+DISCORD_EPOCH = 1420070400000
+_snowflakes = itertools.count((int(time.time() * 1000) - DISCORD_EPOCH) << 22)
+
+
+def next_id():
+    return next(_snowflakes)
+
+
+class FakeVoiceState:
+    def __init__(self, channel=None):
+        self.channel = channel
+
+
+class FakeRole:
+    def __init__(self, guild, name, id=None, administrator=False):
+        self.id = id or next_id()
+        self.guild = guild
+        self.name = name
+        self.permissions = discord.Permissions.all() if administrator else discord.Permissions.none()
+
+    def __repr__(self):
+        return f"<FakeRole {self.name} {self.id}>"
+
+
+class FakeChannel:
+    type: discord.ChannelType
+
+    def __init__(self, guild, name, id=None, category=None, position=0):
+        self.id = id or next_id()
+        self.guild = guild
+        self.name = name
+        self.category_id = category.id if category else None
+        self.position = position
+
+    @property
+    def category(self):
+        return self.guild.get_channel(self.category_id)
+
+    def permissions_for(self, member):
+        return discord.Permissions.all()
+
+    async def delete(self, reason=None):
+        await self.guild.rest("channel.delete")
+        if self.guild.channels.pop(self.id, None) is None:
+            raise FakeNotFound()
+        self.guild.client.dispatch("on_guild_channel_delete", self)
+
+    async def edit(self, **kwargs):
+        await self.guild.rest("channel.edit")
+        before = self.snapshot()
+        for name, value in kwargs.items():
+            if name == "category":
+                self.category_id = value.id if value else None
+            else:
+                setattr(self, name, value)
+        self.guild.client.dispatch("on_guild_channel_update", before, self)
+
+    def snapshot(self):
+        copy = object.__new__(type(self))
+        copy.__dict__.update(self.__dict__)
+        return copy
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name} {self.id}>"
+
+
+class FakeCategoryChannel(FakeChannel):
+    type = discord.ChannelType.category
+
+    @property
+    def channels(self):
+        return [channel for channel in self.guild.channels.values() if channel.category_id == self.id]
+
+    async def create_voice_channel(self, name, **kwargs):
+        return await self.guild.create_voice_channel(name, category=self, **kwargs)
+
+
+class FakeVoiceChannel(FakeChannel):
+    type = discord.ChannelType.voice
+
+    def __init__(self, guild, name, bitrate=64000, user_limit=0, **kwargs):
+        super().__init__(guild, name, **kwargs)
+        self.bitrate = bitrate
+        self.user_limit = user_limit
+        self.voice_members: Dict[int, "FakeMember"] = {}
+
+    @property
+    def members(self):
+        return list(self.voice_members.values())
+
+    @property
+    def voice_states(self):
+        return {member_id: member.voice for member_id, member in self.voice_members.items()}
+
+
+class FakeTextChannel(FakeChannel):
+    type = discord.ChannelType.text
+
+    async def send(self, content=None):
+        await self.guild.rest("message.send")
+        message = FakeMessage(self.guild.me, self, content)
+        self.guild.sent.append(content)
+        return message
+
+
+class FakeMember:
+    def __init__(self, guild, name="member", id=None, roles=(), administrator=False, bot=False):
+        self.id = id or next_id()
+        self.guild = guild
+        self.name = name
+        self.roles = list(roles)
+        self.administrator = administrator
+        self.bot = bot
+        self.voice: Optional[FakeVoiceState] = None
+
+    @property
+    def guild_permissions(self):
+        if self.administrator or any(role.permissions.administrator for role in self.roles):
+            return discord.Permissions.all()
+        return discord.Permissions.none()
+
+    def permissions_in(self, channel):
+        return self.guild_permissions
+
+    def _set_voice(self, channel):
+        before = FakeVoiceState(self.voice.channel if self.voice else None)
+        if before.channel is not None:
+            before.channel.voice_members.pop(self.id, None)
+        if channel is not None:
+            channel.voice_members[self.id] = self
+        self.voice = FakeVoiceState(channel) if channel else None
+        return before, FakeVoiceState(channel)
+
+    def connect(self, channel):
+        # A client-side join or leave: no REST call, just the gateway event.
+        before, after = self._set_voice(channel)
+        return self.guild.client.dispatch("on_voice_state_update", self, before, after)
+
+    async def move_to(self, channel, reason=None):
+        await self.guild.rest("member.move")
+        before, after = self._set_voice(channel)
+        self.guild.client.dispatch("on_voice_state_update", self, before, after)
+
+    def __repr__(self):
+        return f"<FakeMember {self.name} {self.id}>"
+
+
+class FakeMessage:
+    def __init__(self, author, channel, content, id=None):
+        self.id = id or next_id()
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+
+    async def delete(self):
+        await self.guild.rest("message.delete")
+
+    async def edit(self, content=None):
+        await self.guild.rest("message.edit")
+        self.content = content
+
+
+class FakeNotFound(discord.NotFound):
+    def __init__(self):
+        Exception.__init__(self, "404 Not Found (fake)")
+
+
+class FakeHTTPException(discord.HTTPException):
+    def __init__(self, text="400 Bad Request (fake)"):
+        Exception.__init__(self, text)
+
+
+class FakeGuild:
+    def __init__(self, client, name="guild", id=None):
+        self.id = id or next_id()
+        self.client = client
+        self.name = name
+        self.channels: Dict[int, FakeChannel] = {}
+        self.members: Dict[int, FakeMember] = {}
+        self.roles: Dict[int, FakeRole] = {}
+        self.rest_calls: Counter = collections.Counter()
+        self.sent: List[str] = []
+        self.me = self.add_member(FakeMember(self, "PartyBot", id=client.user.id, administrator=True, bot=True))
+        client.guilds.append(self)
+
+    async def rest(self, route):
+        self.rest_calls[route] += 1
+        self.client.rest_calls[route] += 1
+        await asyncio.sleep(self.client.rest_latency)
+
+    def add_channel(self, channel):
+        self.channels[channel.id] = channel
+        return channel
+
+    def add_member(self, member):
+        self.members[member.id] = member
+        return member
+
+    def add_role(self, role):
+        self.roles[role.id] = role
+        return role
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    async def fetch_member(self, member_id):
+        await self.rest("member.fetch")
+        member = self.members.get(member_id)
+        if member is None:
+            raise FakeNotFound()
+        return member
+
+    async def create_category(self, name, position=0, reason=None):
+        await self.rest("category.create")
+        category = self.add_channel(FakeCategoryChannel(self, name, position=position))
+        self.client.dispatch("on_guild_channel_create", category)
+        return category
+
+    async def create_voice_channel(self, name, category=None, bitrate=64000, user_limit=0, reason=None):
+        await self.rest("channel.create")
+        channel = self.add_channel(FakeVoiceChannel(
+            self, name, category=category, bitrate=bitrate, user_limit=user_limit))
+        self.client.dispatch("on_guild_channel_create", channel)
+        return channel
+
+
+class FakeClient:
+    def __init__(self, module, rest_latency=0.0):
+        self.module = module
+        self.rest_latency = rest_latency
+        self.user = FakeMember.__new__(FakeMember)
+        self.user.id = next_id()
+        self.user.name = "PartyBot"
+        self.guilds: List[FakeGuild] = []
+        self.rest_calls: Counter = collections.Counter()
+        self.pending: Set[asyncio.Future] = set()
+
+    def get_guild(self, guild_id):
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def get_channel(self, channel_id):
+        for guild in self.guilds:
+            channel = guild.get_channel(channel_id)
+            if channel:
+                return channel
+        return None
+
+    def dispatch(self, event, *args):
+        handler = getattr(self.module, event, None)
+        if handler is None:
+            return None
+        task = asyncio.ensure_future(handler(*args))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return task
+
+    async def join(self):
+        while self.pending:
+            await asyncio.wait(list(self.pending))
+
+
+def build_party_guild(client, members=0, name="guild"):
+    # A guild laid out the way partybot expects after setup: a main category
+    # holding the join channel, a command channel and a chat channel.
+    guild = FakeGuild(client, name)
+    manager = guild.add_role(FakeRole(guild, "PartyBot Manager"))
+    moderator = guild.add_role(FakeRole(guild, "PartyBot Moderator"))
+    main_category = guild.add_channel(FakeCategoryChannel(guild, "Party Rooms"))
+    join_channel = guild.add_channel(FakeVoiceChannel(
+        guild, "Join Here", category=main_category, bitrate=64000, user_limit=4))
+    command_channel = guild.add_channel(FakeTextChannel(guild, "partybot-commands"))
+    chat_channel = guild.add_channel(FakeTextChannel(guild, "general"))
+    guild.add_member(FakeMember(guild, "admin", roles=[manager], administrator=True))
+    for i in range(members):
+        guild.add_member(FakeMember(guild, f"member{i}"))
+
+    guild.manager_role = manager
+    guild.moderator_role = moderator
+    guild.main_category = main_category
+    guild.join_channel = join_channel
+    guild.command_channel = command_channel
+    guild.chat_channel = chat_channel
+    return guild
@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import copy
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import tempfile
+import time
+
+from typing import *
+
+# Replays a trace written by partybot's EventRecorder (PARTYBOT_TRACE_FILE)
+# against the fake Discord objects in partybot_fakes.py, optionally under
+# cProfile and a stack sampler, so production-shaped load can be profiled
+# offline. The profiler slows the replayed bot down, so a speed below 1 keeps
+# it ahead of the recorded leaves the way the live bot was.
+#
+#   python partybot_replay.py trace.jsonl --speed 10 --profile replay.prof --collapsed replay.folded
+#   python partybot_replay.py trace.jsonl --slow-ms 50 --slow-file replay-slow.jsonl
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a PartyBot event trace offline.")
+    parser.add_argument("trace")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="1 replays in real time, 10 ten times faster, 0 as fast as possible")
+    parser.add_argument("--rest-latency-ms", type=float, default=0)
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the scheduler's real rate budgets instead of lifting them")
+    parser.add_argument("--profile", help="write cProfile stats to this file")
+    parser.add_argument("--collapsed", help="write sampled collapsed stacks (flamegraph input) to this file")
+    parser.add_argument("--sample-interval-ms", type=float, default=1)
+    parser.add_argument("--slow-ms", type=float,
+                        help="run partybot's slow-handler profiler with this threshold")
+    parser.add_argument("--slow-file", default="replay-slow.jsonl", help="where the slow-handler profiler writes")
+    parser.add_argument("--top", type=int, default=25, help="functions to print from the profile")
+    parser.add_argument("--timeout", type=float, default=120)
+    return parser.parse_args(argv)
+
+
+def read_trace(filename):
+    with open(filename, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class Replayer:
+    def __init__(self, args, partybot, fakes):
+        self.args = args
+        self.partybot = partybot
+        self.fakes = fakes
+        self.client = fakes.FakeClient(partybot, rest_latency=args.rest_latency_ms / 1000)
+        # Recorded ids of rooms the live bot created, mapped to the rooms the
+        # replayed bot created for the same member.
+        self.rooms: Dict[int, Any] = {}
+        self.replayed = 0
+        self.skipped = 0
+
+    def guild(self, guild_id):
+        guild = self.client.get_guild(guild_id)
+        if guild is None:
+            guild = self.fakes.FakeGuild(self.client, str(guild_id), id=guild_id)
+        return guild
+
+    def member(self, guild, member_id, administrator=False, role_ids=None):
+        member = guild.get_member(member_id)
+        if member is None:
+            member = guild.add_member(self.fakes.FakeMember(
+                guild, str(member_id), id=member_id, administrator=administrator))
+        if role_ids is not None:
+            # Manager and moderator roles decide which command paths run.
+            roles = [self.role(guild, role_id) for role_id in role_ids]
+            if roles != member.roles:
+                before = copy.copy(member)
+                member.roles = roles
+                self.client.dispatch("on_member_update", before, member)
+        return member
+
+    def role(self, guild, role_id):
+        role = guild.get_role(role_id)
+        if role is None:
+            role = guild.add_role(self.fakes.FakeRole(guild, str(role_id), id=role_id))
+        return role
+
+    def category(self, guild, category_id):
+        if category_id is None:
+            return None
+        category = guild.get_channel(category_id)
+        if category is None:
+            category = guild.add_channel(self.fakes.FakeCategoryChannel(guild, str(category_id), id=category_id))
+        return category
+
+    def voice_channel(self, guild, channel_id, category_id=None, **kwargs):
+        channel = self.rooms.get(channel_id) or guild.get_channel(channel_id)
+        if channel is None:
+            channel = guild.add_channel(self.fakes.FakeVoiceChannel(
+                guild, str(channel_id), id=channel_id, category=self.category(guild, category_id), **kwargs))
+        return channel
+
+    def text_channel(self, guild, channel_id):
+        channel = guild.get_channel(channel_id)
+        if channel is None:
+            channel = guild.add_channel(self.fakes.FakeTextChannel(guild, str(channel_id), id=channel_id))
+        return channel
+
+    async def apply_guild(self, record):
+        guild = self.guild(record["g"])
+        if not record["s"]:
+            return
+
+        guild_settings = self.partybot.PartyBotGuildSettings(*record["s"])
+        if guild_settings.main_category_id:
+            self.category(guild, guild_settings.main_category_id)
+        if guild_settings.join_channel_id:
+            self.voice_channel(guild, guild_settings.join_channel_id, guild_settings.main_category_id,
+                               bitrate=64000, user_limit=4)
+        if guild_settings.command_channel_id:
+            self.text_channel(guild, guild_settings.command_channel_id)
+        for role_id in (guild_settings.manage_role_id, guild_settings.moderator_role_id):
+            if role_id:
+                self.role(guild, role_id)
+        await self.partybot.storage.set_party_bot_guild_settings(guild_settings)
+
+    def apply_voice(self, record):
+        guild = self.guild(record["g"])
+        member = self.member(guild, record["u"])
+        guild_settings = self.partybot.storage.party_bot_guild_settings.get(guild.id)
+        join_channel_id = guild_settings.join_channel_id if guild_settings else None
+        before, after = record["b"], record["a"]
+
+        if after is None:
+            if member.voice:
+                member.connect(None)
+            return True
+
+        if after[0] == join_channel_id:
+            member.connect(self.voice_channel(guild, after[0], after[1]))
+            return True
+
+        if before and before[0] == join_channel_id:
+            # The live bot moved them into a room it made; the replayed bot
+            # does its own move, remember which room that was.
+            if member.voice and member.voice.channel and member.voice.channel.id != join_channel_id:
+                self.rooms[after[0]] = member.voice.channel
+            return False
+
+        member.connect(self.voice_channel(guild, after[0], after[1]))
+        return True
+
+    def apply_message(self, record):
+        guild = self.guild(record["g"])
+        author = self.member(guild, record["u"], record.get("a", False), record.get("r"))
+        channel = self.text_channel(guild, record["c"])
+        message = self.fakes.FakeMessage(author, channel, record["x"] or "...")
+        self.client.dispatch("on_message", message)
+        return True
+
+    def apply_delete(self, record):
+        guild = self.guild(record["g"])
+        channel = guild.get_channel(record["c"])
+        if channel is None or record["c"] in self.rooms:
+            # Rooms are created and deleted by the replayed bot itself.
+            return False
+        guild.channels.pop(channel.id, None)
+        self.client.dispatch("on_guild_channel_delete", channel)
+        return True
+
+    async def settle(self):
+        partybot = self.partybot
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline:
+            await self.client.join()
+            await partybot.voice_pipeline.join()
+            if not self.client.pending and not partybot.voice_pipeline.workers and \
+                    partybot.action_scheduler.idle() and \
+                    not partybot.voice_channel_pool.refilling:
+                return
+            await asyncio.sleep(0.01)
+        print("Timed out waiting for the bot to settle.", file=sys.stderr)
+
+    async def run(self):
+        partybot = self.partybot
+        directory = tempfile.mkdtemp(prefix="partybot-replay-")
+        storage = partybot.Storage(os.path.join(directory, "partybot.db"), write_behind=self.args.write_behind)
+        storage.load_all()
+        partybot.storage = storage
+        partybot.client = self.client
+        partybot.start_background_tasks()
+
+        db_operations = storage.executor.operations
+        start = time.monotonic()
+        for record in read_trace(self.args.trace):
+            # Yield even when behind schedule so the pipelines, scheduler and
+            # reaper get to run between events.
+            delay = start + record["t"] / self.args.speed - time.monotonic() if self.args.speed > 0 else 0
+            await asyncio.sleep(max(0, delay))
+
+            event = record["e"]
+            if event == "guild":
+                await self.apply_guild(record)
+                continue
+            elif event == "voice":
+                applied = self.apply_voice(record)
+            elif event == "message":
+                applied = self.apply_message(record)
+            elif event == "delete":
+                applied = self.apply_delete(record)
+            else:
+                applied = False
+
+            if applied:
+                self.replayed += 1
+            else:
+                self.skipped += 1
+
+        await self.settle()
+        elapsed = time.monotonic() - start
+        for task in partybot.background_tasks:
+            task.cancel()
+        await storage.flush()
+        db_operations = storage.executor.operations - db_operations
+        storage.close()
+
+        print(f"Replayed {self.replayed} events ({self.skipped} left to the replayed bot) in {elapsed:.2f}s.")
+        print(f"DB operations: {db_operations}, REST calls: {sum(self.client.rest_calls.values())} "
+              f"{json.dumps(dict(self.client.rest_calls), sort_keys=True)}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ.setdefault("PARTYBOT_PIPELINE_BACKLOG_WARNING", "0")
+    if not args.rate_limits:
+        for name in ("PARTYBOT_SCHEDULER_GUILD_RATE", "PARTYBOT_SCHEDULER_GUILD_BURST",
+                     "PARTYBOT_SCHEDULER_GLOBAL_RATE", "PARTYBOT_SCHEDULER_GLOBAL_BURST"):
+            os.environ.setdefault(name, "1000000")
+
+    import partybot
+    import partybot_fakes
+
+    replayer = Replayer(args, partybot, partybot_fakes)
+    if args.slow_ms:
+        partybot.slow_handler_profiler = partybot.SlowHandlerProfiler(args.slow_ms / 1000, args.slow_file)
+        partybot.slow_handler_profiler.install()
+    profile = cProfile.Profile()
+    sampler = partybot.StackSampler(interval=args.sample_interval_ms / 1000) if args.collapsed else None
+
+    if sampler:
+        sampler.start()
+    profile.enable()
+    try:
+        asyncio.run(replayer.run())
+    finally:
+        profile.disable()
+        if sampler:
+            sampler.stop()
+        if partybot.slow_handler_profiler:
+            partybot.slow_handler_profiler.close()
+
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(args.top)
+    print(stream.getvalue())
+
+    if args.profile:
+        profile.dump_stats(args.profile)
+        print(f"cProfile stats written to {args.profile}.")
+    if sampler:
+        sampler.write_collapsed(args.collapsed)
+        print(f"{sampler.samples} stack samples written to {args.collapsed}.")
+    if partybot.slow_handler_profiler:
+        print(f"{partybot.slow_handler_profiler.slow} slow handlers and {partybot.slow_handler_profiler.stalls} "
+              f"loop stalls written to {args.slow_file}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+import partybot_fakes
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = partybot.TokenBucket(rate=10, capacity=2)
+        self.assertEqual(bucket.delay(), 0)
+        bucket.take()
+        bucket.take()
+        self.assertAlmostEqual(bucket.delay(), 0.1, places=2)
+        bucket.updated -= 0.1
+        self.assertEqual(bucket.delay(), 0)
+
+    def test_reserve_is_kept_back(self):
+        bucket = partybot.TokenBucket(rate=1, capacity=3)
+        self.assertEqual(bucket.delay(reserve=2), 0)
+        self.assertGreater(bucket.delay(reserve=3), 0)
+
+    def test_never_refills_past_capacity(self):
+        bucket = partybot.TokenBucket(rate=100, capacity=2)
+        bucket.updated -= 60
+        bucket.delay()
+        self.assertEqual(bucket.tokens, 2)
+
+
+class ActionSchedulerTest(unittest.TestCase):
+    def run_scheduler(self, test, workers=1):
+        async def _run():
+            scheduler = partybot.ActionScheduler(workers=workers)
+            try:
+                return await test(scheduler)
+            finally:
+                for worker in scheduler.workers:
+                    worker.cancel()
+
+        return asyncio.run(_run())
+
+    def action(self, ran, name, result=None):
+        async def _action():
+            ran.append(name)
+            return result
+        return _action
+
+    def test_runs_by_priority_then_arrival(self):
+        async def test(scheduler):
+            ran = []
+            futures = [
+                scheduler.submit(partybot.PRIORITY_DELETE, "delete", "guild:1", self.action(ran, "delete")),
+                scheduler.submit(partybot.PRIORITY_CREATE, "create", "guild:1", self.action(ran, "create 1")),
+                scheduler.submit(partybot.PRIORITY_MOVE, "move", "guild:1", self.action(ran, "move")),
+                scheduler.submit(partybot.PRIORITY_CREATE, "create", "guild:1", self.action(ran, "create 2")),
+            ]
+            await asyncio.gather(*futures)
+            return ran
+
+        self.assertEqual(self.run_scheduler(test), ["move", "create 1", "create 2", "delete"])
+
+    def test_same_key_merges_into_the_latest_action(self):
+        async def test(scheduler):
+            ran = []
+            first = scheduler.submit(partybot.PRIORITY_EDIT, "edit", "guild:1", self.action(ran, "old", 1), key="k")
+            second = scheduler.submit(partybot.PRIORITY_EDIT, "edit", "guild:1", self.action(ran, "new", 2), key="k")
+            self.assertIs(first, second)
+            self.assertEqual(await first, 2)
+            self.assertEqual(scheduler.stats["edit"]["merged"], 1)
+            return ran
+
+        self.assertEqual(self.run_scheduler(test), ["new"])
+
+    def test_actions_no_longer_needed_are_skipped(self):
+        async def test(scheduler):
+            ran = []
+            future = scheduler.submit(partybot.PRIORITY_EDIT, "edit", "guild:1", self.action(ran, "edit"),
+                                      still_needed=lambda: False)
+            self.assertIsNone(await future)
+            self.assertEqual(scheduler.stats["edit"]["skipped"], 1)
+            return ran
+
+        self.assertEqual(self.run_scheduler(test), [])
+
+    def test_not_found_only_satisfies_deletes(self):
+        async def missing():
+            raise partybot_fakes.FakeNotFound()
+
+        async def test(scheduler):
+            self.assertIsNone(await scheduler.submit(partybot.PRIORITY_DELETE, "delete", "guild:1", missing))
+            with self.assertRaises(partybot_fakes.FakeNotFound):
+                await scheduler.submit(partybot.PRIORITY_MOVE, "move", "guild:1", missing)
+
+        self.run_scheduler(test)
+
+    def test_failure_reaches_the_caller(self):
+        async def failing():
+            raise partybot_fakes.FakeHTTPException()
+
+        async def test(scheduler):
+            with self.assertRaises(partybot_fakes.FakeHTTPException):
+                await scheduler.submit(partybot.PRIORITY_MOVE, "move", "guild:1", failing)
+            self.assertEqual(scheduler.stats["move"]["failed"], 1)
+            self.assertTrue(scheduler.idle())
+
+        self.run_scheduler(test)
+
+
+if __name__ == "__main__":
+    unittest.main()
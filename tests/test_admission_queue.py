@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+
+
+class AdmissionQueueTest(unittest.TestCase):
+    def test_members_wait_in_arrival_order(self):
+        queue = partybot.AdmissionQueue(max_waiting=10, max_wait=60)
+        for member_id in (3, 1, 2):
+            self.assertTrue(queue.enqueue(1, member_id))
+        self.assertTrue(queue.enqueue(1, 1))
+        self.assertEqual(queue.members(1), [3, 1, 2])
+        self.assertEqual(queue.size(1), 3)
+        self.assertEqual(queue.queued, 3)
+        self.assertTrue(queue.contains(1, 2))
+        self.assertFalse(queue.contains(2, 2))
+        self.assertEqual(queue.members(2), [])
+
+    def test_full_queue_turns_members_away(self):
+        queue = partybot.AdmissionQueue(max_waiting=2, max_wait=60)
+        self.assertTrue(queue.enqueue(1, 10))
+        self.assertTrue(queue.enqueue(1, 11))
+        self.assertFalse(queue.enqueue(1, 12))
+        # Each guild has its own limit, and those already waiting stay in.
+        self.assertTrue(queue.enqueue(2, 12))
+        self.assertTrue(queue.enqueue(1, 11))
+        self.assertEqual(queue.members(1), [10, 11])
+
+    def test_nobody_waits_when_the_limit_is_zero(self):
+        queue = partybot.AdmissionQueue(max_waiting=0, max_wait=60)
+        self.assertFalse(queue.enqueue(1, 10))
+        self.assertNotIn(1, queue.waiting)
+
+    def test_remove_returns_the_time_waited(self):
+        queue = partybot.AdmissionQueue(max_waiting=10, max_wait=60)
+        queue.enqueue(1, 10)
+        queue.enqueue(1, 11)
+        queue.waiting[1][10] -= 5
+        self.assertGreaterEqual(queue.remove(1, 10), 5)
+        self.assertIsNone(queue.remove(1, 10))
+        self.assertIsNone(queue.remove(2, 11))
+        self.assertGreaterEqual(queue.remove(1, 11), 0)
+        self.assertNotIn(1, queue.waiting)
+
+    def test_overdue(self):
+        queue = partybot.AdmissionQueue(max_waiting=10, max_wait=60)
+        for member_id in (10, 11, 12):
+            queue.enqueue(1, member_id)
+        queue.waiting[1][10] -= 61
+        queue.waiting[1][12] -= 60
+        self.assertEqual(queue.overdue(1), [10, 12])
+        self.assertEqual(queue.overdue(2), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+import partybot_fakes
+
+
+class BulkProvisionerTest(unittest.TestCase):
+    def setUp(self):
+        partybot.category_occupancy.clear()
+        partybot.action_scheduler = partybot.ActionScheduler()
+
+    def tearDown(self):
+        partybot.category_occupancy.clear()
+
+    def test_headroom_counts_creates_the_gateway_has_not_shown(self):
+        async def _run():
+            client = partybot_fakes.FakeClient(partybot)
+            guild = partybot_fakes.build_party_guild(client)
+            category = guild.main_category
+            # The join channel is in there already; leave three free slots.
+            for _ in range(partybot.CHANNEL_LIMIT - 4):
+                guild.add_channel(partybot_fakes.FakeVoiceChannel(guild, "room", category=category))
+
+            # Creates return before the channel shows up in the guild cache.
+            unseen = []
+
+            async def create_voice_channel(name, category=None, **kwargs):
+                await asyncio.sleep(0.001)
+                channel = partybot_fakes.FakeVoiceChannel(guild, name, category=category)
+                unseen.append(channel)
+                return channel
+            guild.create_voice_channel = create_voice_channel
+
+            provisioner = partybot.BulkProvisioner(concurrency=2)
+            run = provisioner.plan(guild, [category.id])
+            self.assertEqual(run.total, 3)
+            # More than fits, as a plan made from a stale cache could ask for.
+            run.remaining[category.id] = 10
+            await provisioner.start(guild, run, guild.command_channel)
+            for worker in partybot.action_scheduler.workers:
+                worker.cancel()
+            return run, unseen
+
+        run, unseen = asyncio.run(_run())
+        self.assertEqual(run.created, 3)
+        self.assertEqual(len(unseen), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+import partybot_fakes
+
+# Snowflakes for categories made long ago, so min_lifetime never holds them.
+OLD = 1 << 22
+
+
+def settings(max_categories=5, dynamic=True):
+    return partybot.PartyBotGuildSettings(
+        1, 2, 3, OLD, 5, 6, dynamic, max_categories, 0, partybot.CATEGORY_POLICY_FILL_FIRST)
+
+
+def occupancy(*counts, capacity=10):
+    occupancy = partybot.CategoryOccupancy(capacity)
+    for index, count in enumerate(counts):
+        category_id = OLD * (index + 1)
+        occupancy.add_category(category_id, range(category_id + 1, category_id + 1 + count))
+    return occupancy
+
+
+class CategoryAutoscalerTest(unittest.TestCase):
+    def autoscaler(self, **kwargs):
+        kwargs.setdefault("scale_up_free", 2)
+        kwargs.setdefault("scale_down_free", 5)
+        kwargs.setdefault("min_lifetime", 0)
+        kwargs.setdefault("down_delay", 0)
+        kwargs.setdefault("consolidate_below", 0)
+        return partybot.CategoryAutoscaler(**kwargs)
+
+    def test_idle_pool_rooms_count_as_free(self):
+        autoscaler = self.autoscaler()
+        full = occupancy(9)
+        self.assertTrue(autoscaler.wants_category(full, settings(), [OLD]))
+        # Four of those nine rooms are idle in the pool, nobody needs more.
+        self.assertFalse(autoscaler.wants_category(full, settings(), [OLD], {OLD: 4}))
+
+    def test_category_holding_only_pool_rooms_is_empty(self):
+        autoscaler = self.autoscaler()
+        state = occupancy(3, 2)
+        second = OLD * 2
+        self.assertEqual(autoscaler.track(1, state, OLD), {})
+        self.assertEqual(list(autoscaler.track(1, state, OLD, {second: 2})), [second])
+        self.assertEqual(autoscaler.scale_down_candidates(1, state, OLD, {second: 2}), [second])
+
+    def test_wants_category_only_when_allowed(self):
+        autoscaler = self.autoscaler()
+        full = occupancy(9)
+        self.assertTrue(autoscaler.wants_category(full, settings(), [OLD]))
+        self.assertFalse(autoscaler.wants_category(full, settings(dynamic=False), [OLD]))
+        self.assertFalse(autoscaler.wants_category(full, settings(max_categories=1), [OLD]))
+        self.assertFalse(autoscaler.wants_category(occupancy(7), settings(), [OLD]))
+
+    def test_thresholds_keep_a_gap(self):
+        self.assertEqual(self.autoscaler(scale_up_free=4, scale_down_free=2).scale_down_free, 5)
+
+    def test_scale_down_keeps_spare_slots(self):
+        state = occupancy(5, 0, 0)
+        self.assertEqual(self.autoscaler().scale_down_candidates(1, state, OLD), [OLD * 3, OLD * 2])
+        # Newest goes first, and only while the rest keep scale_down_free.
+        self.assertEqual(self.autoscaler(scale_down_free=10).scale_down_candidates(1, state, OLD), [OLD * 3])
+        self.assertEqual(self.autoscaler(scale_down_free=20).scale_down_candidates(1, state, OLD), [])
+
+    def test_empty_categories_wait_for_down_delay(self):
+        autoscaler = self.autoscaler(down_delay=60)
+        state = occupancy(5, 0)
+        second = OLD * 2
+        self.assertEqual(autoscaler.scale_down_candidates(1, state, OLD), [])
+        autoscaler.empty_since[1][second] -= 61
+        self.assertEqual(autoscaler.scale_down_candidates(1, state, OLD), [second])
+
+        # Used again, the clock starts over.
+        state.add_channel(second, second + 1)
+        self.assertEqual(autoscaler.track(1, state, OLD), {})
+        self.assertNotIn(1, autoscaler.empty_since)
+        state.remove_channel(second, second + 1)
+        self.assertEqual(autoscaler.scale_down_candidates(1, state, OLD), [])
+
+    def test_new_categories_live_min_lifetime(self):
+        state = occupancy(5)
+        new = partybot_fakes.next_id()
+        state.add_category(new)
+        self.assertEqual(self.autoscaler(min_lifetime=3600).scale_down_candidates(1, state, OLD), [])
+        self.assertEqual(self.autoscaler().scale_down_candidates(1, state, OLD), [new])
+
+    def test_consolidation_source(self):
+        state = occupancy(5, 2, 6)
+        second = OLD * 2
+        self.assertIsNone(self.autoscaler().consolidation_source(state, OLD))
+        self.assertEqual(self.autoscaler(consolidate_below=2).consolidation_source(state, OLD), second)
+        # Not when the others would be left short.
+        self.assertIsNone(self.autoscaler(consolidate_below=2, scale_down_free=10).consolidation_source(state, OLD))
+        # A category holding only pool rooms is for scale down, not consolidation.
+        self.assertIsNone(self.autoscaler(consolidate_below=2).consolidation_source(state, OLD, {second: 2}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+
+FILL_FIRST = partybot.CATEGORY_POLICY_FILL_FIRST
+LEAST_LOADED = partybot.CATEGORY_POLICY_LEAST_LOADED
+
+
+class CategoryOccupancyTest(unittest.TestCase):
+    def occupancy(self, *counts, capacity=3):
+        occupancy = partybot.CategoryOccupancy(capacity)
+        for index, count in enumerate(counts):
+            category_id = (index + 1) * 100
+            occupancy.add_category(category_id, range(category_id + 1, category_id + 1 + count))
+        return occupancy
+
+    def test_fill_first_picks_the_first_category_with_room(self):
+        occupancy = self.occupancy(3, 1, 0)
+        self.assertEqual(occupancy.pick(FILL_FIRST), 200)
+        occupancy.add_channel(200, 298)
+        occupancy.add_channel(200, 299)
+        self.assertEqual(occupancy.pick(FILL_FIRST), 300)
+        occupancy.remove_channel(100, 101)
+        self.assertEqual(occupancy.pick(FILL_FIRST), 100)
+
+    def test_least_loaded_picks_the_emptiest_category(self):
+        occupancy = self.occupancy(2, 1, 2)
+        self.assertEqual(occupancy.pick(LEAST_LOADED), 200)
+        occupancy.add_channel(200, 299)
+        # Ties go to the earlier category.
+        self.assertEqual(occupancy.pick(LEAST_LOADED), 100)
+        occupancy.remove_channel(300, 301)
+        self.assertEqual(occupancy.pick(LEAST_LOADED), 300)
+
+    def test_full_guild_has_nothing_to_pick(self):
+        occupancy = self.occupancy(3, 3)
+        self.assertIsNone(occupancy.pick(FILL_FIRST))
+        self.assertIsNone(occupancy.pick(LEAST_LOADED))
+        self.assertEqual(occupancy.free_slots(100), 0)
+
+    def test_updates_are_idempotent(self):
+        occupancy = self.occupancy(1)
+        occupancy.add_channel(100, 101)
+        occupancy.add_channel(100, 102)
+        occupancy.add_channel(100, 102)
+        self.assertEqual(occupancy.channel_count(100), 2)
+        occupancy.remove_channel(100, 102)
+        occupancy.remove_channel(100, 102)
+        self.assertEqual(occupancy.channel_count(100), 1)
+        # Channels outside managed categories are ignored.
+        occupancy.add_channel(999, 1)
+        self.assertNotIn(999, occupancy)
+
+    def test_removed_category_is_never_picked(self):
+        occupancy = self.occupancy(0, 0)
+        occupancy.remove_category(100)
+        self.assertNotIn(100, occupancy)
+        self.assertEqual(occupancy.pick(FILL_FIRST), 200)
+        self.assertEqual(occupancy.pick(LEAST_LOADED), 200)
+        occupancy.remove_category(100)
+
+    def test_reserved_slots_count_until_released(self):
+        occupancy = self.occupancy(2, 0)
+        occupancy.reserve(100)
+        self.assertEqual(occupancy.channel_count(100), 3)
+        self.assertEqual(occupancy.pick(FILL_FIRST), 200)
+        self.assertEqual(occupancy.pick(LEAST_LOADED), 200)
+        occupancy.unreserve(100)
+        self.assertEqual(occupancy.pick(FILL_FIRST), 100)
+        occupancy.unreserve(100)
+        self.assertEqual(occupancy.channel_count(100), 2)
+
+    def test_matches_compares_with_the_guild(self):
+        class Channel:
+            def __init__(self, id, channels=()):
+                self.id = id
+                self.channels = list(channels)
+
+        class Guild:
+            def __init__(self, channels):
+                self.channels = {channel.id: channel for channel in channels}
+
+            def get_channel(self, channel_id):
+                return self.channels.get(channel_id)
+
+        occupancy = self.occupancy(2)
+        self.assertTrue(occupancy.matches(Guild([Channel(100, [Channel(101), Channel(102)])])))
+        self.assertFalse(occupancy.matches(Guild([Channel(100, [Channel(101)])])))
+        self.assertFalse(occupancy.matches(Guild([])))
+
+
+if __name__ == "__main__":
+    unittest.main()
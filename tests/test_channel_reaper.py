@@ -0,0 +1,88 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+
+
+class Channel:
+    def __init__(self, id, members=()):
+        self.id = id
+        self.members = list(members)
+
+
+class Guild:
+    def __init__(self, id, channels):
+        self.id = id
+        self.channels = {channel.id: channel for channel in channels}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+class ChannelReaperTest(unittest.TestCase):
+    def age(self, reaper, guild_id, seconds):
+        marked = reaper.marked[guild_id]
+        for channel_id in marked:
+            marked[channel_id] -= seconds
+
+    def test_rooms_are_due_after_the_grace_period(self):
+        reaper = partybot.ChannelReaper(grace=30)
+        reaper.mark(1, 10)
+        reaper.mark(1, 11)
+        self.assertEqual(reaper.due_guilds(), [])
+        self.assertEqual(reaper.take_due(1), [])
+
+        self.age(reaper, 1, 31)
+        self.assertEqual(reaper.due_guilds(), [1])
+        self.assertEqual(sorted(reaper.take_due(1)), [10, 11])
+        self.assertNotIn(1, reaper.marked)
+        self.assertEqual(reaper.take_due(1), [])
+
+    def test_due_now_skips_the_grace_period(self):
+        reaper = partybot.ChannelReaper(grace=30)
+        reaper.mark(1, 10)
+        reaper.mark(1, 11, due_now=True)
+        self.assertEqual(reaper.take_due(1), [11])
+        # Rooms still in their grace period stay marked.
+        self.assertEqual(list(reaper.marked[1]), [10])
+
+    def test_marking_twice_keeps_the_first_mark(self):
+        reaper = partybot.ChannelReaper(grace=30)
+        reaper.mark(1, 10)
+        self.age(reaper, 1, 31)
+        reaper.mark(1, 10)
+        self.assertEqual(reaper.marks, 1)
+        self.assertEqual(reaper.take_due(1), [10])
+
+    def test_cancel_and_discard(self):
+        reaper = partybot.ChannelReaper(grace=0)
+        reaper.mark(1, 10)
+        reaper.mark(1, 11)
+        self.assertTrue(reaper.cancel(1, 10))
+        self.assertFalse(reaper.cancel(1, 10))
+        self.assertFalse(reaper.cancel(2, 10))
+        reaper.discard(1, 11)
+        reaper.discard(2, 11)
+        self.assertEqual(reaper.cancelled, 1)
+        self.assertEqual(reaper.take_due(1), [])
+
+    def test_reclaim_takes_the_oldest_empty_room(self):
+        reaper = partybot.ChannelReaper(grace=30)
+        guild = Guild(1, [Channel(10, ["someone"]), Channel(12), Channel(13)])
+        # 10 was rejoined without the mark being cancelled, 11 is gone.
+        for channel_id in (10, 11, 12, 13):
+            reaper.mark(1, channel_id)
+
+        self.assertEqual(reaper.reclaim(guild).id, 12)
+        self.assertEqual(list(reaper.marked[1]), [13])
+        self.assertEqual(reaper.reclaim(guild).id, 13)
+        self.assertIsNone(reaper.reclaim(guild))
+        self.assertNotIn(1, reaper.marked)
+        self.assertEqual(reaper.reclaimed, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import discord
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+import partybot_fakes
+
+
+class CommandRouterTest(unittest.TestCase):
+    def setUp(self):
+        partybot.permission_cache = partybot.PermissionCache()
+        self.client = partybot_fakes.FakeClient(partybot)
+        self.guild = partybot_fakes.build_party_guild(self.client)
+        self.guild_settings = partybot.PartyBotGuildSettings(
+            self.guild.id, self.guild.join_channel.id, self.guild.command_channel.id,
+            self.guild.main_category.id, self.guild.moderator_role.id, self.guild.manager_role.id, False, 0)
+
+        self.router = partybot.CommandRouter()
+        self.ran = []
+
+        @self.router.command("lock", partybot.PERMISSION_OWNER)
+        async def lock(context):
+            self.ran.append(("lock", context.arguments))
+
+        @self.router.command("set", partybot.PERMISSION_MANAGER)
+        async def set(context):
+            self.ran.append(("set", context.arguments))
+
+    def context(self, content, roles=(), voice_channel=None):
+        author = self.guild.add_member(partybot_fakes.FakeMember(self.guild, roles=roles))
+        message = partybot_fakes.FakeMessage(author, self.guild.command_channel, content)
+        parsed = self.router.parse(content)
+        context = partybot.CommandContext(message, self.guild, self.guild_settings, parsed[1], voice_channel)
+        return parsed[0], context
+
+    def dispatch(self, content, **kwargs):
+        command, context = self.context(content, **kwargs)
+        asyncio.run(self.router.dispatch(command, context))
+
+    def test_parse(self):
+        command, arguments = self.router.parse("!pb set pool_size 3")
+        self.assertEqual(command.name, "set")
+        self.assertEqual(arguments, ["pool_size", "3"])
+        self.assertEqual(self.router.parse("!pb lock")[1], [])
+        for content in ("", "!pb", "hello there", "!pbset pool_size 3", "!pb unknown", "pb lock"):
+            self.assertIsNone(self.router.parse(content), content)
+
+    def test_owner_commands_need_a_room(self):
+        self.dispatch("!pb lock")
+        self.assertEqual(self.ran, [])
+        room = partybot_fakes.FakeVoiceChannel(self.guild, "room")
+        self.dispatch("!pb lock now", voice_channel=room)
+        self.assertEqual(self.ran, [("lock", ["now"])])
+
+    def test_manager_commands_need_the_manage_role(self):
+        self.dispatch("!pb set pool_size 3")
+        self.dispatch("!pb set pool_size 4", roles=[self.guild.moderator_role])
+        self.assertEqual(self.ran, [])
+        self.dispatch("!pb set pool_size 5", roles=[self.guild.manager_role])
+        self.assertEqual(self.ran, [("set", ["pool_size", "5"])])
+
+    def test_manager_commands_need_the_bot_permissions(self):
+        self.guild.command_channel.permissions_for = lambda member: discord.Permissions.none()
+        self.dispatch("!pb set pool_size 3", roles=[self.guild.manager_role])
+        self.assertEqual(self.ran, [])
+
+    def test_dispatch_records_timings_even_on_failure(self):
+        @self.router.command("fail", partybot.PERMISSION_MANAGER)
+        async def fail(context):
+            raise RuntimeError("boom")
+
+        with self.assertRaises(RuntimeError):
+            self.dispatch("!pb fail", roles=[self.guild.manager_role])
+        self.dispatch("!pb set a b", roles=[self.guild.manager_role])
+        self.assertEqual(self.router.timings["fail"]["count"], 1)
+        self.assertEqual(self.router.timings["set"]["count"], 1)
+        self.assertNotIn("lock", self.router.timings)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+
+
+class DatabaseMaintenanceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.directory.name, "partybot.db")
+        # A file from before incremental auto-vacuum.
+        connection = sqlite3.connect(self.database)
+        connection.execute("CREATE TABLE filler(data BLOB)")
+        connection.executemany("INSERT INTO filler VALUES (?)", [(b"x" * 1000,) for _ in range(100)])
+        connection.commit()
+        connection.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_maintenance(self, test, **kwargs):
+        async def _run():
+            maintenance = partybot.DatabaseMaintenance(self.database, **kwargs)
+            try:
+                return await test(maintenance)
+            finally:
+                maintenance.close()
+
+        return asyncio.run(_run())
+
+    def test_small_database_is_converted_online(self):
+        async def test(maintenance):
+            self.assertTrue(await maintenance.enable_incremental_vacuum())
+            self.assertEqual(await maintenance._pragma("auto_vacuum"), 2)
+            self.assertFalse(await maintenance.enable_incremental_vacuum())
+
+        self.run_maintenance(test)
+
+    def test_large_database_is_left_for_offline_conversion(self):
+        async def test(maintenance):
+            self.assertFalse(await maintenance.enable_incremental_vacuum())
+            self.assertEqual(await maintenance._pragma("auto_vacuum"), 0)
+
+        self.run_maintenance(test, online_vacuum_max_bytes=4096)
+
+    def test_backups_in_the_same_second_are_kept_apart(self):
+        backups = os.path.join(self.directory.name, "backups")
+
+        async def test(maintenance):
+            return [await maintenance.backup() for _ in range(3)]
+
+        targets = self.run_maintenance(test, backup_directory=backups, keep_backups=2)
+        self.assertEqual(len(set(targets)), 3)
+        self.assertEqual(sorted(os.listdir(backups)), [os.path.basename(target) for target in targets[1:]])
+
+
+if __name__ == "__main__":
+    unittest.main()
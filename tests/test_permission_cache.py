@@ -0,0 +1,87 @@
+import discord
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+import partybot_fakes
+
+MANAGER = partybot.PermissionCache.MANAGER
+MODERATOR = partybot.PermissionCache.MODERATOR
+ADMINISTRATOR = partybot.PermissionCache.ADMINISTRATOR
+
+
+class PermissionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = partybot.PermissionCache(ttl=300)
+        self.client = partybot_fakes.FakeClient(partybot)
+        self.guild = partybot_fakes.build_party_guild(self.client)
+        self.guild_settings = partybot.PartyBotGuildSettings(
+            self.guild.id, self.guild.join_channel.id, self.guild.command_channel.id,
+            self.guild.main_category.id, self.guild.moderator_role.id, self.guild.manager_role.id, False, 0)
+
+    def member(self, roles=(), administrator=False):
+        return self.guild.add_member(partybot_fakes.FakeMember(self.guild, roles=roles, administrator=administrator))
+
+    def test_flags(self):
+        cases = [
+            (self.member(), 0, False, False),
+            (self.member([self.guild.moderator_role]), MODERATOR, True, False),
+            (self.member([self.guild.manager_role]), MANAGER, True, True),
+            (self.member(administrator=True), ADMINISTRATOR, True, True),
+            (self.member([self.guild.manager_role, self.guild.moderator_role], True),
+             MANAGER | MODERATOR | ADMINISTRATOR, True, True),
+        ]
+        for member, flags, staff, manager in cases:
+            with self.subTest(member=member):
+                self.assertEqual(self.cache.member_flags(member, self.guild_settings), flags)
+                self.assertEqual(self.cache.is_staff(member, self.guild_settings), staff)
+                self.assertEqual(self.cache.is_manager(member, self.guild_settings), manager)
+
+    def test_member_flags_are_cached_until_invalidated(self):
+        member = self.member()
+        self.assertFalse(self.cache.is_manager(member, self.guild_settings))
+        member.roles.append(self.guild.manager_role)
+        self.assertFalse(self.cache.is_manager(member, self.guild_settings))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        self.cache.invalidate_member(self.guild.id, member.id)
+        self.assertTrue(self.cache.is_manager(member, self.guild_settings))
+        member.roles.clear()
+        self.cache.invalidate_members(self.guild.id)
+        self.assertFalse(self.cache.is_manager(member, self.guild_settings))
+        member.roles.append(self.guild.manager_role)
+        self.cache.invalidate_guild(self.guild.id)
+        self.assertTrue(self.cache.is_manager(member, self.guild_settings))
+        # Unknown guilds and members are fine to invalidate.
+        self.cache.invalidate_member(0, member.id)
+        self.cache.invalidate_member(self.guild.id, 0)
+
+    def test_member_flags_expire(self):
+        member = self.member()
+        self.assertFalse(self.cache.is_manager(member, self.guild_settings))
+        member.roles.append(self.guild.manager_role)
+        flags, expires = self.cache.members[self.guild.id][member.id]
+        self.cache.members[self.guild.id][member.id] = (flags, expires - 301)
+        self.assertTrue(self.cache.is_manager(member, self.guild_settings))
+
+    def test_bot_permissions_are_cached_per_channel(self):
+        channel = self.guild.command_channel
+        other = self.guild.chat_channel
+        self.assertFalse(self.cache.bot_missing_permissions(channel))
+        channel.permissions_for = lambda member: discord.Permissions.none()
+        self.assertFalse(self.cache.bot_missing_permissions(channel))
+
+        self.cache.invalidate_channel(self.guild.id, channel.id)
+        self.assertTrue(self.cache.bot_missing_permissions(channel))
+        self.assertFalse(self.cache.bot_missing_permissions(other))
+        del channel.permissions_for
+        self.cache.invalidate_bot(self.guild.id)
+        self.assertFalse(self.cache.bot_missing_permissions(channel))
+        self.cache.invalidate_channel(0, channel.id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+
+
+def settings(guild_id, policy=partybot.CATEGORY_POLICY_LEAST_LOADED):
+    return partybot.PartyBotGuildSettings(
+        guild_id, guild_id + 1, None, guild_id + 3, guild_id + 4, guild_id + 5, True, 10, 2, policy)
+
+
+class StateSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.directory.name, "partybot.db")
+        self.filename = os.path.join(self.directory.name, "partybot.snapshot")
+        partybot.category_occupancy.clear()
+
+    def tearDown(self):
+        partybot.category_occupancy.clear()
+        self.directory.cleanup()
+
+    def open_storage(self, **kwargs):
+        storage = partybot.Storage(self.database, **kwargs)
+        partybot.storage = storage
+        return storage
+
+    def test_pack_read_round_trip(self):
+        state = (
+            [partybot.dataclasses.astuple(settings(100)), partybot.dataclasses.astuple(settings(200, "fill_first"))],
+            [(100, [103, 110, 111]), (200, [None])],
+            [(500, 600, 100), (501, 601, None)],
+            [(100, 102)],
+        )
+        occupancy = [(100, [(103, [500, 501]), (110, []), (111, [502])])]
+        data = partybot.StateSnapshot.pack(42, "4:0,1", True, state, occupancy)
+        with open(self.filename, "wb") as f:
+            f.write(data)
+
+        snapshot = partybot.StateSnapshot.read(self.filename)
+        self.assertEqual(snapshot["schema_version"], partybot.Storage.SCHEMA_VERSION)
+        self.assertEqual(snapshot["generation"], 42)
+        self.assertEqual(snapshot["shard_key"], "4:0,1")
+        self.assertTrue(snapshot["complete"])
+        self.assertEqual(snapshot["settings"], state[0])
+        self.assertEqual(snapshot["categories"], state[1])
+        self.assertEqual(snapshot["owners"], state[2])
+        self.assertEqual(snapshot["command_channels"], state[3])
+        self.assertEqual(snapshot["occupancy"], {100: {103: [500, 501], 110: [], 111: [502]}})
+
+    def test_corrupt_file_is_rejected(self):
+        data = bytearray(partybot.StateSnapshot.pack(1, "", True, ([], [], [(1, 2, 3)], []), []))
+        data[len(data) // 2] ^= 0xFF
+        with open(self.filename, "wb") as f:
+            f.write(data)
+
+        with self.assertRaises(ValueError):
+            partybot.StateSnapshot.read(self.filename)
+
+    def test_restore_rejects_stale_generation(self):
+        async def _run():
+            storage = self.open_storage()
+            storage.load_all()
+            await storage.set_party_bot_guild_settings(settings(100))
+            await storage.set_channel_owner(100, 500, 600)
+            self.assertGreater(await partybot.save_state_snapshot(self.filename), 0)
+            storage.close()
+
+        asyncio.run(_run())
+
+        storage = self.open_storage()
+        self.assertTrue(partybot.restore_state_snapshot(self.filename))
+        self.assertEqual(storage.party_bot_channels.get(500), 600)
+        storage.executor.call(lambda connection, cursor: (
+            cursor.execute("DELETE FROM partybot_owners WHERE channel_id = 500"), connection.commit()))
+        storage.close()
+
+        storage = self.open_storage()
+        self.assertFalse(partybot.restore_state_snapshot(self.filename))
+        storage.close()
+
+    def test_owner_replaced_from_another_guild_invalidates_snapshot(self):
+        # A user owns a room in guild 111, then takes one in guild 222 from a
+        # shard worker that doesn't own 111; the unique index removes the
+        # first row, and 111's worker must notice.
+        async def _run():
+            storage = self.open_storage(guild_filter=lambda guild_id: guild_id == 111)
+            storage.load_all()
+            await storage.set_channel_owner(111, 501, 8)
+            await storage.set_channel_owner(111, 500, 9)
+            self.assertGreater(await partybot.save_state_snapshot(self.filename), 0)
+            storage.close()
+
+            storage = self.open_storage(guild_filter=lambda guild_id: guild_id == 222)
+            storage.load_all()
+            await storage.set_channel_owner(222, 600, 9)
+            generations = dict(await storage._fetchall_async(partybot.Storage.PARTYBOT_SELECT_GENERATIONS_QUERY, ()))
+            self.assertEqual(generations, {111: 3, 222: 1})
+            storage.close()
+
+        asyncio.run(_run())
+
+        storage = self.open_storage(guild_filter=lambda guild_id: guild_id == 111)
+        self.assertFalse(partybot.restore_state_snapshot(self.filename))
+        storage.close()
+
+    def test_write_during_snapshot_never_restores_unsaved_state(self):
+        # A write racing the snapshot, then a crash before write-behind
+        # flushes it: whatever is restored must be what the database holds.
+        for yields in range(8):
+            with self.subTest(yields=yields):
+                if os.path.exists(self.filename):
+                    os.remove(self.filename)
+
+                async def _run():
+                    storage = self.open_storage(write_behind=True, flush_interval=60)
+                    storage.load_all()
+                    await storage.set_party_bot_guild_settings(settings(1))
+                    await storage.flush()
+                    snapshot = asyncio.ensure_future(partybot.save_state_snapshot(self.filename))
+                    for _ in range(yields):
+                        await asyncio.sleep(0)
+                    await storage.set_channel_owner(1, 77, 777)
+                    await snapshot
+                    storage._pending_writes = []
+                    storage._flush_task.cancel()
+                    storage.executor.close()
+
+                asyncio.run(_run())
+
+                storage = self.open_storage()
+                owners = storage.executor.call(lambda connection, cursor: cursor.execute(
+                    "SELECT channel_id, user_id FROM partybot_owners").fetchall())
+                if partybot.restore_state_snapshot(self.filename):
+                    self.assertEqual(dict(storage.party_bot_channels.items()), dict(owners))
+                storage.close()
+                os.remove(self.database)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+
+
+class BoundedCacheTest(unittest.TestCase):
+    def test_unbounded_keeps_everything(self):
+        cache = partybot.BoundedCache("test")
+        for i in range(100):
+            cache[i] = i
+        self.assertEqual(len(cache), 100)
+        self.assertEqual(cache.evictions, 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = partybot.BoundedCache("test", max_size=2)
+        cache[1] = "a"
+        cache[2] = "b"
+        self.assertEqual(cache[1], "a")
+        cache[3] = "c"
+        self.assertNotIn(2, cache)
+        self.assertEqual(sorted(cache), [1, 3])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_expiry_and_negative_ttl(self):
+        cache = partybot.BoundedCache("test", ttl=60, negative_ttl=0.01)
+        cache[1] = "a"
+        cache[2] = None
+        time.sleep(0.02)
+        self.assertEqual(cache.get(1), "a")
+        self.assertNotIn(2, cache)
+        self.assertEqual(cache.get(2, -1), -1)
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_on_evict_sees_evicted_and_expired_entries(self):
+        evicted = []
+        cache = partybot.BoundedCache("test", max_size=1, ttl=0.01)
+        cache.on_evict = lambda key, value: evicted.append((key, value))
+        cache[1] = "a"
+        cache[2] = "b"
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(evicted, [(1, "a"), (2, "b")])
+
+    def test_discard_if_only_matching_value(self):
+        cache = partybot.BoundedCache("test")
+        cache[1] = "a"
+        cache.discard_if(1, "b")
+        self.assertIn(1, cache)
+        cache.discard_if(1, "a")
+        self.assertNotIn(1, cache)
+        cache.discard_if(1, "a")
+
+
+class BoundedStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.directory.name, "partybot.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_storage(self, test, **kwargs):
+        async def _run():
+            storage = partybot.Storage(self.database, **kwargs)
+            storage.load_all()
+            try:
+                await test(storage)
+            finally:
+                storage.close()
+
+        asyncio.run(_run())
+
+    def test_bounded_storage_reads_through_on_miss(self):
+        async def test(storage):
+            self.assertTrue(storage.bounded)
+            self.assertFalse(storage.loaded)
+            for i in range(5):
+                await storage.set_channel_owner(1, 100 + i, 1000 + i)
+            self.assertLessEqual(len(storage.party_bot_channels), 2)
+            for i in range(5):
+                self.assertEqual(await storage.get_channel_owner(100 + i), 1000 + i)
+                self.assertEqual(await storage.get_owner_channel(1000 + i), 100 + i)
+            self.assertIsNone(await storage.get_channel_owner(999))
+            self.assertGreater(storage.cache_misses, 0)
+
+        self.run_storage(test, cache_max_owners=2)
+
+    def test_transfer_after_one_direction_was_evicted(self):
+        async def test(storage):
+            await storage.set_channel_owner(1, 100, 1000)
+            # Touching the owner side only, so an LRU per map would keep
+            # 1000 -> 100 while evicting 100 -> 1000.
+            await storage.set_channel_owner(1, 101, 1001)
+            self.assertEqual(await storage.get_owner_channel(1000), 100)
+            await storage.set_channel_owner(1, 102, 1002)
+            self.assertEqual(await storage.get_owner_channel(1000), 100)
+
+            await storage.set_channel_owner(1, 100, 2000)
+            self.assertIsNone(await storage.get_owner_channel(1000))
+            self.assertEqual(await storage.get_owner_channel(2000), 100)
+            self.assertEqual(await storage.get_channel_owner(100), 2000)
+            for channel_id, owner_id in storage.party_bot_channels.items():
+                self.assertEqual(storage.party_bot_owners.get(owner_id), channel_id)
+
+        self.run_storage(test, cache_max_owners=2)
+
+    def test_channel_owners_batch_reads_through(self):
+        async def test(storage):
+            for i in range(5):
+                await storage.set_channel_owner(1, 100 + i, 1000 + i)
+            operations = storage.executor.operations
+            owners = await storage.get_channel_owners([100, 101, 103, 104, 999])
+            self.assertEqual(owners, {100: 1000, 101: 1001, 103: 1003, 104: 1004})
+            # Whatever wasn't cached came back in a single executor call.
+            self.assertEqual(storage.executor.operations, operations + 1)
+
+        self.run_storage(test, cache_max_owners=2)
+
+    def test_channel_owners_batch_from_loaded_cache(self):
+        async def test(storage):
+            self.assertTrue(storage.loaded)
+            await storage.set_channel_owner(1, 100, 1000)
+            operations = storage.executor.operations
+            self.assertEqual(await storage.get_channel_owners([100, 999]), {100: 1000})
+            self.assertEqual(storage.executor.operations, operations)
+
+        self.run_storage(test)
+
+    def test_delete_channel_after_eviction(self):
+        async def test(storage):
+            await storage.set_channel_owner(1, 100, 1000)
+            await storage.set_channel_owner(1, 101, 1001)
+            await storage.set_channel_owner(1, 102, 1002)
+            await storage.delete_channel(100)
+            self.assertIsNone(await storage.get_owner_channel(1000))
+            self.assertIsNone(await storage.get_channel_owner(100))
+
+        self.run_storage(test, cache_max_owners=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partybot
+import partybot_fakes
+
+
+class VoicePlacementTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        partybot.category_occupancy.clear()
+        partybot.voice_pipeline = partybot.GuildEventPipeline(partybot.handle_voice_state_updates)
+        partybot.channel_reaper = partybot.ChannelReaper()
+        partybot.admission_queue = partybot.AdmissionQueue()
+        partybot.voice_channel_pool = partybot.VoiceChannelPool()
+        partybot.action_scheduler = partybot.ActionScheduler()
+        partybot.permission_cache = partybot.PermissionCache()
+
+    def tearDown(self):
+        for worker in partybot.action_scheduler.workers:
+            worker.cancel()
+        partybot.category_occupancy.clear()
+        self.directory.cleanup()
+
+    def run_async(self, coroutine):
+        async def _run():
+            self.storage = partybot.Storage(os.path.join(self.directory.name, "partybot.db"))
+            self.storage.load_all()
+            partybot.storage = self.storage
+            self.client = partybot_fakes.FakeClient(partybot)
+            partybot.client = self.client
+            try:
+                return await coroutine()
+            finally:
+                for worker in partybot.action_scheduler.workers:
+                    worker.cancel()
+                self.storage.close()
+
+        return asyncio.run(_run())
+
+    async def build_guild(self, members, max_categories=1, dynamic=False):
+        guild = partybot_fakes.build_party_guild(self.client, members)
+        await self.storage.set_party_bot_guild_settings(partybot.PartyBotGuildSettings(
+            guild.id, guild.join_channel.id, guild.command_channel.id, guild.main_category.id,
+            guild.moderator_role.id, guild.manager_role.id, dynamic, max_categories, 0,
+            partybot.CATEGORY_POLICY_FILL_FIRST))
+        return guild
+
+    async def settle(self):
+        for _ in range(20):
+            await self.client.join()
+            await partybot.voice_pipeline.join()
+            await asyncio.sleep(0)
+
+    def members(self, guild):
+        return [member for member in guild.members.values() if member.name.startswith("member")]
+
+    def fail_moves(self, member):
+        async def move_to(channel, reason=None):
+            raise partybot_fakes.FakeHTTPException("400 Target user is not connected to voice (fake)")
+        member.move_to = move_to
+
+    def test_failed_move_does_not_drop_the_batch(self):
+        async def _run():
+            guild = await self.build_guild(3)
+            first, failing, last = self.members(guild)
+            self.fail_moves(failing)
+            # One batch: the pipeline collects all three before its worker runs.
+            for member in (first, failing, last):
+                member.connect(guild.join_channel)
+            await self.settle()
+
+            for member in (first, last):
+                self.assertNotEqual(member.voice.channel.id, guild.join_channel.id)
+                self.assertEqual(await self.storage.get_owner_channel(member.id), member.voice.channel.id)
+            # The room made for the member that couldn't be moved is left to the reaper.
+            marked = partybot.channel_reaper.marked.get(guild.id, {})
+            self.assertEqual(len(marked), 1)
+            room_id = next(iter(marked))
+            self.assertEqual(await self.storage.get_channel_owner(room_id), failing.id)
+            self.assertFalse(guild.get_channel(room_id).members)
+
+        self.run_async(_run)
+
+    def test_failed_move_room_is_reaped(self):
+        async def _run():
+            guild = await self.build_guild(1)
+            failing, = self.members(guild)
+            self.fail_moves(failing)
+            failing.connect(guild.join_channel)
+            await self.settle()
+
+            room_id, = partybot.channel_reaper.marked[guild.id]
+            partybot.channel_reaper.grace = 0
+            partybot.voice_pipeline.submit(guild.id, partybot.CHANNEL_REAP)
+            await self.settle()
+            await asyncio.sleep(0.01)
+            await self.settle()
+
+            self.assertIsNone(guild.get_channel(room_id))
+            self.assertIsNone(await self.storage.get_channel_owner(room_id))
+            self.assertIsNone(await self.storage.get_owner_channel(failing.id))
+
+        self.run_async(_run)
+
+    def patch_place_member(self, place):
+        original = partybot.place_member
+        partybot.place_member = place
+        self.addCleanup(setattr, partybot, "place_member", original)
+        return original
+
+    def test_failed_placement_keeps_admitting(self):
+        async def _run():
+            guild = await self.build_guild(3)
+            first, failing, last = self.members(guild)
+
+            async def place(member, *args):
+                if member is failing:
+                    raise RuntimeError("placement failed")
+                return await original(member, *args)
+            original = self.patch_place_member(place)
+
+            for member in (first, failing, last):
+                member.connect(guild.join_channel)
+            await self.settle()
+
+            self.assertNotEqual(first.voice.channel.id, guild.join_channel.id)
+            self.assertNotEqual(last.voice.channel.id, guild.join_channel.id)
+            self.assertEqual(failing.voice.channel.id, guild.join_channel.id)
+            self.assertEqual(partybot.admission_queue.size(guild.id), 0)
+            self.assertEqual(partybot.admission_queue.failed, 1)
+
+        self.run_async(_run)
+
+    def test_failed_placement_still_sheds_overdue_waiters(self):
+        async def _run():
+            guild = await self.build_guild(2)
+            failing, overdue = self.members(guild)
+            for member in (failing, overdue):
+                member._set_voice(guild.join_channel)
+                partybot.admission_queue.enqueue(guild.id, member.id)
+            partybot.admission_queue.waiting[guild.id][overdue.id] -= partybot.admission_queue.max_wait
+
+            async def place(member, *args):
+                if member is failing:
+                    raise RuntimeError("placement failed")
+                return False
+            self.patch_place_member(place)
+
+            partybot.voice_pipeline.submit(guild.id, partybot.ADMIT)
+            await self.settle()
+
+            self.assertIsNone(overdue.voice)
+            self.assertEqual(partybot.admission_queue.shed["timeout"], 1)
+            self.assertFalse(partybot.admission_queue.contains(guild.id, failing.id))
+
+        self.run_async(_run)
+
+
+if __name__ == "__main__":
+    unittest.main()